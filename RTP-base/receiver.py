@@ -1,34 +1,37 @@
 import argparse
 import socket
-from collections import defaultdict
 import sys
 
-from utils import PacketHeader, compute_checksum
+from utils import (CRC32, HEADER_SIZE, BatchIO, DelayedAcks, PacketHeader, ReorderBuffer,
+                   TraceWriter, accept_checksum, checksum_offer, compute_checksum, verify_packet)
 
 buffer_size = 2048
 no_port = -1000
 
-def verify_checksum(header, payload):
-    """Verify packet checksum"""
-    saved_checksum = header.checksum
-    header.checksum = 0
-    calculated = compute_checksum(bytes(header) + payload)
-    # print(f"Calculated checksum: {calculated} with saved checksum: {saved_checksum}")
-    header.checksum = saved_checksum
-    return calculated == saved_checksum
-
-    
-
-def receiver(receiver_ip, receiver_port, window_size):
+def receiver(receiver_ip, receiver_port, window_size, batch_size=1, ack_every=1,
+             ack_delay=0.002, trace_path=None):
     
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.settimeout(0.5)
+    # Room for a full window of datagrams, bursts overflow the default size
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, window_size * buffer_size)
     s.bind((receiver_ip, receiver_port))
     
     expected_seq_num = 0
-    data_buffer = defaultdict(bytes) # Avoid key error
-    received_data = bytearray()
+    # Out-of-order payloads only, in a ring of preallocated slots
+    data_buffer = ReorderBuffer(window_size)
+    # In-order data is written out as soon as the window base advances,
+    # only out-of-order packets inside the window are kept in memory
+    output = sys.stdout.buffer
     connection_established = no_port # Ensure only one sender can connect
+    # sendmmsg/recvmmsg batching of data packets and ACKs (Linux)
+    batch_io = BatchIO(s, batch_size, buffer_size)
+    acks = [] # ACKs queued for one batched send
+    # Cumulative ACKs are coalesced: one covers every in-order packet before it
+    ack_policy = DelayedAcks(ack_every, ack_delay)
+    checksum = CRC32 # Checksum of the connection, agreed in the START handshake
+    # Optional binary packet trace, see trace_analyze.py
+    trace = TraceWriter(trace_path) if trace_path is not None else None
     
     # Support function to send ACK
     def send_ack(ack_seq_num, address):
@@ -38,88 +41,136 @@ def receiver(receiver_ip, receiver_port, window_size):
             length=0,
             checksum=0
         )
-        ack_header.checksum = compute_checksum(ack_header)
-        s.sendto(bytes(ack_header), address)
+        ack_header.checksum = compute_checksum(ack_header, checksum)
+        acks.append((bytes(ack_header), address))
+        if trace is not None:
+            trace("cumulative_ack_sent", ack_seq_num, HEADER_SIZE)
+    
+    # Support function to ACK a START, echoing the checksum taken (in crc32
+    # like every START ACK)
+    def send_start_ack(address):
+        payload = checksum_offer(checksum)
+        ack_header = PacketHeader(
+            type=3,
+            seq_num=1,
+            length=len(payload),
+            checksum=0
+        )
+        ack_header.checksum = compute_checksum(bytes(ack_header) + payload)
+        acks.append((bytes(ack_header) + payload, address))
+        if trace is not None:
+            trace("cumulative_ack_sent", 1, HEADER_SIZE + len(payload))
     
     # print("Receiver is listening")
     
-    while True:
+    done = False
+    while not done:
         # print("Waiting for package")
+        # Wake up when the delayed ACK timer expires
+        s.settimeout(ack_policy.timeout(0.5))
         try:
-            package, address = s.recvfrom(buffer_size)
+            batch = batch_io.recv_batch()
         except socket.timeout:
             # print("Timeout when waiting package")
-            continue
-        
-        # print("Received package")
-        # Check valid package
-        if (len(package) < 16):
-            # print("Invalid length packet")
-            continue
+            batch = ()
         
-        try:
-            header = PacketHeader(package[:16])
-        except: # Wrong format
-            # print("Wrong format packet")
-            continue
+        for package, address in batch:
+            # print("Received package")
+            # Check valid package
+            if (len(package) < 16):
+                # print("Invalid length packet")
+                if trace is not None:
+                    trace("checksum_failure", 0, len(package))
+                continue
         
-        # Ensure payload only contains data
-        # print(f"Received package type: {header.type} Reading payload")
-        payload = package[16:16+header.length]
+            try:
+                header = PacketHeader.unpack_from(package)
+            except: # Wrong format
+                # print("Wrong format packet")
+                continue
         
-        # Drop package if checksum is invalid
-        if not verify_checksum(header, payload):
-            # print(f"Invalid checksum: {header.checksum} with {header.seq_num}")
-            if connection_established == address:
-                send_ack(expected_seq_num, address)
-            continue
+            # Ensure payload only contains data; package is a view into the
+            # receive buffer, so slicing it does not copy
+            # print(f"Received package type: {header.type} Reading payload")
+            payload = package[16:16+header.length]
         
-        # print("Valid package")
+            # Drop package if checksum is invalid
+            if not verify_packet(package, header, checksum):
+                # print(f"Invalid checksum: {header.checksum} with {header.seq_num}")
+                if trace is not None:
+                    trace("checksum_failure", header.seq_num, len(package))
+                if connection_established == address:
+                    send_ack(expected_seq_num, address)
+                continue
         
-        # Start handshake
-        if header.type == 0 and not connection_established == address:
-            # print("Start handshake")
-            if header.seq_num == 0:
-                send_ack(1, address)
-                connection_established = address
-                expected_seq_num = 1
-            continue
+            # print("Valid package")
         
-        if header.type == 0 and connection_established == address:
-            if header.seq_num == 0: # Resend ACK
-                # print("Resend start ACK")
-                send_ack(1, address)
+            # Start handshake
+            if header.type == 0 and not connection_established == address:
+                # print("Start handshake")
+                if header.seq_num == 0:
+                    checksum = accept_checksum(package, header)
+                    send_start_ack(address)
+                    connection_established = address
+                    expected_seq_num = 1
                 continue
+        
+            if header.type == 0 and connection_established == address:
+                if header.seq_num == 0: # Resend ACK
+                    # print("Resend start ACK")
+                    send_start_ack(address)
+                    continue
     
-        # Data transmission
-        if header.type == 2 and connection_established == address:
-            seq_num = header.seq_num
-            # print(f"Data transmission with seq_num: {seq_num}")
+            # Data transmission
+            if header.type == 2 and connection_established == address:
+                seq_num = header.seq_num
+                # print(f"Data transmission with seq_num: {seq_num}")
             
-            if seq_num < expected_seq_num:
-                send_ack(expected_seq_num, address)
-            elif seq_num < expected_seq_num + window_size:
-                if seq_num not in data_buffer:
-                    data_buffer[seq_num] = payload
+                if trace is not None:
+                    if seq_num < expected_seq_num:
+                        trace("duplicate", seq_num, len(package))
+                    elif seq_num < expected_seq_num + window_size:
+                        trace("data", seq_num, len(package))
+                    else:
+                        trace("out_of_window", seq_num, len(package))
+                if seq_num < expected_seq_num:
+                    # Duplicate, the sender missed an ACK
+                    ack_policy.on_data(False)
+                elif seq_num < expected_seq_num + window_size:
+                    # In order: the window base with no gap behind it
+                    ack_policy.on_data(seq_num == expected_seq_num and not data_buffer.count)
+                    if seq_num == expected_seq_num:
+                        # In-order packet, written straight from the receive buffer
+                        output.write(payload)
+                        expected_seq_num += 1
+                    else:
+                        # Copied into its slot, the receive buffer is reused by the next batch
+                        data_buffer.store(seq_num, payload)
                 
-                # In order delivery
-                while expected_seq_num in data_buffer:
-                    received_data.extend(data_buffer[expected_seq_num])
-                    del data_buffer[expected_seq_num]
-                    expected_seq_num += 1
-            # Drop out of window packets seq_num >= expected_seq_num + window_size case
-            
-                send_ack(expected_seq_num, address)
+                    # In order delivery
+                    if data_buffer.count:
+                        expected_seq_num = data_buffer.drain(expected_seq_num, output.write)
+                # Drop out of window packets seq_num >= expected_seq_num + window_size case
             
-        # End handshake
-        if header.type == 1 and connection_established:
-            if header.seq_num == expected_seq_num:
-                send_ack(expected_seq_num + 1, address)
-                sys.stdout.buffer.write(received_data)
-                sys.stdout.buffer.flush()
-                break
+            # End handshake
+            if header.type == 1 and connection_established:
+                if header.seq_num == expected_seq_num:
+                    send_ack(expected_seq_num + 1, address)
+                    done = True
+                    break
+        
+        # One cumulative ACK for the whole batch, or several when delayed
+        if ack_policy.due() and connection_established != no_port:
+            send_ack(expected_seq_num, connection_established)
+            ack_policy.sent()
+        # One batched send for the ACKs of the whole batch
+        batch_io.send_batch(acks)
+        acks.clear()
+        output.flush()
             
     s.close()
+    if trace is not None:
+        trace.close()
     # while True:
     #     # Receive packet; address includes both IP and port
 
@@ -148,9 +199,26 @@ def main():
     parser.add_argument(
         "window_size", type=int, help="Maximum number of outstanding packets"
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Datagrams per sendmmsg/recvmmsg call (1 disables batching)"
+    )
+    parser.add_argument(
+        "--ack-every", type=int, default=1,
+        help="Acknowledge every N in-order packets (out-of-order ones at once)"
+    )
+    parser.add_argument(
+        "--ack-delay", type=float, default=0.002,
+        help="Longest delay in seconds of an ACK owed to in-order packets"
+    )
+    parser.add_argument(
+        "--trace", dest="trace_path",
+        help="Record a binary packet trace to this file (see trace_analyze.py)"
+    )
     args = parser.parse_args()
 
-    receiver(args.receiver_ip, args.receiver_port, args.window_size)
+    receiver(args.receiver_ip, args.receiver_port, args.window_size, args.batch_size,
+             args.ack_every, args.ack_delay, args.trace_path)
 
 
 if __name__ == "__main__":
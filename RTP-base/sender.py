@@ -1,115 +1,223 @@
 import argparse
+import logging
 import socket
 import sys
 import time
 from collections import OrderedDict
 
-from utils import PacketHeader, compute_checksum
+from utils import (CHECKSUMS, CONGESTION_CONTROLS, INPUT_PENDING, BatchIO, MappedFilePackets,
+                   PacketHeader, RTTEstimator, StreamPackets, TraceWriter, agreed_checksum,
+                   checksum_offer, compute_checksum, packet_size, verify_packet, wait_input)
+
+# Connection events at INFO, every packet at DEBUG
+log = logging.getLogger(__name__)
 
 chunk_size = 1472 - 16 # 1472 is the maximum size of a packet
 buffer_size = 2048
 
-def verify_checksum(header):
-    """Verify packet checksum"""
-    saved_checksum = header.checksum
-    header.checksum = 0
-    return compute_checksum(header) == saved_checksum
-
-def sender(receiver_ip, receiver_port, window_size):
+def sender(receiver_ip, receiver_port, window_size, batch_size=1, file_path=None,
+           congestion="none", cc_trace=False, reorder_threshold=3, checksum="crc32",
+           trace_path=None):
     """
     
     """
     """TODO: Open socket and send message from sys.stdin."""
     # Create a UDP socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(0.5)
+    # Adaptive retransmission timeout of this connection
+    rtt = RTTEstimator()
+    # Congestion window, capped by the receiver window (window_size)
+    cc = CONGESTION_CONTROLS[congestion](window_size)
+    if cc_trace:
+        cc.trace = lambda event, state: print(f"cc {event}: {state}", file=sys.stderr)
+    # Optional binary packet trace, see trace_analyze.py
+    trace = TraceWriter(trace_path) if trace_path is not None else None
+    s.settimeout(rtt.rto)
+    # sendmmsg/recvmmsg batching of data packets and ACKs (Linux)
+    batch_io = BatchIO(s, batch_size, buffer_size)
     
-    # Handshake with START packet
+    # Handshake with START packet, offering the checksum of the connection
+    offered = CHECKSUMS[checksum]
+    offer = checksum_offer(offered)
     start_header = PacketHeader(
         type=0,
         seq_num=0,
-        length=0,
+        length=len(offer),
         checksum=0
     )
-    start_header.checksum = compute_checksum(bytes(start_header) + b'')
+    start_header.checksum = compute_checksum(bytes(start_header) + offer)
     
     # Send START until ACK is received
+    attempts = 0
     while True:
-        print("Sending START")
-        s.sendto(bytes(start_header), (receiver_ip, receiver_port))
+        log.debug("Sending START")
+        s.sendto(bytes(start_header) + offer, (receiver_ip, receiver_port))
+        sent_time = time.time()
+        attempts += 1
         try:
-            print("Waiting for ACK at start")
+            log.debug("Waiting for ACK at start")
             ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            ack_header = PacketHeader.unpack_from(ack_data)
             if(ack_header.type == 3 and #ACK type
                 ack_header.seq_num == 1):
-                    if(verify_checksum(ack_header)):
+                    if(verify_packet(ack_data, ack_header)):
+                        # Karn's rule: the RTT of a resent START is ambiguous
+                        if attempts == 1:
+                            rtt.sample(time.time() - sent_time)
+                        # crc32 unless the receiver took the offer
+                        checksum = agreed_checksum(ack_data, ack_header, offered)
                         break
                     else:
-                        print("Invalid checksum for start ACK")
-        except (socket.timeout, ValueError):
-            print("Timeout when waiting for ACK")
+                        log.info("Invalid checksum for start ACK")
+        except socket.timeout:
+            log.info("Timeout when waiting for ACK")
+            rtt.on_timeout()
+            s.settimeout(rtt.rto)
+        except ValueError:
             continue
     
-    print("Connection established")
-    # Data transmission
-    data = sys.stdin.buffer.read()
-    chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
-    n_packets = len(chunks)
+    log.info("Connection established, checksum %s", checksum.name)
+    # Data transmission: chunks are read from stdin only when the window
+    # has room, so transmission starts before EOF. A regular file given
+    # with --file is memory-mapped and sent as slices of the mapping.
+    if file_path is not None:
+        source = MappedFilePackets(file_path, chunk_size, checksum)
+    else:
+        source = StreamPackets(sys.stdin.buffer, chunk_size, window_size, checksum)
+    eof = False
     
     # Sliding window mechanism implementation
     start = 1 # First data packet seq_num
     next_seq_num = 1
     packets = OrderedDict()
+    batch = [] # Datagrams queued for one batched send
+    # The timer restarts whenever an ACK acknowledges new data (RFC 6298)
+    timer_start = time.time()
+    # Fast retransmit: reorder_threshold duplicate ACKs (later packets
+    # arrived while the base is missing) resend the base without waiting
+    # for the timeout, then every partial ACK resends the next hole
+    # until recover is acknowledged (NewReno)
+    dup_acks = 0
+    recover = 0
+    # Go-back-N after a timeout: the packets from resend_seq_num up to
+    # resend_end are resent as the congestion window opens again
+    resend_seq_num = resend_end = 0
+    debug = log.isEnabledFor(logging.DEBUG)
     
-    print(f"Sending {n_packets} packets")
+    def fast_retransmit(seq_num):
+        packet, _, _ = packets[seq_num]
+        batch.append((packet, (receiver_ip, receiver_port)))
+        packets[seq_num] = (packet, time.time(), True)
+        if debug:
+            log.debug("Fast retransmit of packet %d", seq_num)
+        if trace is not None:
+            trace("fast_retransmit", seq_num, packet_size(packet))
     
-    while start <= n_packets:
+    while True:
         
-        while next_seq_num < start + window_size and next_seq_num <= n_packets:
-            # chunks start from 0
-            chunk = chunks[next_seq_num-1]
-            header = PacketHeader(
-                type=2, # Data type
-                seq_num=next_seq_num,
-                length=len(chunk),
-                checksum=0
-            )
-            # Compute checksum like tutorial
-            header.checksum = compute_checksum(bytes(header) + chunk)
-            packet = bytes(header) + chunk
+        input_pending = False
+        # Resend what the window has room for, ACKs clock out the rest
+        resend_seq_num = max(resend_seq_num, start)
+        now = time.time()
+        while resend_seq_num < min(resend_end, start + cc.window):
+            if resend_seq_num in packets:
+                packet, _, _ = packets[resend_seq_num]
+                batch.append((packet, (receiver_ip, receiver_port)))
+                packets[resend_seq_num] = (packet, now, True)
+                if trace is not None:
+                    trace("retransmit", resend_seq_num, packet_size(packet))
+            resend_seq_num += 1
+        while not eof and next_seq_num < start + cc.window:
+            packet = source.packet(next_seq_num)
+            if packet is None:
+                eof = True
+                break
+            if packet is INPUT_PENDING:
+                input_pending = True
+                break
 
-            print(f"Sending packet {next_seq_num} with {header.checksum}")
+            if debug:
+                log.debug("Sending packet %d", next_seq_num)
+            if trace is not None:
+                trace("send", next_seq_num, packet_size(packet))
             
-            s.sendto(bytes(packet), (receiver_ip, receiver_port))
+            batch.append((packet, (receiver_ip, receiver_port)))
             
-            # Store packet in order to resend if necessary, get time.time() to 
-            # have different values for each packet
-            packets[next_seq_num] = (packet, time.time())
+            # Store packet in order to resend if necessary, with its send
+            # time and whether it has been retransmitted (Karn's rule)
+            packets[next_seq_num] = (packet, time.time(), False)
             next_seq_num += 1
+        batch_io.send_batch(batch)
+        batch.clear()
+        
+        # Every packet up to EOF is acknowledged
+        if eof and start == next_seq_num:
+            break
             
-        # Wait for ACKs
+        # Wait for ACKs until the oldest unacked packet times out
+        if start < next_seq_num:
+            _, base_sent_time, _ = packets[start]
+            deadline = max(base_sent_time, timer_start) + rtt.rto
+            timeout = max(deadline - time.time(), 0.001)
+        else:
+            # Nothing in flight, only input of a paused stream to wait for
+            deadline = timeout = None
+        # Also wake up for the input of a paused stream, before the timeout
+        if (input_pending and not wait_input(s, source.fileno, timeout)
+                and (deadline is None or time.time() < deadline)):
+            continue
+        s.settimeout(timeout)
         try:
-            print(f"Waiting for ACKs at {next_seq_num}")
-            ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            if debug:
+                log.debug("Waiting for ACKs at %d", next_seq_num)
+            acks = batch_io.recv_batch()
+        except socket.timeout:
+            # If timeout occurs, resend all packets in window, within
+            # the congestion window cut by the timeout
+            cc.on_timeout(next_seq_num)
+            rtt.on_timeout()
+            resend_seq_num, resend_end = start, next_seq_num
+            continue
+        for ack_data, _ in acks:
+            try:
+                ack_header = PacketHeader.unpack_from(ack_data)
+            except ValueError:
+                continue
             
-            if ack_header.type == 3 and verify_checksum(ack_header):
+            if ack_header.type == 3 and verify_packet(ack_data, ack_header, checksum):
+                if trace is not None:
+                    trace("cumulative_ack", ack_header.seq_num, len(ack_data))
                 # Move window
                 new_seq_num = ack_header.seq_num
-                if new_seq_num > start:
-                    # Remove all acknowledged packets
+                if start < new_seq_num <= next_seq_num:
+                    cc.on_ack(new_seq_num - start)
+                    # Remove all acknowledged packets. The newest gives an
+                    # RTT sample unless one of them was resent: the ACK
+                    # then waited for the copy (Karn's rule)
+                    sample = True
                     while start < new_seq_num:
                         if start in packets:
-                            del packets[start]
+                            packet, sent_time, retransmitted = packets.pop(start)
+                            sample = sample and not retransmitted
+                            source.release(packet)
                         start += 1
-        except (socket.timeout,ValueError):
-            # If timeout occurs, resend all packets in window
-            # next_seq_num = start
-            for seq in range(start, min(start + window_size, next_seq_num)):
-                if seq in packets:
-                    packet, _ = packets[seq]
-                    s.sendto(packet, (receiver_ip, receiver_port))
+                    if sample:
+                        rtt.sample(time.time() - sent_time)
+                    timer_start = time.time()
+                    dup_acks = 0
+                    if start < recover:
+                        # Partial ACK, the next hole is lost too
+                        fast_retransmit(start)
+                elif new_seq_num == start and start < next_seq_num:
+                    dup_acks += 1
+                    if dup_acks == reorder_threshold:
+                        recover = next_seq_num
+                        cc.on_loss(start, next_seq_num)
+                        fast_retransmit(start)
+    source.close()
+    s.settimeout(rtt.rto)
+    n_packets = next_seq_num - 1
+    log.info("Sent %d packets", n_packets)
         
     # END handshake
     end_seq_num = n_packets + 1
@@ -119,22 +227,27 @@ def sender(receiver_ip, receiver_port, window_size):
         length=0,
         checksum=0
     )
-    end_header.checksum = compute_checksum(end_header)
+    end_header.checksum = compute_checksum(end_header, checksum)
     
     end_time = time.time() + 0.5
     while time.time() < end_time:
         s.sendto(bytes(end_header), (receiver_ip, receiver_port))
         try:
-            print("Waiting for END ACK")
+            log.debug("Waiting for END ACK")
             ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            ack_header = PacketHeader.unpack_from(ack_data)
             if (ack_header.type == 3 
                 and ack_header.seq_num == end_seq_num  + 1
-                and verify_checksum(ack_header)):
-                print("Connection closed")
+                and verify_packet(ack_data, ack_header, checksum)):
+                log.info("Connection closed")
                 break
-        except (socket.timeout, ValueError):
+        except socket.timeout:
+            rtt.on_timeout()
+            s.settimeout(rtt.rto)
+        except ValueError:
             continue
+    if trace is not None:
+        trace.close()
     
     # pkt_header = PacketHeader(type=2, seq_num=10, length=14)
     # pkt_header.checksum = compute_checksum(pkt_header / "Hello, world!\n")
@@ -153,9 +266,45 @@ def main():
     parser.add_argument(
         "window_size", type=int, help="Maximum number of outstanding packets"
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Datagrams per sendmmsg/recvmmsg call (1 disables batching)"
+    )
+    parser.add_argument(
+        "--file", dest="file_path",
+        help="Send this regular file through mmap instead of reading stdin"
+    )
+    parser.add_argument(
+        "--cc", choices=sorted(CONGESTION_CONTROLS), default="none",
+        help="Congestion control, none (the default) keeps a fixed window of window_size"
+    )
+    parser.add_argument(
+        "--cc-trace", action="store_true",
+        help="Print the congestion control state on every loss and timeout"
+    )
+    parser.add_argument(
+        "--reorder-threshold", type=int, default=3,
+        help="Duplicate ACKs that trigger a fast retransmit of the window base"
+    )
+    parser.add_argument(
+        "--checksum", choices=sorted(CHECKSUMS), default="crc32",
+        help="Checksum to offer in the START handshake (crc32 if the receiver declines)"
+    )
+    parser.add_argument(
+        "--trace", dest="trace_path",
+        help="Record a binary packet trace to this file (see trace_analyze.py)"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+        help="DEBUG logs every packet, which slows the transfer down"
+    )
     args = parser.parse_args()
+    # On stderr, stdout is left alone
+    logging.basicConfig(level=args.log_level, format="%(message)s")
 
-    sender(args.receiver_ip, args.receiver_port, args.window_size)
+    sender(args.receiver_ip, args.receiver_port, args.window_size, args.batch_size,
+           args.file_path, args.cc, args.cc_trace, args.reorder_threshold, args.checksum,
+           args.trace_path)
 
 
 if __name__ == "__main__":
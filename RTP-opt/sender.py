@@ -1,107 +1,248 @@
 import argparse
+import logging
 import socket
 import sys
 import time
 
-from utils import PacketHeader, compute_checksum
+from utils import (CHECKSUMS, CONGESTION_CONTROLS, INPUT_PENDING, BatchIO, InFlight,
+                   MappedFilePackets, PacketHeader, Pacer, RetransmitTimers, RTTEstimator,
+                   StreamPackets, TraceWriter, agreed_checksum, checksum_offer,
+                   compute_checksum, decode_sack, packet_size, verify_batch, verify_packet,
+                   wait_input)
+
+# Connection events at INFO, every packet at DEBUG
+log = logging.getLogger(__name__)
 
 chunk_size = 1472 - 16 # 1472 is the maximum size of a packet
 buffer_size = 2048
 
-def verify_checksum(header):
-    """Verify packet checksum"""
-    saved_checksum = header.checksum
-    header.checksum = 0
-    return compute_checksum(header) == saved_checksum
-
-def sender(receiver_ip, receiver_port, window_size):
+def sender(receiver_ip, receiver_port, window_size, batch_size=1, file_path=None,
+           congestion="none", cc_trace=False, pacing=False, reorder_threshold=3,
+           checksum="crc32", trace_path=None):
     """
     
     """
     """TODO: Open socket and send message from sys.stdin."""
     # Create a UDP socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(0.5)
+    # Adaptive retransmission timeout of this connection
+    rtt = RTTEstimator()
+    # Congestion window, capped by the receiver window (window_size)
+    cc = CONGESTION_CONTROLS[congestion](window_size)
+    if cc_trace:
+        cc.trace = lambda event, state: print(f"cc {event}: {state}", file=sys.stderr)
+    # Optional binary packet trace, see trace_analyze.py
+    trace = TraceWriter(trace_path) if trace_path is not None else None
+    s.settimeout(rtt.rto)
+    # sendmmsg/recvmmsg batching of data packets and ACKs (Linux)
+    batch_io = BatchIO(s, batch_size, buffer_size)
     
-    # Handshake with START packet
+    # Handshake with START packet, offering the checksum of the connection
+    offered = CHECKSUMS[checksum]
+    offer = checksum_offer(offered)
     start_header = PacketHeader(
         type=0,
         seq_num=0,
-        length=0,
+        length=len(offer),
         checksum=0
     )
-    start_header.checksum = compute_checksum(bytes(start_header) + b'')
+    start_header.checksum = compute_checksum(bytes(start_header) + offer)
     
     # Send START until ACK is received
+    attempts = 0
     while True:
-        print("Sending START")
-        s.sendto(bytes(start_header), (receiver_ip, receiver_port))
+        log.debug("Sending START")
+        s.sendto(bytes(start_header) + offer, (receiver_ip, receiver_port))
+        sent_time = time.time()
+        attempts += 1
         try:
-            print("Waiting for ACK at start")
+            log.debug("Waiting for ACK at start")
             ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            ack_header = PacketHeader.unpack_from(ack_data)
             if(ack_header.type == 3 and #ACK type
                 ack_header.seq_num == 1):
-                    if(verify_checksum(ack_header)):
+                    if(verify_packet(ack_data, ack_header)):
+                        # Karn's rule: the RTT of a resent START is ambiguous
+                        if attempts == 1:
+                            rtt.sample(time.time() - sent_time)
+                        # crc32 unless the receiver took the offer
+                        checksum = agreed_checksum(ack_data, ack_header, offered)
                         break
                     else:
-                        print("Invalid checksum for start ACK")
-        except (socket.timeout, ValueError):
-            print("Timeout when waiting for ACK")
+                        log.info("Invalid checksum for start ACK")
+        except socket.timeout:
+            log.info("Timeout when waiting for ACK")
+            rtt.on_timeout()
+            s.settimeout(rtt.rto)
+        except ValueError:
             continue
     
-    print("Connection established")
-    # Data transmission
-    data = sys.stdin.buffer.read()
-    chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
-    n_packets = len(chunks)
+    log.info("Connection established, checksum %s", checksum.name)
+    # Data transmission: chunks are read from stdin only when the window
+    # has room, so transmission starts before EOF. A regular file given
+    # with --file is memory-mapped and sent as slices of the mapping.
+    if file_path is not None:
+        source = MappedFilePackets(file_path, chunk_size, checksum)
+    else:
+        source = StreamPackets(sys.stdin.buffer, chunk_size, window_size, checksum)
+    eof = False
     
-    # Create a packet dictionary to store all packets
-    packet_dict = {}
-    for i in range(n_packets):
-        seq_num = i + 1
-        chunk = chunks[i]
-        header = PacketHeader(
-            type=2, # Data type
-            seq_num=seq_num,
-            length=len(chunk),
-            checksum=0
-        )
-        header.checksum = compute_checksum(bytes(header) + chunk)
-        packet_dict[seq_num] = bytes(header) + chunk
+    # Packets in flight, in slots recycled once the window moves past them
+    in_flight = InFlight(window_size)
     
     # Sliding window mechanism implementation
     start = 1 # First data packet seq_num
-    
-    print(f"Sending {n_packets} packets")
-    
-    received = set()
-    while start <= n_packets:
-        end = start + window_size
-        if end > n_packets:
-            end = n_packets
-        for seq_num in range(start, end + 1):
-            if seq_num not in received:
-                s.sendto(packet_dict[seq_num], (receiver_ip, receiver_port))
-                print(f"Sending packet {seq_num} with {start}")
-        # Wait for ACKs
+    next_seq_num = 1
+    # Each outstanding packet has its own retransmission deadline
+    timers = RetransmitTimers()
+    # Fast retransmit: a packet is lost once reorder_threshold packets
+    # sent after it are acknowledged, it is resent without waiting for its RTO
+    highest_acked = 0
+    fast_scanned = 1 # seq_nums below were already checked for fast retransmit
+    batch = [] # Datagrams queued for one batched send
+    last_progress = time.time() # Last time an ACK acknowledged new data
+    backoff_until = 0.0 # Timers expiring until then are the same timeout
+    # Optional pacing of new packets over the RTT instead of window bursts
+    pacer = Pacer() if pacing else None
+    debug = log.isEnabledFor(logging.DEBUG)
+    while True:
+        if pacer is not None:
+            pacer.set_rate(cc.cwnd, rtt.srtt, cc.cwnd < cc.ssthresh)
+        # Send new packets that fit in the window
+        input_pending = False
+        while not eof and next_seq_num < start + cc.window:
+            if pacer is not None and not pacer.ready(time.time()):
+                break
+            packet = source.packet(next_seq_num)
+            if packet is None:
+                eof = True
+                break
+            if packet is INPUT_PENDING:
+                input_pending = True
+                break
+            batch.append((packet, (receiver_ip, receiver_port)))
+            if debug:
+                log.debug("Sending packet %d with %d", next_seq_num, start)
+            if trace is not None:
+                trace("send", next_seq_num, packet_size(packet))
+            now = time.time()
+            in_flight.add(next_seq_num, packet, now)
+            timers.arm(next_seq_num, now + rtt.rto)
+            if pacer is not None:
+                pacer.sent_packet(now)
+            next_seq_num += 1
+        
+        # Every packet up to EOF is acknowledged
+        if eof and start == next_seq_num:
+            break
+        
+        # Only resend packets whose own timer expired
+        now = time.time()
+        expired = timers.expired(now)
+        if expired:
+            # Loss while ACKs still arrive, timeout when nothing was
+            # acknowledged for a whole RTO
+            if now - last_progress >= rtt.rto:
+                cc.on_timeout(next_seq_num)
+            else:
+                cc.on_loss(expired[0], next_seq_num)
+            # Timers expiring together are one timeout, back off once per RTO
+            if now >= backoff_until:
+                rtt.on_timeout()
+                backoff_until = now + rtt.rto
+        for seq_num in expired:
+            packet = in_flight.resend(seq_num)
+            batch.append((packet, (receiver_ip, receiver_port)))
+            if debug:
+                log.debug("Resending packet %d with %d", seq_num, start)
+            if trace is not None:
+                trace("retransmit", seq_num, packet_size(packet))
+            timers.arm(seq_num, now + rtt.rto)
+        batch_io.send_batch(batch)
+        batch.clear()
+        
+        # Wait for ACKs until the earliest deadline, or the next paced packet
+        deadline = timers.next_deadline()
+        paced = (pacer is not None and not eof and next_seq_num < start + cc.window
+                 and (deadline is None or pacer.next_release() < deadline))
+        if paced:
+            deadline = pacer.next_release()
+        # None: nothing in flight, only input of a paused stream to wait for
+        timeout = max(deadline - time.time(), 0.001) if deadline is not None else None
+        if paced and deadline - time.time() < 0.001:
+            # Too short to block on: sleep/spin, then only poll for ACKs
+            pacer.wait(deadline)
+            timeout = 0.0
+        # Also wake up for the input of a paused stream
+        if input_pending and not wait_input(s, source.fileno, timeout):
+            continue
+        s.settimeout(timeout)
         try:
-            ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            acks = batch_io.recv_batch()
+        except (socket.timeout, BlockingIOError):
+            # Expired packets are resent at the top of the loop
+            continue
+        # Checksums of the whole batch verified in one pass
+        for ack_data, ack_header, _ in verify_batch(acks, checksum):
+            if ack_header.type != 3:
+                continue
+            received_seq_num = ack_header.seq_num
+            try:
+                if ack_header.length:
+                    # SACK: everything below the cumulative base plus the
+                    # received blocks, in one update
+                    ranges = decode_sack(ack_data, ack_header.length)
+                else:
+                    ranges = ((received_seq_num, received_seq_num + 1),)
+            except ValueError:
+                continue
             
-            if ack_header.type == 3 and verify_checksum(ack_header):
-                # Move window
-                print(f"Received ACK for packet {ack_header.seq_num}")
-                received_seq_num = ack_header.seq_num
-                
-                if start <= received_seq_num:
-                    received.add(received_seq_num)
-                    # Remove all acknowledged packets
-                    while start in received:
-                        start += 1
-        except (socket.timeout,ValueError):
-            # retransmit packets
-            pass
+            # Move window
+            if debug:
+                log.debug("Received ACK for packet %d", received_seq_num)
+            if trace is not None:
+                trace("ack", received_seq_num, len(ack_data))
+            acked = 0
+            for begin, end in ranges:
+                for seq_num in range(max(begin, start), min(end, next_seq_num)):
+                    sent_time = in_flight.ack(seq_num)
+                    if sent_time is False:
+                        continue
+                    acked += 1
+                    timers.cancel(seq_num)
+                    highest_acked = max(highest_acked, seq_num)
+                    # Only the packet that triggered the ACK gives an RTT sample
+                    if sent_time is not None and seq_num == received_seq_num:
+                        rtt.sample(time.time() - sent_time)
+            if acked:
+                cc.on_ack(acked)
+                last_progress = time.time()
+            # Recycle the slots of all acknowledged packets at the window base
+            start = in_flight.advance(start, source.release)
+        
+        # Fast retransmit of the holes with enough later packets acknowledged,
+        # once each; if the copy is lost too the timer resends it. Each
+        # seq_num is checked once, from where the last pass stopped
+        now = time.time()
+        fast_end = highest_acked - reorder_threshold + 1
+        for seq_num in range(max(fast_scanned, start), fast_end):
+            if not in_flight.mark_fast_retransmit(seq_num):
+                continue
+            cc.on_loss(seq_num, next_seq_num)
+            packet = in_flight.resend(seq_num)
+            batch.append((packet, (receiver_ip, receiver_port)))
+            if debug:
+                log.debug("Fast retransmit of packet %d with %d", seq_num, start)
+            if trace is not None:
+                trace("fast_retransmit", seq_num, packet_size(packet))
+            timers.arm(seq_num, now + rtt.rto)
+        fast_scanned = max(fast_scanned, fast_end)
+    source.close()
+    s.settimeout(rtt.rto)
+    n_packets = next_seq_num - 1
+    log.info("Sent %d packets", n_packets)
+    if pacer is not None:
+        log.info("Pacing: %s", pacer.report())
         
     # END handshake
     end_seq_num = n_packets + 1
@@ -111,23 +252,28 @@ def sender(receiver_ip, receiver_port, window_size):
         length=0,
         checksum=0
     )
-    end_header.checksum = compute_checksum(end_header)
+    end_header.checksum = compute_checksum(end_header, checksum)
     
     
     end_time = time.time() + 0.5
     while time.time() < end_time:
         s.sendto(bytes(end_header), (receiver_ip, receiver_port))
         try:
-            print("Waiting for END ACK")
+            log.debug("Waiting for END ACK")
             ack_data, _ = s.recvfrom(buffer_size)
-            ack_header = PacketHeader(ack_data[:16])
+            ack_header = PacketHeader.unpack_from(ack_data)
             if (ack_header.type == 3 
                 and ack_header.seq_num == end_seq_num  + 1
-                and verify_checksum(ack_header)):
-                print("Connection closed")
+                and verify_packet(ack_data, ack_header, checksum)):
+                log.info("Connection closed")
                 break
-        except (socket.timeout, ValueError):
+        except socket.timeout:
+            rtt.on_timeout()
+            s.settimeout(rtt.rto)
+        except ValueError:
             pass
+    if trace is not None:
+        trace.close()
 
 
 def main():
@@ -141,9 +287,49 @@ def main():
     parser.add_argument(
         "window_size", type=int, help="Maximum number of outstanding packets"
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Datagrams per sendmmsg/recvmmsg call (1 disables batching)"
+    )
+    parser.add_argument(
+        "--file", dest="file_path",
+        help="Send this regular file through mmap instead of reading stdin"
+    )
+    parser.add_argument(
+        "--cc", choices=sorted(CONGESTION_CONTROLS), default="none",
+        help="Congestion control, none (the default) keeps a fixed window of window_size"
+    )
+    parser.add_argument(
+        "--cc-trace", action="store_true",
+        help="Print the congestion control state on every loss and timeout"
+    )
+    parser.add_argument(
+        "--pacing", action="store_true",
+        help="Pace new packets at cwnd/SRTT instead of sending window bursts"
+    )
+    parser.add_argument(
+        "--reorder-threshold", type=int, default=3,
+        help="Resend a packet once this many later packets are acknowledged"
+    )
+    parser.add_argument(
+        "--checksum", choices=sorted(CHECKSUMS), default="crc32",
+        help="Checksum to offer in the START handshake (crc32 if the receiver declines)"
+    )
+    parser.add_argument(
+        "--trace", dest="trace_path",
+        help="Record a binary packet trace to this file (see trace_analyze.py)"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+        help="DEBUG logs every packet, which slows the transfer down"
+    )
     args = parser.parse_args()
+    # On stderr, stdout is left alone
+    logging.basicConfig(level=args.log_level, format="%(message)s")
 
-    sender(args.receiver_ip, args.receiver_port, args.window_size)
+    sender(args.receiver_ip, args.receiver_port, args.window_size, args.batch_size,
+           args.file_path, args.cc, args.cc_trace, args.pacing, args.reorder_threshold,
+           args.checksum, args.trace_path)
 
 
 if __name__ == "__main__":
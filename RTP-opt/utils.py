@@ -1,27 +1,1238 @@
 import binascii
+import collections
+import ctypes
+import errno
+import heapq
+import io
+import mmap
+import os
+import select
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
+import zlib
 
-from scapy.all import Packet, IntField
+try:
+    # Optional: hardware-accelerated CRC-32C (pip install crc32c)
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
 
+# Precompiled codec for the 4 unsigned 32-bit header fields (network order)
+HEADER_STRUCT = struct.Struct("!IIII")
+HEADER_SIZE = HEADER_STRUCT.size
 
-class PacketHeader(Packet):
+
+class PacketHeader:
     """
     Packet header class.
     16 bytes for 4 integers fields.
     """
+    __slots__ = ("type", "seq_num", "length", "checksum")
     name = "PacketHeader"
-    fields_desc = [
-        IntField("type", 0),
-        IntField("seq_num", 0),
-        IntField("length", 0),
-        IntField("checksum", 0),
-    ]
 
+    def __init__(self, data=None, type=0, seq_num=0, length=0, checksum=0):
+        if data is not None:
+            # Parse from raw bytes, like scapy's PacketHeader(pkt[:16])
+            if len(data) < HEADER_SIZE:
+                raise ValueError("Packet header needs 16 bytes")
+            type, seq_num, length, checksum = HEADER_STRUCT.unpack_from(data)
+        self.type = type
+        self.seq_num = seq_num
+        self.length = length
+        self.checksum = checksum
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Parse a header straight from a buffer without slicing it."""
+        if len(buffer) - offset < HEADER_SIZE:
+            raise ValueError("Packet header needs 16 bytes")
+        return cls(None, *HEADER_STRUCT.unpack_from(buffer, offset))
+
+    def pack_into(self, buffer, offset=0):
+        """Write the header in place at buffer[offset:offset+16]."""
+        HEADER_STRUCT.pack_into(
+            buffer, offset, self.type, self.seq_num, self.length, self.checksum
+        )
+
+    def __bytes__(self):
+        return HEADER_STRUCT.pack(self.type, self.seq_num, self.length, self.checksum)
+
+    def __len__(self):
+        return HEADER_SIZE
+
+    def __repr__(self):
+        return (
+            f"<PacketHeader type={self.type} seq_num={self.seq_num} "
+            f"length={self.length} checksum={self.checksum}>"
+        )
+
+
+class Checksum:
+    """
+    A 32-bit checksum algorithm. update(data, value) continues a running
+    value over more data, so a packet is checksummed part by part
+    (header, payload) without concatenating them.
+    """
+
+    def __init__(self, name, id, update, initial=0):
+        self.name = name
+        self.id = id  # Sent in the START handshake
+        self.update = update
+        self.initial = initial
+
+    def __repr__(self):
+        return f"<Checksum {self.name}>"
+
+
+CRC32 = Checksum("crc32", 0, binascii.crc32)
+ADLER32 = Checksum("adler32", 1, zlib.adler32, 1)
+# Checksums available here by name. START packets and their ACKs always
+# use crc32, every other packet the algorithm agreed on in the handshake.
+CHECKSUMS = {checksum.name: checksum for checksum in (CRC32, ADLER32)}
+if _crc32c is not None:
+    CHECKSUMS["crc32c"] = Checksum("crc32c", 2, _crc32c.crc32c)
+_CHECKSUMS_BY_ID = {checksum.id: checksum for checksum in CHECKSUMS.values()}
 
-def compute_checksum(pkt):
+
+def compute_checksum(pkt, checksum=CRC32):
     '''
     Compute the checksum of the packet (ensure it always is a 32-bit
     unsigned integer).
-    
+
     Used to detect errors in transmitted packets.
     '''
-    return binascii.crc32(bytes(pkt)) & 0xFFFFFFFF
\ No newline at end of file
+    if not isinstance(pkt, (bytes, bytearray, memoryview)):
+        pkt = bytes(pkt)
+    return checksum.update(pkt, checksum.initial) & 0xFFFFFFFF
+
+
+_CHECKSUM_STRUCT = struct.Struct("!I")
+_CHECKSUM_OFFSET = 12
+
+
+def build_packet(buffer, type, seq_num, length, checksum=CRC32):
+    """
+    Pack the header and checksum in place in front of a payload that is
+    already at buffer[16:16+length]. Returns a memoryview of the packet.
+    """
+    HEADER_STRUCT.pack_into(buffer, 0, type, seq_num, length, 0)
+    packet = memoryview(buffer)[:HEADER_SIZE + length]
+    _CHECKSUM_STRUCT.pack_into(buffer, _CHECKSUM_OFFSET,
+                               checksum.update(packet, checksum.initial) & 0xFFFFFFFF)
+    return packet
+
+
+_ZERO_CHECKSUM = bytes(_CHECKSUM_STRUCT.size)
+
+
+def verify_packet(packet, header, checksum=CRC32):
+    """
+    Check the checksum of a received packet without copying it: the crc is
+    chained over the header with a zeroed checksum field and the payload.
+    """
+    if header.type == 0:
+        checksum = CRC32
+    update = checksum.update
+    packet = memoryview(packet)
+    crc = update(packet[:_CHECKSUM_OFFSET], checksum.initial)
+    crc = update(_ZERO_CHECKSUM, crc)
+    crc = update(packet[HEADER_SIZE:HEADER_SIZE + header.length], crc)
+    return crc & 0xFFFFFFFF == header.checksum
+
+
+def verify_batch(batch, checksum=CRC32):
+    """
+    (packet, header, address) of the valid packets of a received batch,
+    e.g. from BatchIO.recv_batch(); malformed and corrupted packets are
+    dropped. One pass with the per-packet lookups hoisted out of the loop.
+    """
+    unpack_from = HEADER_STRUCT.unpack_from
+    update = checksum.update
+    initial = checksum.initial
+    crc32 = binascii.crc32
+    zero = _ZERO_CHECKSUM
+    valid = []
+    for packet, address in batch:
+        if len(packet) < HEADER_SIZE:
+            continue
+        type, seq_num, length, expected = unpack_from(packet)
+        packet = memoryview(packet)
+        if type == 0:
+            # START packets always use crc32
+            crc = crc32(packet[:_CHECKSUM_OFFSET])
+            crc = crc32(packet[HEADER_SIZE:HEADER_SIZE + length], crc32(zero, crc))
+        else:
+            crc = update(packet[:_CHECKSUM_OFFSET], initial)
+            crc = update(packet[HEADER_SIZE:HEADER_SIZE + length], update(zero, crc))
+        if crc & 0xFFFFFFFF == expected:
+            valid.append((packet, PacketHeader(None, type, seq_num, length, expected), address))
+    return valid
+
+
+# Checksum negotiation: a sender offers an algorithm by its id in the
+# payload of its START; a receiver that supports it echoes the id in the
+# START ACK. A START or START ACK without payload means crc32, so peers
+# that know nothing of it interoperate.
+CHECKSUM_ID = struct.Struct("!I")
+
+
+def checksum_offer(checksum):
+    """START payload offering checksum."""
+    return b"" if checksum is CRC32 else CHECKSUM_ID.pack(checksum.id)
+
+
+def accept_checksum(packet, header):
+    """Receiver: algorithm of a START, crc32 unless it offers one known here."""
+    if header.length != CHECKSUM_ID.size:
+        return CRC32
+    checksum_id, = CHECKSUM_ID.unpack_from(packet, HEADER_SIZE)
+    return _CHECKSUMS_BY_ID.get(checksum_id, CRC32)
+
+
+def agreed_checksum(packet, header, offered):
+    """Sender: algorithm of the connection, given the START ACK."""
+    if (header.length == CHECKSUM_ID.size
+            and CHECKSUM_ID.unpack_from(packet, HEADER_SIZE)[0] == offered.id):
+        return offered
+    return CRC32
+
+
+# Selective ACK: an ACK (type 3) whose payload is the cumulative base
+# (every seq_num below it is received) followed by [begin, end) blocks of
+# received seq_nums above it. seq_num still names the packet that
+# triggered the ACK, so plain ACK semantics are kept.
+SACK_BASE = struct.Struct("!I")
+SACK_BLOCK = struct.Struct("!II")
+MAX_SACK_BLOCKS = 64
+
+
+def encode_sack(base, seq_nums):
+    """SACK payload for a cumulative base and the received seq_nums above it."""
+    blocks = []
+    for seq_num in sorted(seq_nums):
+        if blocks and blocks[-1][1] == seq_num:
+            blocks[-1][1] += 1
+        elif len(blocks) < MAX_SACK_BLOCKS:
+            blocks.append([seq_num, seq_num + 1])
+        else:
+            # Lowest blocks first, they describe the holes at the window base
+            break
+    return SACK_BASE.pack(base) + b"".join(SACK_BLOCK.pack(*block) for block in blocks)
+
+
+def decode_sack(packet, length):
+    """
+    [begin, end) ranges of seq_nums acknowledged by the SACK payload of
+    packet. Raises ValueError on a malformed payload.
+    """
+    if length < SACK_BASE.size or (length - SACK_BASE.size) % SACK_BLOCK.size:
+        raise ValueError("Invalid SACK length")
+    payload = memoryview(packet)[HEADER_SIZE:HEADER_SIZE + length]
+    ranges = [(0, SACK_BASE.unpack_from(payload)[0])]
+    ranges.extend(SACK_BLOCK.iter_unpack(payload[SACK_BASE.size:]))
+    return ranges
+
+
+# Persistent sessions (rtp_socket.RTPConnection) carry messages in both
+# directions in SESSION DATA packets (type 4). Their payload starts with
+# the cumulative ACK of the other direction (every seq_num below it is
+# received) and flags; END_OF_MESSAGE marks the last packet of a message.
+SESSION_HEADER = struct.Struct("!IB")
+END_OF_MESSAGE = 0x1
+
+
+class PacketPool:
+    """
+    Free list of preallocated packet buffers, so the hot loop reuses
+    bytearrays instead of allocating a new packet for every send.
+    """
+
+    def __init__(self, buffer_size, count=0):
+        self.buffer_size = buffer_size
+        self.free = [bytearray(buffer_size) for _ in range(count)]
+
+    def acquire(self):
+        return self.free.pop() if self.free else bytearray(self.buffer_size)
+
+    def release(self, buffer):
+        self.free.append(buffer)
+
+
+# packet() of a stream with no input available yet, see StreamPackets
+INPUT_PENDING = object()
+
+
+class StreamPackets:
+    """
+    DATA packets read on demand from a binary stream (e.g. stdin), each
+    payload read with readinto() straight into a pooled packet buffer.
+
+    A pipe or terminal may pause: it is read straight from its descriptor,
+    what is there becomes a short packet and packet() returns
+    INPUT_PENDING instead of blocking when nothing is. `fileno` is then
+    the descriptor to wait on along with the socket (see wait_input()),
+    None for streams that never stall, like regular files.
+    """
+
+    def __init__(self, stream, chunk_size, count=0, checksum=CRC32):
+        self.readinto = stream.readinto
+        self.fileno = None
+        try:
+            fileno = stream.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+        else:
+            if not stat.S_ISREG(os.fstat(fileno).st_mode):
+                self.fileno = fileno
+                self.poll = select.poll()
+                self.poll.register(fileno, select.POLLIN)
+        self.pool = PacketPool(HEADER_SIZE + chunk_size, count)
+        self.checksum = checksum
+
+    def packet(self, seq_num):
+        """
+        Next packet, None at EOF or INPUT_PENDING. Must be asked for in
+        seq_num order.
+        """
+        if self.fileno is not None and not self.poll.poll(0):
+            return INPUT_PENDING
+        buffer = self.pool.acquire()
+        payload = memoryview(buffer)[HEADER_SIZE:]
+        if self.fileno is None:
+            length = self.readinto(payload)
+        else:
+            # Readable, so one read does not block (0 at EOF)
+            length = os.readv(self.fileno, [payload])
+        if not length:
+            self.pool.release(buffer)
+            return None
+        return build_packet(buffer, 2, seq_num, length, self.checksum) # Data type
+
+    def release(self, packet):
+        """Give the buffer of an acknowledged packet back to the pool."""
+        self.pool.release(packet.obj)
+
+    def close(self):
+        pass
+
+
+def wait_input(sock, fileno, timeout):
+    """
+    Wait up to timeout for a datagram on sock or input on fileno, True if
+    a datagram is there.
+    """
+    return sock in select.select([sock, fileno], [], [], timeout)[0]
+
+
+class MappedFilePackets:
+    """
+    DATA packets sliced from an mmap of a regular file.
+
+    A packet is a (header, payload) pair for a scatter/gather send, the
+    payload being a memoryview of the mapping: the file is never copied
+    into user space and retransmissions read it again from the page
+    cache. Opening does not read the file, so startup time does not
+    depend on its size.
+    """
+
+    def __init__(self, path, chunk_size, checksum=CRC32):
+        self.chunk_size = chunk_size
+        self.checksum = checksum
+        with open(path, "rb") as f:
+            # An empty file cannot be mapped
+            if os.fstat(f.fileno()).st_size:
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mapping = b""
+        self.view = memoryview(self.mapping)
+
+    def packet(self, seq_num):
+        """Packet seq_num (the first one is 1), or None past the end of file."""
+        offset = (seq_num - 1) * self.chunk_size
+        payload = self.view[offset:offset + self.chunk_size]
+        if not payload:
+            return None
+        header = bytearray(HEADER_SIZE)
+        HEADER_STRUCT.pack_into(header, 0, 2, seq_num, len(payload), 0) # Data type
+        update = self.checksum.update
+        checksum = update(payload, update(header, self.checksum.initial)) & 0xFFFFFFFF
+        _CHECKSUM_STRUCT.pack_into(header, _CHECKSUM_OFFSET, checksum)
+        return header, payload
+
+    def release(self, packet):
+        pass
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.mapping, mmap.mmap):
+            try:
+                self.mapping.close()
+            except BufferError:
+                # Slices still referenced somewhere, it is unmapped once
+                # they are garbage collected
+                pass
+
+
+def packet_size(packet):
+    """Bytes of a packet of a source, a buffer or a (header, payload) pair."""
+    return len(packet) if not isinstance(packet, tuple) else len(packet[0]) + len(packet[1])
+
+
+class ReorderBuffer:
+    """
+    Out-of-order payloads of a receive window, in a ring of preallocated
+    slots indexed by seq_num % window_size.
+
+    A presence map tells which slots hold a packet (one byte per slot:
+    cheaper to test in Python than bits, and bytearray.find() scans it in
+    C). Payloads are copied into the head of their fixed-size slot, whose
+    length is kept apart, so storing one allocates nothing, and drain()
+    delivers a run of packets as views of the slots in one call. Only
+    seq_nums inside the window (base, base + window_size) may be stored,
+    each then has a slot of its own.
+    """
+
+    def __init__(self, window_size, slot_size=2048 - HEADER_SIZE):
+        self.size = window_size
+        self.slots = [bytearray(slot_size) for _ in range(window_size)]
+        self.views = [memoryview(slot) for slot in self.slots]
+        self.lengths = [0] * window_size
+        self.present = bytearray(window_size)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def store(self, seq_num, payload):
+        """Copy payload into the slot of seq_num, False if already there."""
+        index = seq_num % self.size
+        if self.present[index]:
+            return False
+        n = len(payload)
+        # Slice assignment of the same length, the slot is never resized
+        self.slots[index][:n] = payload
+        self.lengths[index] = n
+        self.present[index] = 1
+        self.count += 1
+        return True
+
+    def drain(self, seq_num, write):
+        """Pass the stored run starting at seq_num to write(), in order.
+        Returns the seq_num after the run."""
+        present = self.present
+        views = self.views
+        lengths = self.lengths
+        size = self.size
+        index = seq_num % size
+        while present[index]:
+            write(views[index][:lengths[index]])
+            present[index] = 0
+            self.count -= 1
+            seq_num += 1
+            index = seq_num % size
+        return seq_num
+
+    def seq_nums(self, base):
+        """Stored seq_nums in increasing order, for a window starting at base."""
+        start = base % self.size
+        present = self.present
+        for begin, end in ((start, self.size), (0, start)):
+            index = present.find(1, begin, end)
+            while index != -1:
+                yield base + (index - start) % self.size
+                index = present.find(1, index + 1, end)
+
+
+class RetransmitTimers:
+    """
+    Per-packet retransmission deadlines kept in a min-heap.
+
+    Cancelled or re-armed entries stay in the heap and are skipped lazily
+    when they reach the top, so arm/cancel are O(log n)/O(1).
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def arm(self, seq_num, deadline):
+        """(Re)start the timer of seq_num."""
+        self.deadlines[seq_num] = deadline
+        heapq.heappush(self.heap, (deadline, seq_num))
+
+    def cancel(self, seq_num):
+        """Stop the timer of seq_num (e.g. it has been ACKed)."""
+        self.deadlines.pop(seq_num, None)
+
+    def _drop_stale(self):
+        heap = self.heap
+        while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_deadline(self):
+        """Earliest pending deadline, or None if no timer is running."""
+        self._drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def expired(self, now):
+        """Pop and return the seq_nums whose deadline has passed."""
+        result = []
+        heap = self.heap
+        while True:
+            self._drop_stale()
+            if not heap or heap[0][0] > now:
+                return result
+            _, seq_num = heapq.heappop(heap)
+            del self.deadlines[seq_num]
+            result.append(seq_num)
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+class InFlight:
+    """
+    Packets in flight of a sender, in a ring of window_size slots indexed
+    by seq_num % window_size and recycled as the window base advances.
+
+    A slot holds the packet, its send time (None once resent, Karn's
+    rule) and its retransmission count; acked and fast-retransmitted
+    flags are byte maps over the slots. Memory depends on the window, not
+    on the transfer size, and every update is O(1). The caller keeps
+    seq_nums in flight within one window (next_seq_num - start <=
+    window_size), so each has a slot of its own.
+    """
+
+    def __init__(self, window_size):
+        self.size = window_size
+        self.packets = [None] * window_size
+        self.send_times = [None] * window_size
+        self.retransmits = [0] * window_size
+        self.acked = bytearray(window_size)
+        self.fast_retransmitted = bytearray(window_size)
+
+    def add(self, seq_num, packet, now):
+        """Put a packet sent for the first time at now in its slot."""
+        index = seq_num % self.size
+        self.packets[index] = packet
+        self.send_times[index] = now
+        self.retransmits[index] = 0
+
+    def resend(self, seq_num):
+        """Return the packet of seq_num to send again."""
+        index = seq_num % self.size
+        # Its RTT is ambiguous from now on
+        self.send_times[index] = None
+        self.retransmits[index] += 1
+        return self.packets[index]
+
+    def ack(self, seq_num):
+        """
+        Mark seq_num acknowledged. Returns False if it already was,
+        otherwise its send time (None if it was resent).
+        """
+        index = seq_num % self.size
+        if self.acked[index]:
+            return False
+        self.acked[index] = 1
+        return self.send_times[index]
+
+    def is_acked(self, seq_num):
+        return self.acked[seq_num % self.size]
+
+    def mark_fast_retransmit(self, seq_num):
+        """True the first time an unacknowledged seq_num is fast retransmitted."""
+        index = seq_num % self.size
+        if self.acked[index] or self.fast_retransmitted[index]:
+            return False
+        self.fast_retransmitted[index] = 1
+        return True
+
+    def advance(self, start, release):
+        """Recycle the acknowledged slots at the window base, passing their
+        packets to release(). Returns the new window base."""
+        acked = self.acked
+        packets = self.packets
+        index = start % self.size
+        while acked[index]:
+            acked[index] = 0
+            self.fast_retransmitted[index] = 0
+            release(packets[index])
+            packets[index] = None
+            start += 1
+            index = start % self.size
+        return start
+
+
+class RTTEstimator:
+    """
+    Retransmission timeout (RTO) of one connection, estimated from RTT
+    samples with Jacobson/Karels smoothing (RFC 6298).
+
+    Callers follow Karn's rule: only packets that were sent exactly once
+    are sampled. Every timeout doubles the RTO until a new sample arrives.
+    """
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, initial_rto=0.5, min_rto=0.005, max_rto=4.0):
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = initial_rto
+        self.backoff = 1
+
+    @property
+    def rto(self):
+        """Current retransmission timeout in seconds (backoff included)."""
+        return min(self.base_rto * self.backoff, self.max_rto)
+
+    def sample(self, rtt):
+        """Feed the RTT (seconds) of a packet that was not retransmitted."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.base_rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+        self.backoff = 1
+
+    def on_timeout(self):
+        """Exponential backoff after a retransmission timeout."""
+        if self.base_rto * self.backoff < self.max_rto:
+            self.backoff *= 2
+
+
+class SocketStats:
+    """
+    Counters of one socket, cheap enough to always keep: plain attribute
+    increments, mostly once per batch.
+
+    high_water is the most packets held at once (in flight on a sender,
+    buffered out of order on a receiver). rtt_histogram[i] counts the RTT
+    samples of i bits in microseconds, i.e. in [2**(i-1), 2**i) us.
+    """
+    COUNTERS = ("packets_sent", "bytes_sent", "retransmits", "fast_retransmits",
+                "timeouts", "packets_received", "bytes_received", "acks_sent",
+                "acks_received", "checksum_failures", "out_of_window", "duplicates")
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.high_water = 0
+        self.rtt_histogram = [0] * 32
+
+    def record_rtt(self, rtt):
+        """Count an RTT sample (seconds)."""
+        self.rtt_histogram[min(int(rtt * 1e6).bit_length(), 31)] += 1
+
+    def rtt_percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding that fraction of the samples."""
+        total = sum(self.rtt_histogram)
+        if not total:
+            return None
+        seen = 0
+        for bits, count in enumerate(self.rtt_histogram):
+            seen += count
+            if seen >= fraction * total:
+                return (1 << bits) / 1e6
+
+    def report(self):
+        """Counters, high-water mark and RTT percentiles."""
+        report = {name: getattr(self, name) for name in self.COUNTERS}
+        report["high_water"] = self.high_water
+        for fraction in (0.5, 0.99):
+            report[f"rtt_p{round(fraction * 100)}"] = self.rtt_percentile(fraction)
+        return report
+
+
+class TraceRing:
+    """
+    Event trace hook keeping the last `capacity` events in memory, as
+    (time, event, seq_num, length) tuples. Set it as the trace of a
+    socket, any trace(event, seq_num, length) callable will do as well.
+    """
+
+    def __init__(self, capacity=4096):
+        self.events = collections.deque(maxlen=capacity)
+
+    def __call__(self, event, seq_num, length=0):
+        self.events.append((time.monotonic(), event, seq_num, length))
+
+
+# Binary packet trace: a TRACE_HEADER (magic, version, wall clock time of
+# the start) then one TRACE_RECORD per packet: seconds since the start,
+# direction, packet type, seq_num, datagram length and verdict.
+TRACE_MAGIC = b"RTPT"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sBd")
+TRACE_RECORD = struct.Struct("<dBBIHB")
+
+# Directions: of an endpoint, or through a proxy towards the receiver
+# (FORWARD) or the sender (BACKWARD)
+SENT, RECEIVED, FORWARD, BACKWARD = range(4)
+DIRECTIONS = ("sent", "received", "forward", "backward")
+# Verdicts. A proxy records one of OK, LOST, DELAYED, REORDERED or
+# CORRUPTED per packet it receives, then BURST_LOST, QUEUE_DROP and
+# DUPLICATED for what its link model does to it. A CUMULATIVE ACK
+# acknowledges every seq_num below its own (RTP-base), an OK one the
+# packet it names.
+(OK, RETRANSMIT, FAST_RETRANSMIT, CHECKSUM_FAILURE, OUT_OF_WINDOW, DUPLICATE, LOST,
+ QUEUE_DROP, DELAYED, REORDERED, CORRUPTED, DUPLICATED, BURST_LOST, CUMULATIVE) = range(14)
+VERDICTS = ("ok", "retransmit", "fast_retransmit", "checksum_failure", "out_of_window",
+            "duplicate", "lost", "queue_drop", "delayed", "reordered", "corrupted",
+            "duplicated", "burst_lost", "cumulative")
+# Record of each trace hook event of the sockets: direction, type, verdict
+TRACE_EVENTS = {
+    "send": (SENT, 2, OK),
+    "retransmit": (SENT, 2, RETRANSMIT),
+    "fast_retransmit": (SENT, 2, FAST_RETRANSMIT),
+    "ack": (RECEIVED, 3, OK),
+    "ack_sent": (SENT, 3, OK),
+    "cumulative_ack": (RECEIVED, 3, CUMULATIVE),
+    "cumulative_ack_sent": (SENT, 3, CUMULATIVE),
+    "data": (RECEIVED, 2, OK),
+    "duplicate": (RECEIVED, 2, DUPLICATE),
+    "out_of_window": (RECEIVED, 2, OUT_OF_WINDOW),
+    "checksum_failure": (RECEIVED, 255, CHECKSUM_FAILURE),  # Type unknown
+}
+
+
+class TraceWriter:
+    """
+    Records a binary packet trace to a file, cheap enough to leave on: the
+    caller only appends a tuple, a background thread packs and writes the
+    records every `interval` seconds.
+
+    It is a trace hook of the sockets (trace(event, seq_num, length)),
+    record() takes the fields directly. Call close() to write the rest.
+    """
+
+    def __init__(self, path, interval=0.2):
+        self.file = open(path, "wb")
+        self.start = time.monotonic()
+        self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time()))
+        self.records = collections.deque()
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, event, seq_num, length=0):
+        direction, type, verdict = TRACE_EVENTS[event]
+        self.records.append((time.monotonic(), direction, type, seq_num, length, verdict))
+
+    def record(self, direction, type, seq_num, length, verdict=OK):
+        self.records.append((time.monotonic(), direction, type, seq_num, length, verdict))
+
+    def _flush(self):
+        # deque appends and poplefts are atomic: the records appended while
+        # these are written stay for the next flush
+        popleft = self.records.popleft
+        records = [popleft() for _ in range(len(self.records))]
+        if records:
+            pack = TRACE_RECORD.pack
+            start = self.start
+            self.file.write(b"".join(
+                [pack(t - start, direction, type, seq_num & 0xFFFFFFFF,
+                      min(length, 0xFFFF), verdict)
+                 for t, direction, type, seq_num, length, verdict in records]))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._flush()
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self._flush()
+        self.file.close()
+
+
+def read_trace(path):
+    """Wall clock start time and the records of a trace file, as tuples."""
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, start = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError(f"{path} is not an RTP trace")
+    body = memoryview(data)[TRACE_HEADER.size:]
+    # A trace cut short (killed writer) ends with a partial record
+    body = body[:len(body) - len(body) % TRACE_RECORD.size]
+    return start, list(TRACE_RECORD.iter_unpack(body))
+
+
+class CongestionControl:
+    """
+    Congestion window of one connection, in packets.
+
+    The sender keeps at most `window` packets outstanding, that is
+    min(cwnd, receiver window). This base class is a fixed window of the
+    receiver window size; subclasses grow cwnd on ACKs and shrink it on
+    losses and timeouts. If `trace` is set it is called as
+    trace(event, state) on every loss and timeout.
+    """
+    name = "none"
+
+    def __init__(self, max_window, initial_cwnd=10):
+        self.max_window = max_window
+        self.cwnd = float(max_window)
+        self.ssthresh = float(max_window)
+        self.trace = None
+
+    @property
+    def window(self):
+        """Number of packets the sender may have outstanding."""
+        return max(1, int(min(self.cwnd, self.max_window)))
+
+    def on_ack(self, acked):
+        """acked packets were newly acknowledged."""
+
+    def on_loss(self, seq_num, next_seq_num):
+        """Packet seq_num was lost, next_seq_num is the next one to send."""
+
+    def on_timeout(self, next_seq_num):
+        """Nothing was acknowledged for a whole RTO."""
+
+    def state(self):
+        return {
+            "cc": self.name,
+            "cwnd": round(self.cwnd, 2),
+            "ssthresh": round(self.ssthresh, 2),
+            "window": self.window,
+        }
+
+    def _trace(self, event):
+        if self.trace is not None:
+            self.trace(event, self.state())
+
+
+class AIMD(CongestionControl):
+    """
+    Slow start then additive increase (one packet per window of ACKs),
+    multiplicative decrease on loss, back to one packet on timeout.
+    """
+    name = "aimd"
+    beta = 0.5
+
+    def __init__(self, max_window, initial_cwnd=10):
+        super().__init__(max_window)
+        self.cwnd = float(min(initial_cwnd, max_window))
+        # Losses of packets sent before the last reduction are the same
+        # congestion event and only reduce cwnd once
+        self.recover = 0
+
+    def on_ack(self, acked):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked # Slow start
+        else:
+            self._increase(acked)
+        # cwnd beyond the receiver window cannot be used
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self, seq_num, next_seq_num):
+        if seq_num < self.recover:
+            return
+        self.recover = next_seq_num
+        self._decrease()
+        self.cwnd = self.ssthresh
+        self._trace("loss")
+
+    def on_timeout(self, next_seq_num):
+        self.recover = next_seq_num
+        self._decrease()
+        self.cwnd = 1.0
+        self._trace("timeout")
+
+    def _increase(self, acked):
+        self.cwnd += acked / self.cwnd
+
+    def _decrease(self):
+        self.ssthresh = max(self.cwnd * self.beta, 2.0)
+
+
+class Cubic(AIMD):
+    """
+    CUBIC-like growth (RFC 8312): after a loss cwnd follows a cubic curve
+    of the time since the reduction, flat around the window where the
+    loss happened. It never grows slower than AIMD would.
+    """
+    name = "cubic"
+    beta = 0.7
+    C = 0.4
+
+    def __init__(self, max_window, initial_cwnd=10):
+        super().__init__(max_window, initial_cwnd)
+        self.w_max = 0.0
+        self.epoch_start = None
+
+    def _increase(self, acked):
+        now = time.time()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.k = (max(self.w_max - self.cwnd, 0.0) / self.C) ** (1 / 3)
+            self.origin = max(self.w_max, self.cwnd)
+            self.aimd_cwnd = self.cwnd
+        target = self.origin + self.C * (now - self.epoch_start - self.k) ** 3
+        # At most 1.5x per window of ACKs, like RFC 8312
+        target = min(target, 1.5 * self.cwnd)
+        self.aimd_cwnd += acked / self.aimd_cwnd
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * acked
+        self.cwnd = max(self.cwnd, self.aimd_cwnd)
+
+    def _decrease(self):
+        self.w_max = self.cwnd
+        self.epoch_start = None
+        super()._decrease()
+
+    def state(self):
+        state = super().state()
+        state["w_max"] = round(self.w_max, 2)
+        return state
+
+
+CONGESTION_CONTROLS = {
+    "none": CongestionControl,
+    "aimd": AIMD,
+    "cubic": Cubic,
+}
+
+
+class Pacer:
+    """
+    Pacing scheduler: new packets are released at gain * cwnd / SRTT
+    packets per second instead of a whole window back-to-back, through a
+    token bucket of `burst` packets. Sending is unpaced until the first
+    RTT sample.
+
+    Waits shorter than `spin` seconds are busy-waited, longer ones are
+    slept up to that margin since sleep() overshoots.
+    """
+
+    def __init__(self, burst=4, gain=1.25, slow_start_gain=2.0, spin=0.0002):
+        self.burst = burst
+        self.gain = gain
+        self.slow_start_gain = slow_start_gain
+        self.spin = spin
+        self.rate = None # Packets per second
+        self.tokens = float(burst)
+        self.last = time.time()
+        # Achieved vs target rate
+        self.sent = 0
+        self.target_total = 0.0
+        self.first_send = None
+        self.last_send = None
+
+    def set_rate(self, cwnd, srtt, slow_start=False):
+        if srtt:
+            gain = self.slow_start_gain if slow_start else self.gain
+            self.rate = gain * cwnd / srtt
+
+    def ready(self, now):
+        """True if a packet may be sent now, see sent_packet()."""
+        if self.rate is None:
+            self.tokens = self.burst
+        else:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return self.tokens >= 1
+
+    def sent_packet(self, now):
+        """Take the token of a packet sent after ready()."""
+        self.tokens -= 1
+        if self.rate is not None:
+            self.sent += 1
+            self.target_total += self.rate
+            if self.first_send is None:
+                self.first_send = now
+            self.last_send = now
+
+    def next_release(self):
+        """Time at which the next token is available."""
+        if self.rate is None or self.tokens >= 1:
+            return self.last
+        return self.last + (1 - self.tokens) / self.rate
+
+    def wait(self, until):
+        """Sleep, then spin, until the given time."""
+        remaining = until - time.time()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+        while time.time() < until:
+            pass
+
+    def report(self):
+        """Average target rate and achieved rate of the paced packets (packets/s)."""
+        if self.sent < 2 or self.last_send == self.first_send:
+            return {"packets": self.sent, "target_pps": None, "achieved_pps": None}
+        return {
+            "packets": self.sent,
+            "target_pps": round(self.target_total / self.sent),
+            "achieved_pps": round((self.sent - 1) / (self.last_send - self.first_send)),
+        }
+
+
+class DelayedAcks:
+    """
+    Delayed/coalesced ACK policy of a receiver.
+
+    An ACK is due once `every` in-order packets are unacknowledged, or
+    `delay` seconds after the first of them, whichever comes first. An
+    out-of-order packet (gap, hole filled or duplicate) makes it due at
+    once so the sender learns about loss without waiting.
+    """
+
+    def __init__(self, every=1, delay=0.002):
+        self.every = max(1, every)
+        self.delay = delay
+        self.pending = 0
+        self.deadline = None
+        self.urgent = False
+
+    def on_data(self, in_order):
+        """Count a DATA packet that is owed an ACK."""
+        if in_order:
+            self.pending += 1
+            if self.deadline is None:
+                self.deadline = time.time() + self.delay
+        else:
+            self.urgent = True
+
+    def due(self):
+        return (self.urgent or self.pending >= self.every
+                or (self.deadline is not None and time.time() >= self.deadline))
+
+    def sent(self):
+        """The owed ACK has been sent."""
+        self.pending = 0
+        self.deadline = None
+        self.urgent = False
+
+    def timeout(self, default):
+        """Socket timeout that wakes the receiver when the delay expires."""
+        if self.deadline is None:
+            return default
+        return min(default, max(self.deadline - time.time(), 0.0001))
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_mmsg():
+    """Return libc if it has sendmmsg/recvmmsg (Linux), else None."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                  ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_mmsg()
+_SOCKADDR_SIZE = 16  # sizeof(struct sockaddr_in)
+_IOVEC_SIZE = ctypes.sizeof(_iovec)
+_IOV_LEN_OFFSET = _iovec.iov_len.offset
+_MMSGHDR_SIZE = ctypes.sizeof(_mmsghdr)
+_MSG_LEN_OFFSET = _mmsghdr.msg_len.offset
+_SIZE_T = struct.Struct("N")
+_UINT = struct.Struct("=I")
+
+
+class _MMsgRing:
+    """Preallocated mmsghdr vector with one data slot and one name per message."""
+
+    def __init__(self, n, buffer_size):
+        self._data = ctypes.create_string_buffer(n * buffer_size)
+        self._names = ctypes.create_string_buffer(n * _SOCKADDR_SIZE)
+        self._iovs = (_iovec * n)()
+        self._msgs = (_mmsghdr * n)()
+        data_address = ctypes.addressof(self._data)
+        names_address = ctypes.addressof(self._names)
+        for i in range(n):
+            self._iovs[i].iov_base = data_address + i * buffer_size
+            self._iovs[i].iov_len = buffer_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names_address + i * _SOCKADDR_SIZE
+            hdr.msg_namelen = _SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+        self.msgs_address = ctypes.addressof(self._msgs)
+        self.data = memoryview(self._data).cast("B")
+        self.names = memoryview(self._names).cast("B")
+        self.iovs = memoryview(self._iovs).cast("B")
+        self.msgs = memoryview(self._msgs).cast("B")
+
+
+class BatchIO:
+    """
+    Batched datagram I/O for an AF_INET UDP socket.
+
+    On Linux a whole batch goes through one sendmmsg/recvmmsg syscall,
+    elsewhere (or with batch_size=1) it falls back to per-packet
+    sendto/recvfrom. Timeouts follow sock.gettimeout() and raise
+    socket.timeout like recvfrom does.
+
+    The mmsg path uses preallocated contiguous buffers: outgoing
+    datagrams are copied into fixed slots and the per-message fields are
+    read/written through memoryviews, which is much cheaper than ctypes
+    attribute access on every packet.
+
+    recv_batch returns memoryviews into those preallocated buffers (no
+    copy); they are only valid until the next recv_batch call.
+    """
+
+    def __init__(self, sock, batch_size=32, buffer_size=2048):
+        self.sock = sock
+        self.batch_size = max(1, batch_size)
+        self.buffer_size = buffer_size
+        self.use_mmsg = _libc is not None and self.batch_size > 1
+        if self.use_mmsg:
+            self.send = _MMsgRing(self.batch_size, buffer_size)
+            self.recv = _MMsgRing(self.batch_size, buffer_size)
+            self.sockaddrs = {}  # address -> packed sockaddr_in
+            self.addresses = {}  # packed sockaddr_in -> address
+            self.slot_addresses = [None] * self.batch_size
+        else:
+            self.recv_buffers = [bytearray(buffer_size) for _ in range(self.batch_size)]
+
+    def _wait(self, readable):
+        """Wait until the socket is ready, honouring its timeout."""
+        timeout = self.sock.gettimeout()
+        if readable:
+            ready = select.select([self.sock], [], [], timeout)[0]
+        else:
+            ready = select.select([], [self.sock], [], timeout)[1]
+        if not ready:
+            raise socket.timeout("timed out")
+
+    def _sockaddr(self, address):
+        sockaddr = self.sockaddrs.get(address)
+        if sockaddr is None:
+            sockaddr = (struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1])
+                        + socket.inet_aton(socket.gethostbyname(address[0]))).ljust(
+                            _SOCKADDR_SIZE, b"\0")
+            self.sockaddrs[address] = sockaddr
+        return sockaddr
+
+    def _address(self, sockaddr):
+        address = self.addresses.get(sockaddr)
+        if address is None:
+            address = (socket.inet_ntoa(sockaddr[4:8]), struct.unpack_from("!H", sockaddr, 2)[0])
+            self.addresses[sockaddr] = address
+        return address
+
+    def send_batch(self, datagrams):
+        """
+        Send a list of (data, address) pairs. data is a buffer, or a tuple
+        of buffers sent as one datagram (scatter/gather).
+        """
+        if not self.use_mmsg:
+            for data, address in datagrams:
+                if type(data) is tuple:
+                    self.sock.sendmsg(data, (), 0, address)
+                else:
+                    self.sock.sendto(data, address)
+            return
+        ring = self.send
+        buffer_size = self.buffer_size
+        slot_addresses = self.slot_addresses
+        fd = self.sock.fileno()
+        for begin in range(0, len(datagrams), self.batch_size):
+            chunk = datagrams[begin:begin + self.batch_size]
+            for i, (data, address) in enumerate(chunk):
+                offset = i * buffer_size
+                if type(data) is tuple:
+                    length = 0
+                    for part in data:
+                        part_length = len(part)
+                        ring.data[offset + length:offset + length + part_length] = part
+                        length += part_length
+                else:
+                    length = len(data)
+                    ring.data[offset:offset + length] = data
+                _SIZE_T.pack_into(ring.iovs, i * _IOVEC_SIZE + _IOV_LEN_OFFSET, length)
+                if slot_addresses[i] != address:
+                    name_offset = i * _SOCKADDR_SIZE
+                    ring.names[name_offset:name_offset + _SOCKADDR_SIZE] = self._sockaddr(address)
+                    slot_addresses[i] = address
+            sent = 0
+            while sent < len(chunk):
+                n = _libc.sendmmsg(fd, ring.msgs_address + sent * _MMSGHDR_SIZE,
+                                   len(chunk) - sent, 0)
+                if n < 0:
+                    err = ctypes.get_errno()
+                    if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._wait(readable=False)
+                        continue
+                    if err == errno.EINTR:
+                        continue
+                    raise OSError(err, "sendmmsg: " + errno.errorcode.get(err, ""))
+                sent += n
+
+    def recv_batch(self):
+        """
+        Block (up to the socket timeout) for at least one datagram and
+        return up to batch_size (data, address) pairs already queued.
+        """
+        if not self.use_mmsg:
+            buffers = self.recv_buffers
+            n, address = self.sock.recvfrom_into(buffers[0])
+            batch = [(memoryview(buffers[0])[:n], address)]
+            while len(batch) < self.batch_size:
+                buffer = buffers[len(batch)]
+                try:
+                    n, address = self.sock.recvfrom_into(buffer, 0, socket.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    break
+                batch.append((memoryview(buffer)[:n], address))
+            return batch
+        ring = self.recv
+        fd = self.sock.fileno()
+        while True:
+            n = _libc.recvmmsg(fd, ring.msgs_address, self.batch_size, socket.MSG_DONTWAIT, None)
+            if n > 0:
+                break
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._wait(readable=True)
+            elif err != errno.EINTR:
+                raise OSError(err, "recvmmsg: " + errno.errorcode.get(err, ""))
+        buffer_size = self.buffer_size
+        batch = []
+        for i in range(n):
+            length = _UINT.unpack_from(ring.msgs, i * _MMSGHDR_SIZE + _MSG_LEN_OFFSET)[0]
+            offset = i * buffer_size
+            name_offset = i * _SOCKADDR_SIZE
+            address = self._address(bytes(ring.names[name_offset:name_offset + _SOCKADDR_SIZE]))
+            batch.append((ring.data[offset:offset + length], address))
+        return batch
+
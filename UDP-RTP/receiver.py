@@ -1,17 +1,32 @@
 from rtp_socket import RTPReceiverSocket
+from stripe import recv_striped
+from utils import TraceWriter
 import sys
 import argparse
+import logging
 
-def receiver(receiver_ip, receiver_port, window_size):
-    rtp_socket = RTPReceiverSocket(window_size)
+def receiver(receiver_ip, receiver_port, window_size, batch_size=1, sack=False,
+             ack_every=1, ack_delay=0.002, streams=1, output_path=None,
+             stats=False, trace_path=None):
+    if streams > 1:
+        # One flow per worker process and port, see stripe.py
+        recv_striped(receiver_ip, receiver_port, window_size, streams, output_path,
+                     batch_size=batch_size, sack=sack, ack_every=ack_every,
+                     ack_delay=ack_delay)
+        return
+    rtp_socket = RTPReceiverSocket(window_size, batch_size, sack, ack_every, ack_delay)
     rtp_socket.bind(receiver_ip, receiver_port)
+    if trace_path is not None:
+        rtp_socket.trace = TraceWriter(trace_path)
     
     
-    data = rtp_socket.recv()
-    if data:
-        sys.stdout.buffer.write(data)
-        sys.stdout.flush()
-    rtp_socket.close()  
+    # Write data to stdout as it arrives instead of buffering until END
+    rtp_socket.recv_stream(sys.stdout.buffer)
+    rtp_socket.close()
+    if trace_path is not None:
+        rtp_socket.trace.close()
+    if stats:
+        print(f"Stats: {rtp_socket.stats.report()}", file=sys.stderr)
     
     
 def main():
@@ -25,9 +40,54 @@ def main():
     parser.add_argument(
         "window_size", type=int, help="Maximum number of outstanding packets"
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Datagrams per sendmmsg/recvmmsg call (1 disables batching)"
+    )
+    parser.add_argument(
+        "--sack", action="store_true",
+        help="Send selective ACKs, one per received batch"
+    )
+    parser.add_argument(
+        "--ack-every", type=int, default=1,
+        help="Acknowledge every N in-order packets (out-of-order ones at once)"
+    )
+    parser.add_argument(
+        "--ack-delay", type=float, default=0.002,
+        help="Longest delay in seconds of an ACK owed to in-order packets"
+    )
+    parser.add_argument(
+        "--streams", type=int, default=1,
+        help="Receive a transfer striped over this many flows (ports receiver_port and up)"
+    )
+    parser.add_argument(
+        "--output", dest="output_path",
+        help="With --streams, write the data to this file instead of stdout"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+        help="DEBUG logs every packet, which slows the transfer down"
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="Print the counters of the socket at the end"
+    )
+    parser.add_argument(
+        "--trace", dest="trace_path",
+        help="Record a binary packet trace to this file (see trace_analyze.py)"
+    )
     args = parser.parse_args()
+    if args.streams > 1:
+        # The flows run in worker processes, each with its own socket
+        for option, value in (("--stats", args.stats), ("--trace", args.trace_path)):
+            if value:
+                parser.error(f"{option} is not supported with --streams")
+    # On stderr, stdout may carry the data
+    logging.basicConfig(level=args.log_level, format="%(message)s")
 
-    receiver(args.receiver_ip, args.receiver_port, args.window_size)
+    receiver(args.receiver_ip, args.receiver_port, args.window_size, args.batch_size,
+             args.sack, args.ack_every, args.ack_delay, args.streams, args.output_path,
+             args.stats, args.trace_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,523 @@
+"""
+asyncio implementation of the RTP sockets of rtp_socket.py.
+
+Same wire protocol (START/DATA/END/ACK, individual ACKs or SACKs), but
+every connection is a DatagramProtocol driven by the event loop, so one
+process can run thousands of transfers concurrently:
+
+    # Sender
+    conn = await connect("localhost", 40000)
+    await conn.send(data)          # or conn.write(data); await conn.drain()
+    conn.close()
+    await conn.wait_closed()
+
+    # Receiver: one transfer at a time...
+    receiver = await listen("localhost", 40000)
+    data, address = await receiver.recv()
+
+    # ...or a stream reader per sender, like asyncio.start_server
+    async def handle(reader, address):
+        data = await reader.read()
+    server = await start_server(handle, "localhost", 40000)
+
+Retransmission timers are loop.call_later handles, one per packet in
+flight; on the receiving side one per sender drops it after IDLE_TIMEOUT
+without a packet.
+"""
+import asyncio
+
+from utils import (CHECKSUMS, CONGESTION_CONTROLS, CRC32, RTTEstimator, PacketHeader,
+                   accept_checksum, agreed_checksum, checksum_offer, compute_checksum,
+                   decode_sack, encode_sack, verify_packet)
+
+CHUNK_SIZE = 1472 - 16  # 1472 is the maximum size of a packet
+# Finished receiver connections are kept this long to ACK a resent END
+LINGER = 2.0
+# Receiver connections with no packet for this long are dropped: their
+# sender died mid-transfer
+IDLE_TIMEOUT = 15 * LINGER
+
+
+def _packet(type, seq_num, payload=b"", checksum=CRC32):
+    header = PacketHeader(type=type, seq_num=seq_num, length=len(payload), checksum=0)
+    header.checksum = compute_checksum(bytes(header) + payload, checksum)
+    return bytes(header) + payload
+
+
+class RTPSenderProtocol(asyncio.DatagramProtocol):
+    """Sending side of one connection (selective repeat, like RTPSenderSocket)."""
+
+    def __init__(self, window_size=128, congestion="none", reorder_threshold=3,
+                 checksum="crc32"):
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.window_size = window_size
+        # Checksum offered in the START handshake; crc32 until the receiver
+        # takes it
+        self.offered_checksum = CHECKSUMS[checksum]
+        self.checksum = CRC32
+        # Adaptive retransmission timeout of this connection
+        self.rtt = RTTEstimator()
+        # Congestion window, capped by the receiver window (window_size)
+        self.cc = CONGESTION_CONTROLS[congestion](window_size)
+        self.reorder_threshold = reorder_threshold
+        self.pending = bytearray()  # Written data not yet in a packet
+        self.packets = {}  # Packets in flight
+        self.timers = {}  # Retransmission timer handle of each packet in flight
+        # Send time of packets sent only once, used for RTT samples (Karn's rule)
+        self.send_times = {}
+        self.received = set()
+        self.fast_scanned = 1  # seq_nums below were already checked for fast retransmit
+        self.highest_acked = 0
+        self.start = 1  # First data packet seq_num
+        self.next_seq_num = 1
+        self.last_progress = self.loop.time()
+        self.backoff_until = 0.0
+        # START/END handshake in progress: ACK seq_num and its future
+        self.handshake_ack = None
+        self.handshake = None
+        self.waiters = []
+        self.exception = None
+        self.closed = self.loop.create_future()  # Done once the transport is closed
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.exception = exc or ConnectionError("Connection closed")
+        if not self.closed.done():
+            self.closed.set_result(None)
+        for handle in self.timers.values():
+            handle.cancel()
+        self.timers.clear()
+        self._wake()
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) are recovered by retransmission
+        pass
+
+    def datagram_received(self, data, address):
+        try:
+            header = PacketHeader.unpack_from(data)
+            if header.type != 3 or not verify_packet(data, header, self.checksum):
+                return
+            if self.handshake is not None:
+                if header.seq_num == self.handshake_ack and not self.handshake.done():
+                    if header.seq_num == 1:
+                        # START ACK: crc32 unless the receiver took the offer
+                        self.checksum = agreed_checksum(data, header, self.offered_checksum)
+                    self.handshake.set_result(None)
+                return
+            if header.length:
+                # SACK: everything below the cumulative base plus the blocks
+                ranges = decode_sack(data, header.length)
+            else:
+                ranges = ((header.seq_num, header.seq_num + 1),)
+        except ValueError:
+            return
+        self._on_ack(header.seq_num, ranges)
+
+    async def handshake_packet(self, type, seq_num, deadline=None):
+        """Send a START/END packet until it is ACKed (or the deadline passes)."""
+        if type == 0:
+            # START packets always use crc32 and carry the checksum offer
+            packet = _packet(type, seq_num, checksum_offer(self.offered_checksum))
+        else:
+            packet = _packet(type, seq_num, checksum=self.checksum)
+        self.handshake_ack = seq_num + 1
+        self.handshake = self.loop.create_future()
+        attempts = 0
+        try:
+            while True:
+                attempts += 1
+                sent_time = self.loop.time()
+                self.transport.sendto(packet)
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.handshake), self.rtt.rto)
+                except asyncio.TimeoutError:
+                    self.rtt.on_timeout()
+                    if deadline is not None and self.loop.time() >= deadline:
+                        return False
+                    continue
+                # Karn's rule: only a packet sent once gives an RTT sample
+                if attempts == 1:
+                    self.rtt.sample(self.loop.time() - sent_time)
+                return True
+        finally:
+            self.handshake = None
+
+    def write(self, data):
+        self.pending += data
+        self._fill()
+
+    @property
+    def buffered(self):
+        """Bytes written but not acknowledged yet."""
+        return len(self.pending) + (self.next_seq_num - self.start) * CHUNK_SIZE
+
+    def _fill(self):
+        """Send new packets that fit in the window."""
+        if self.transport is None or self.exception is not None:
+            return
+        now = self.loop.time()
+        while self.pending and self.next_seq_num < self.start + self.cc.window:
+            chunk = bytes(self.pending[:CHUNK_SIZE])
+            del self.pending[:CHUNK_SIZE]
+            seq_num = self.next_seq_num
+            self.next_seq_num += 1
+            self.packets[seq_num] = _packet(2, seq_num, chunk, self.checksum)  # Data type
+            self.send_times[seq_num] = now
+            self.transport.sendto(self.packets[seq_num])
+            self._arm(seq_num)
+
+    def _arm(self, seq_num):
+        handle = self.timers.get(seq_num)
+        if handle is not None:
+            handle.cancel()
+        self.timers[seq_num] = self.loop.call_later(self.rtt.rto, self._on_timer, seq_num)
+
+    def _on_timer(self, seq_num):
+        """The retransmission timer of seq_num expired."""
+        now = self.loop.time()
+        # Loss while ACKs still arrive, timeout when nothing was
+        # acknowledged for a whole RTO
+        if now - self.last_progress >= self.rtt.rto:
+            self.cc.on_timeout(self.next_seq_num)
+        else:
+            self.cc.on_loss(seq_num, self.next_seq_num)
+        # Timers expiring together are one timeout, back off once per RTO
+        if now >= self.backoff_until:
+            self.rtt.on_timeout()
+            self.backoff_until = now + self.rtt.rto
+        self.send_times.pop(seq_num, None)
+        self.transport.sendto(self.packets[seq_num])
+        self._arm(seq_num)
+
+    def _retransmit(self, seq_num):
+        self.send_times.pop(seq_num, None)
+        self.transport.sendto(self.packets[seq_num])
+        self._arm(seq_num)
+
+    def _on_ack(self, received_seq_num, ranges):
+        now = self.loop.time()
+        acked = 0
+        for begin, end in ranges:
+            for seq_num in range(max(begin, self.start), min(end, self.next_seq_num)):
+                if seq_num in self.received:
+                    continue
+                self.received.add(seq_num)
+                acked += 1
+                self.timers.pop(seq_num).cancel()
+                self.highest_acked = max(self.highest_acked, seq_num)
+                sent_time = self.send_times.pop(seq_num, None)
+                # Only the packet that triggered the ACK gives an RTT sample
+                if sent_time is not None and seq_num == received_seq_num:
+                    self.rtt.sample(now - sent_time)
+        if not acked:
+            return
+        self.cc.on_ack(acked)
+        self.last_progress = now
+        # Move window
+        while self.start in self.received:
+            self.received.remove(self.start)
+            del self.packets[self.start]
+            self.start += 1
+        # Fast retransmit of the holes with enough later packets acknowledged,
+        # each seq_num checked once, from where the last pass stopped
+        fast_end = self.highest_acked - self.reorder_threshold + 1
+        for seq_num in range(max(self.fast_scanned, self.start), fast_end):
+            if seq_num in self.received:
+                continue
+            self.cc.on_loss(seq_num, self.next_seq_num)
+            self._retransmit(seq_num)
+        self.fast_scanned = max(self.fast_scanned, fast_end)
+        self._fill()
+        self._wake()
+
+    def _wake(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_until(self, condition):
+        """Wait until condition() is true, re-checked on every ACK progress."""
+        while not condition():
+            if self.exception is not None:
+                raise self.exception
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+
+class RTPStreamWriter:
+    """Stream interface of a sender connection, like asyncio.StreamWriter."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+        # drain() waits until no more than this is buffered
+        self.high_water = protocol.window_size * CHUNK_SIZE
+        self.closing = None
+
+    def write(self, data):
+        self.protocol.write(data)
+
+    async def drain(self):
+        """Wait until the write buffer is below the high-water mark."""
+        protocol = self.protocol
+        await protocol.wait_until(lambda: protocol.buffered <= self.high_water)
+
+    async def flush(self):
+        """Wait until everything written so far is acknowledged."""
+        protocol = self.protocol
+        await protocol.wait_until(lambda: protocol.buffered == 0)
+
+    async def send(self, data):
+        """Reliably send data, returns once it is all acknowledged."""
+        self.write(data)
+        await self.flush()
+
+    def close(self):
+        if self.closing is None:
+            self.closing = asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        protocol = self.protocol
+        try:
+            await self.flush()
+            # END handshake, given up after 0.5 s like RTPSenderSocket
+            await protocol.handshake_packet(1, protocol.next_seq_num,
+                                            protocol.loop.time() + 0.5)  # END type
+        finally:
+            self.transport.close()
+
+    async def wait_closed(self):
+        """Wait until the connection is closed, by close() or otherwise."""
+        if self.closing is not None:
+            await self.closing
+        await asyncio.shield(self.protocol.closed)
+
+    def is_closing(self):
+        return self.closing is not None
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+async def connect(host, port, window_size=128, congestion="none", reorder_threshold=3,
+                  checksum="crc32"):
+    """
+    Open a sender connection (START handshake, offering checksum) and
+    return its RTPStreamWriter.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: RTPSenderProtocol(window_size, congestion, reorder_threshold, checksum),
+        remote_addr=(host, port))
+    try:
+        await protocol.handshake_packet(0, 0)  # START type
+    except BaseException:
+        transport.close()
+        raise
+    return RTPStreamWriter(transport, protocol)
+
+
+class _Peer:
+    """
+    Receiving state of one sender. It is also the transport of its
+    reader, which pauses it once more than twice its limit is buffered and
+    resumes it when the consumer has read down to the limit.
+    """
+    __slots__ = ("start_seq_num", "data_buffer", "reader", "done", "paused", "last_seen",
+                 "idle", "checksum")
+
+    def __init__(self, reader, now, checksum):
+        self.start_seq_num = 1
+        self.data_buffer = {}  # Out-of-order payloads only
+        self.reader = reader
+        self.done = False
+        self.paused = False
+        self.last_seen = now  # Of the latest valid packet
+        self.idle = None  # Idle timer handle
+        self.checksum = checksum  # Agreed in the START handshake
+        reader.set_transport(self)
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+class RTPServerProtocol(asyncio.DatagramProtocol):
+    """
+    Receiving side: one bound endpoint, one connection per sender
+    address. Each new connection is handed to client_connected_cb(reader,
+    address) with an asyncio.StreamReader of its in-order data. Like with
+    asyncio.start_server, a reader holds about `limit` bytes: past it the
+    packets at the window base are dropped until the consumer reads. A
+    sender silent for IDLE_TIMEOUT mid-transfer is dropped and its reader
+    raises ConnectionError.
+    """
+
+    def __init__(self, client_connected_cb, window_size=128, sack=False, limit=2 ** 16):
+        self.loop = asyncio.get_running_loop()
+        self.client_connected_cb = client_connected_cb
+        self.window_size = window_size
+        self.sack = sack
+        self.limit = limit
+        self.transport = None
+        self.peers = {}
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for peer in self.peers.values():
+            peer.idle.cancel()
+            if not peer.done:
+                peer.reader.set_exception(exc or ConnectionError("Connection closed"))
+        self.peers.clear()
+
+    def error_received(self, exc):
+        pass
+
+    def send_ack(self, ack_seq_num, address, payload=b"", checksum=CRC32):
+        self.transport.sendto(_packet(3, ack_seq_num, payload, checksum), address)
+
+    def datagram_received(self, data, address):
+        if len(data) < 16:
+            return
+        try:
+            header = PacketHeader.unpack_from(data)
+        except ValueError:
+            return
+        peer = self.peers.get(address)
+        # START packets are checked with crc32, the others with the checksum
+        # of their connection
+        if not verify_packet(data, header, CRC32 if peer is None else peer.checksum):
+            return
+
+        # Start handshake, a finished connection can be reopened. The START
+        # ACK echoes the checksum taken (in crc32 like every START ACK)
+        if header.type == 0:
+            if header.seq_num == 0:
+                if peer is None or peer.done:
+                    peer = self._accept(address, accept_checksum(data, header))
+                self.send_ack(1, address, checksum_offer(peer.checksum))
+            return
+        if peer is None:
+            return
+        peer.last_seen = self.loop.time()
+
+        # Data transmission
+        if header.type == 2 and not peer.done:
+            seq_num = header.seq_num
+            if seq_num >= peer.start_seq_num + self.window_size:
+                return  # Out of window
+            if seq_num == peer.start_seq_num and peer.paused:
+                # Slow consumer: neither ACKed nor delivered, so the window
+                # stops and the sender retransmits it once the reader resumes
+                return
+            if seq_num == peer.start_seq_num:
+                peer.reader.feed_data(data[16:16 + header.length])
+                peer.start_seq_num += 1
+                # Then the buffered packets behind it
+                while peer.start_seq_num in peer.data_buffer:
+                    peer.reader.feed_data(peer.data_buffer.pop(peer.start_seq_num))
+                    peer.start_seq_num += 1
+            elif seq_num > peer.start_seq_num and seq_num not in peer.data_buffer:
+                peer.data_buffer[seq_num] = data[16:16 + header.length]
+            if self.sack:
+                self.send_ack(seq_num, address,
+                              encode_sack(peer.start_seq_num, peer.data_buffer), peer.checksum)
+            else:
+                self.send_ack(seq_num, address, checksum=peer.checksum)
+
+        # End handshake
+        elif header.type == 1 and header.seq_num == peer.start_seq_num:
+            self.send_ack(peer.start_seq_num + 1, address, checksum=peer.checksum)
+            if not peer.done:
+                peer.done = True
+                peer.reader.feed_eof()
+                self.loop.call_later(LINGER, self._forget, address, peer)
+
+    def _accept(self, address, checksum):
+        now = self.loop.time()
+        peer = _Peer(asyncio.StreamReader(self.limit), now, checksum)
+        peer.idle = self.loop.call_at(now + IDLE_TIMEOUT, self._check_idle, address, peer)
+        self.peers[address] = peer
+        result = self.client_connected_cb(peer.reader, address)
+        if asyncio.iscoroutine(result):
+            task = self.loop.create_task(result)
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return peer
+
+    def _forget(self, address, peer):
+        peer.idle.cancel()
+        if self.peers.get(address) is peer:
+            del self.peers[address]
+
+    def _check_idle(self, address, peer):
+        if peer.done or self.peers.get(address) is not peer:
+            return
+        due = peer.last_seen + IDLE_TIMEOUT
+        if self.loop.time() < due:
+            peer.idle = self.loop.call_at(due, self._check_idle, address, peer)
+            return
+        peer.reader.set_exception(ConnectionError("Sender %s:%d timed out" % address[:2]))
+        del self.peers[address]
+
+
+class RTPServer:
+    """Bound receiving endpoint returned by start_server()."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    @property
+    def address(self):
+        return self.transport.get_extra_info("sockname")
+
+    def close(self):
+        self.transport.close()
+
+
+async def start_server(client_connected_cb, host, port, window_size=128, sack=False,
+                       limit=2 ** 16):
+    """Receive from any number of senders on one port, see RTPServerProtocol."""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: RTPServerProtocol(client_connected_cb, window_size, sack, limit),
+        local_addr=(host, port))
+    return RTPServer(transport, protocol)
+
+
+class RTPReceiver(RTPServer):
+    """Whole transfers as (data, address), returned by listen()."""
+
+    def __init__(self, transport, protocol, transfers):
+        super().__init__(transport, protocol)
+        self.transfers = transfers
+
+    async def recv(self):
+        """Return the data and sender address of the next completed transfer."""
+        return await self.transfers.get()
+
+
+async def listen(host, port, window_size=128, sack=False):
+    transfers = asyncio.Queue()
+
+    async def collect(reader, address):
+        try:
+            data = await reader.read()
+        except ConnectionError:
+            return  # The sender died mid-transfer
+        await transfers.put((data, address))
+
+    server = await start_server(collect, host, port, window_size, sack)
+    return RTPReceiver(server.transport, server.protocol, transfers)
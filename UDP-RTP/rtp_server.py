@@ -1,18 +1,27 @@
-from rtp_socket import RTPReceiverSocket, RTPSenderSocket
+from rtp_socket import RTPListener
+import threading
 
 serverPort = 40000
 
-serverSocketRecv = RTPReceiverSocket()
-serverSocketRecv.bind('', serverPort)  # Bind once here (outside the loop)
+# One session per client, all on the bound port
+serverListener = RTPListener()
+serverListener.bind('', serverPort)
 
 print("The server is ready to receive")
 
+
+def serve(connection):
+    # Any number of requests per session; each reply carries the ACK of
+    # its request
+    while True:
+        message = connection.recv()
+        if message is None:  # Client closed the session
+            break
+        modifiedMessage = message.decode().upper().encode()
+        connection.send(modifiedMessage)
+    connection.close()
+
+
 while True:
-    message, clientAddress = serverSocketRecv.recv()  # No bind() here
-    modifiedMessage = message.decode().upper().encode()
-    
-    # Create a new sender socket per request
-    serverSocketSender = RTPSenderSocket()
-    serverSocketSender.connect(clientAddress[0], clientAddress[1])
-    serverSocketSender.send(modifiedMessage)
-    serverSocketSender.close()
\ No newline at end of file
+    connection, clientAddress = serverListener.accept()
+    threading.Thread(target=serve, args=(connection,), daemon=True).start()
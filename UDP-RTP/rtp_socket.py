@@ -1,114 +1,311 @@
 import socket
-from utils import PacketHeader, compute_checksum
+from utils import (CHECKSUMS, CONGESTION_CONTROLS, CRC32, END_OF_MESSAGE, HEADER_SIZE,
+                   INPUT_PENDING, SESSION_HEADER, BatchIO, DelayedAcks, InFlight,
+                   MappedFilePackets, PacketHeader, Pacer, ReorderBuffer, RetransmitTimers,
+                   RTTEstimator, SocketStats, StreamPackets, accept_checksum, agreed_checksum,
+                   checksum_offer, compute_checksum, decode_sack, encode_sack, packet_size,
+                   verify_batch, verify_packet, wait_input)
+import io
+import logging
+import queue
+import threading
 import time
-from collections import defaultdict
+from collections import deque
+
+# Finished receiver connections are kept this long to ACK a resent END
+LINGER = 2.0
+# Receiver connections with no packet for this long are dropped: their
+# sender died mid-transfer
+IDLE_TIMEOUT = 15 * LINGER
+
+# Connection events at INFO, every packet at DEBUG
+log = logging.getLogger(__name__)
 
 
 class RTPSenderSocket:
-    def __init__(self, window_size=128):
+    def __init__(self, window_size=128, batch_size=1, congestion="none", pacing=False,
+                 reorder_threshold=3, checksum="crc32"):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
-        self.sock.settimeout(0.5)
+        # Adaptive retransmission timeout of this connection
+        self.rtt = RTTEstimator()
+        self.sock.settimeout(self.rtt.rto)
         self.window_size = window_size
+        # Congestion window, capped by the receiver window (window_size);
+        # its state() and trace hook are there for tracing
+        self.cc = CONGESTION_CONTROLS[congestion](window_size)
+        # Optional pacing of new packets over the RTT instead of window
+        # bursts, pacer.report() gives the achieved vs target rate
+        self.pacer = Pacer() if pacing else None
+        # Later packets acknowledged before a missing one is fast retransmitted
+        self.reorder_threshold = reorder_threshold
+        # Checksum offered in the START handshake; crc32 until the receiver
+        # takes it
+        self.offered_checksum = CHECKSUMS[checksum]
+        self.checksum = CRC32
         self.seq_num = 0
         self.receiver_addr = None
         self.buffer_size = 2048
+        # sendmmsg/recvmmsg batching of data packets and ACKs (Linux)
+        self.batch_io = BatchIO(self.sock, batch_size, self.buffer_size)
         self.chunk_size = 1472 - 16  # 1472 is the maximum size of a packet
         self.n_packets = None
+        self.stats = SocketStats()
+        # Optional trace(event, seq_num, length) hook, e.g. a TraceRing or a
+        # TraceWriter; read into a local by the loops, so it costs one test
+        # per event when None
+        self.trace = None
     
-    def verify_checksum(self, header):
-        """Verify packet checksum"""
-        saved_checksum = header.checksum
-        header.checksum = 0
-        return compute_checksum(header) == saved_checksum
-
     def connect(self, receiver_ip, receiver_port):
         """Initiate connection with START packet."""
         self.receiver_addr = (receiver_ip, receiver_port)
         # Send START packet and wait for ACK (existing logic from sender.py)
         # Handshake with START packet
+        offer = checksum_offer(self.offered_checksum)
         start_header = PacketHeader(
             type=0,
             seq_num=0,
-            length=0,
+            length=len(offer),
             checksum=0
         )
-        start_header.checksum = compute_checksum(bytes(start_header) + b'')
+        start_header.checksum = compute_checksum(bytes(start_header) + offer)
+        start_packet = bytes(start_header) + offer
 
         # Send START until ACK is received
+        attempts = 0
         while True:
-            print("Sending START")
-            self.sock.sendto(bytes(start_header), (receiver_ip, receiver_port))
+            log.debug("Sending START")
+            self.sock.sendto(start_packet, (receiver_ip, receiver_port))
+            sent_time = time.time()
+            attempts += 1
             try:
-                print("Waiting for ACK at start")
+                log.debug("Waiting for ACK at start")
                 ack_data, _ = self.sock.recvfrom(self.buffer_size)
-                ack_header = PacketHeader(ack_data[:16])
+                ack_header = PacketHeader.unpack_from(ack_data)
                 if (ack_header.type == 3 and  # ACK type
                         ack_header.seq_num == 1):
-                    if (self.verify_checksum(ack_header)):
+                    if verify_packet(ack_data, ack_header):
+                        self.checksum = agreed_checksum(ack_data, ack_header,
+                                                        self.offered_checksum)
+                        # Karn's rule: the RTT of a resent START is ambiguous
+                        if attempts == 1:
+                            self.rtt.sample(time.time() - sent_time)
                         break
                     else:
-                        print("Invalid checksum for start ACK")
-            except (socket.timeout, ValueError):
-                print("Timeout when waiting for ACK")
+                        self.stats.checksum_failures += 1
+                        log.info("Invalid checksum for start ACK")
+            except socket.timeout:
+                log.info("Timeout when waiting for ACK")
+                self.rtt.on_timeout()
+                self.sock.settimeout(self.rtt.rto)
+            except ValueError:
                 continue
-        print("Connection established")
+        log.info("Connection established, checksum %s", self.checksum.name)
 
     def send(self, data):
         """Reliably send data using sliding window."""
-        # Split data into chunks, add RTP headers, manage window and retransmissions
-        # (Adapt logic from sender.py's data transmission phase)
-        chunks = [data[i:i+self.chunk_size]
-                  for i in range(0, len(data), self.chunk_size)]
-        self.n_packets = len(chunks)
-
-        # Create a packet dictionary to store all packets
-        packet_dict = {}
-        for i in range(self.n_packets):
-            seq_num = i + 1
-            chunk = chunks[i]
-            header = PacketHeader(
-                type=2,  # Data type
-                seq_num=seq_num,
-                length=len(chunk),
-                checksum=0
-            )
-            header.checksum = compute_checksum(bytes(header) + chunk)
-            packet_dict[seq_num] = bytes(header) + chunk
+        # BytesIO shares the bytes object, chunks are copied into packet
+        # buffers only when the window has room for them
+        self.send_stream(io.BytesIO(data))
+
+    def send_stream(self, stream):
+        """Reliably send a binary stream (e.g. sys.stdin.buffer) until EOF.
+
+        Chunks are read on demand as the window advances, so only packets
+        in flight are kept in memory and sending starts before EOF.
+        """
+        self._send_packets(StreamPackets(stream, self.chunk_size, self.window_size,
+                                         self.checksum))
+
+    def sendfile(self, path):
+        """Reliably send a regular file.
+
+        The file is memory-mapped and packets are slices of the mapping,
+        so it is never copied into user space and retransmissions read
+        it again from the page cache.
+        """
+        source = MappedFilePackets(path, self.chunk_size, self.checksum)
+        try:
+            self._send_packets(source)
+        finally:
+            source.close()
+
+    def _send_packets(self, source):
+        """Sliding window transmission of the packets of a source."""
+        eof = False
+        # Packets in flight, in slots recycled once the window moves past them
+        in_flight = InFlight(self.window_size)
 
         # Sliding window mechanism implementation
         start = 1  # First data packet seq_num
+        next_seq_num = 1
+        # Each outstanding packet has its own retransmission deadline
+        timers = RetransmitTimers()
+        # Fast retransmit: a packet is lost once reorder_threshold packets
+        # sent after it are acknowledged, it is resent without waiting for its RTO
+        highest_acked = 0
+        fast_scanned = 1  # seq_nums below were already checked for fast retransmit
+        last_progress = time.time()  # Last time an ACK acknowledged new data
+        backoff_until = 0.0  # Timers expiring until then are the same timeout
+        batch = []  # Datagrams queued for one batched send
+        pacer = self.pacer
+        stats = self.stats
+        trace = self.trace
+        debug = log.isEnabledFor(logging.DEBUG)
+        while True:
+            if pacer is not None:
+                pacer.set_rate(self.cc.cwnd, self.rtt.srtt, self.cc.cwnd < self.cc.ssthresh)
+            # Send new packets that fit in the window
+            input_pending = False
+            while not eof and next_seq_num < start + self.cc.window:
+                if pacer is not None and not pacer.ready(time.time()):
+                    break
+                packet = source.packet(next_seq_num)
+                if packet is None:
+                    eof = True
+                    break
+                if packet is INPUT_PENDING:
+                    input_pending = True
+                    break
+                batch.append((packet, self.receiver_addr))
+                size = packet_size(packet)
+                stats.packets_sent += 1
+                stats.bytes_sent += size
+                if debug:
+                    log.debug("Sending packet %d with %d", next_seq_num, start)
+                if trace is not None:
+                    trace("send", next_seq_num, size)
+                now = time.time()
+                in_flight.add(next_seq_num, packet, now)
+                timers.arm(next_seq_num, now + self.rtt.rto)
+                if pacer is not None:
+                    pacer.sent_packet(now)
+                next_seq_num += 1
+            if next_seq_num - start > stats.high_water:
+                stats.high_water = next_seq_num - start
 
-        print(f"Sending {self.n_packets} packets")
-
-        received = set()
-        while start <= self.n_packets:
-            end = start + self.window_size
-            if end > self.n_packets:
-                end = self.n_packets
-            for seq_num in range(start, end + 1):
-                if seq_num not in received:
-                    self.sock.sendto(packet_dict[seq_num], self.receiver_addr)
-                    print(f"Sending packet {seq_num} with {start}")
-            # Wait for ACKs
-            try:
-                ack_data, _ = self.sock.recvfrom(self.buffer_size)
-                ack_header = PacketHeader(ack_data[:16])
+            # Every packet up to EOF is acknowledged
+            if eof and start == next_seq_num:
+                break
 
-                if ack_header.type == 3 and self.verify_checksum(ack_header):
-                    # Move window
-                    print(f"Received ACK for packet {ack_header.seq_num}")
+            # Only resend packets whose own timer expired
+            now = time.time()
+            expired = timers.expired(now)
+            if expired:
+                # Loss while ACKs still arrive, timeout when nothing was
+                # acknowledged for a whole RTO
+                if now - last_progress >= self.rtt.rto:
+                    self.cc.on_timeout(next_seq_num)
+                    stats.timeouts += 1
+                else:
+                    self.cc.on_loss(expired[0], next_seq_num)
+                # Timers expiring together are one timeout, back off once per RTO
+                if now >= backoff_until:
+                    self.rtt.on_timeout()
+                    backoff_until = now + self.rtt.rto
+            for seq_num in expired:
+                packet = in_flight.resend(seq_num)
+                batch.append((packet, self.receiver_addr))
+                size = packet_size(packet)
+                stats.retransmits += 1
+                stats.bytes_sent += size
+                if debug:
+                    log.debug("Resending packet %d with %d", seq_num, start)
+                if trace is not None:
+                    trace("retransmit", seq_num, size)
+                timers.arm(seq_num, now + self.rtt.rto)
+            self.batch_io.send_batch(batch)
+            batch.clear()
+
+            # Wait for ACKs until the earliest deadline, or the next paced packet
+            deadline = timers.next_deadline()
+            paced = (pacer is not None and not eof
+                     and next_seq_num < start + self.cc.window
+                     and (deadline is None or pacer.next_release() < deadline))
+            if paced:
+                deadline = pacer.next_release()
+            # None: nothing in flight, only input of a paused stream to wait for
+            timeout = max(deadline - time.time(), 0.001) if deadline is not None else None
+            if paced and deadline - time.time() < 0.001:
+                # Too short to block on: sleep/spin, then only poll for ACKs
+                pacer.wait(deadline)
+                timeout = 0.0
+            # Also wake up for the input of a paused stream
+            if input_pending and not wait_input(self.sock, source.fileno, timeout):
+                continue
+            self.sock.settimeout(timeout)
+            try:
+                acks = self.batch_io.recv_batch()
+            except (socket.timeout, BlockingIOError):
+                # Expired packets are resent at the top of the loop
+                continue
+            valid = verify_batch(acks, self.checksum)
+            stats.checksum_failures += len(acks) - len(valid)
+            for ack_data, ack_header, _ in valid:
+                try:
+                    if ack_header.type != 3:
+                        continue
                     received_seq_num = ack_header.seq_num
+                    if ack_header.length:
+                        # SACK: everything below the cumulative base plus
+                        # the received blocks, in one update
+                        ranges = decode_sack(ack_data, ack_header.length)
+                    else:
+                        ranges = ((received_seq_num, received_seq_num + 1),)
+                except ValueError:
+                    continue
 
-                    if start <= received_seq_num:
-                        received.add(received_seq_num)
-                        # Remove all acknowledged packets
-                        while start in received:
-                            start += 1
-            except (socket.timeout, ValueError):
-                # retransmit packets
-                pass
-        
+                # Move window
+                stats.acks_received += 1
+                if debug:
+                    log.debug("Received ACK for packet %d", received_seq_num)
+                if trace is not None:
+                    trace("ack", received_seq_num, len(ack_data))
+                acked = 0
+                for begin, end in ranges:
+                    for seq_num in range(max(begin, start), min(end, next_seq_num)):
+                        sent_time = in_flight.ack(seq_num)
+                        if sent_time is False:
+                            continue
+                        acked += 1
+                        timers.cancel(seq_num)
+                        highest_acked = max(highest_acked, seq_num)
+                        # Only the packet that triggered the ACK gives an RTT sample
+                        if sent_time is not None and seq_num == received_seq_num:
+                            rtt = time.time() - sent_time
+                            self.rtt.sample(rtt)
+                            stats.record_rtt(rtt)
+                if acked:
+                    self.cc.on_ack(acked)
+                    last_progress = time.time()
+                # Recycle the slots of all acknowledged packets at the window base
+                start = in_flight.advance(start, source.release)
+
+            # Fast retransmit of the holes with enough later packets acknowledged,
+            # once each; if the copy is lost too the timer resends it. Each
+            # seq_num is checked once, from where the last pass stopped
+            now = time.time()
+            fast_end = highest_acked - self.reorder_threshold + 1
+            for seq_num in range(max(fast_scanned, start), fast_end):
+                if not in_flight.mark_fast_retransmit(seq_num):
+                    continue
+                self.cc.on_loss(seq_num, next_seq_num)
+                packet = in_flight.resend(seq_num)
+                batch.append((packet, self.receiver_addr))
+                size = packet_size(packet)
+                stats.fast_retransmits += 1
+                stats.bytes_sent += size
+                if debug:
+                    log.debug("Fast retransmit of packet %d with %d", seq_num, start)
+                if trace is not None:
+                    trace("fast_retransmit", seq_num, size)
+                timers.arm(seq_num, now + self.rtt.rto)
+            fast_scanned = max(fast_scanned, fast_end)
+        self.sock.settimeout(self.rtt.rto)
+        self.n_packets = next_seq_num - 1
+        log.info("Sent %d packets", self.n_packets)
+        if pacer is not None:
+            log.info("Pacing: %s", pacer.report())
 
     def close(self):
         """Terminate connection with END packet."""
@@ -121,142 +318,712 @@ class RTPSenderSocket:
             length=0,
             checksum=0
         )
-        end_header.checksum = compute_checksum(end_header)
+        end_header.checksum = compute_checksum(end_header, self.checksum)
 
         end_time = time.time() + 0.5
         while time.time() < end_time:
             self.sock.sendto(bytes(end_header), self.receiver_addr)
             try:
-                print("Waiting for END ACK")
+                log.debug("Waiting for END ACK")
                 ack_data, _ = self.sock.recvfrom(self.buffer_size)
-                ack_header = PacketHeader(ack_data[:16])
+                ack_header = PacketHeader.unpack_from(ack_data)
                 if (ack_header.type == 3
                     and ack_header.seq_num == end_seq_num + 1
-                        and self.verify_checksum(ack_header)):
-                    print("Connection closed")
+                        and verify_packet(ack_data, ack_header, self.checksum)):
+                    log.info("Connection closed")
                     break
-            except (socket.timeout, ValueError):
+            except socket.timeout:
+                self.rtt.on_timeout()
+                self.sock.settimeout(self.rtt.rto)
+            except ValueError:
                 pass
         self.sock.close()
 
 
+class ReceiverConnection:
+    """Receiving state of one sender, kept by RTPReceiverSocket per address."""
+
+    def __init__(self, address, sink, window_size=128, ack_every=1, ack_delay=0.002,
+                 checksum=CRC32):
+        self.address = address
+        self.checksum = checksum  # Agreed in the START handshake
+        # In-order payloads are appended to a bytearray sink or written to
+        # a stream sink, flushed once per received batch
+        self.sink = sink
+        self.deliver = sink.extend if isinstance(sink, bytearray) else sink.write
+        self.flush = getattr(sink, "flush", None)
+        self.start_seq_num = 1
+        # Out-of-order payloads only, in a ring of preallocated slots
+        self.data_buffer = ReorderBuffer(window_size)
+        self.ack_policy = DelayedAcks(ack_every, ack_delay)
+        self.sack_seq_num = None  # Latest DATA packet owed a SACK
+        self.done = False
+        self.closed_time = None
+        self.last_seen = time.time()  # Of the latest valid packet
+
+
 class RTPReceiverSocket:
-    def __init__(self, window_size=128):
+    def __init__(self, window_size=128, batch_size=1, sack=False, ack_every=1,
+                 ack_delay=0.002):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) 
         self.sock.settimeout(0.5)
         self.window_size = window_size
         self.buffer_size = 2048
+        # Room for a full window of datagrams, bursts overflow the default size
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             window_size * self.buffer_size)
+        # sendmmsg/recvmmsg batching of data packets and ACKs (Linux)
+        self.batch_io = BatchIO(self.sock, batch_size, self.buffer_size)
+        self.acks = []  # ACKs queued for one batched send
+        # Individual ACK per DATA packet, or coalesced SACKs: an individual
+        # ACK names a single packet and cannot acknowledge several
+        self.coalesce = sack or ack_every > 1
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        # One connection per sender address, so any number of senders can
+        # send to the bound port at the same time
+        self.connections = {}
+        self.owed = set()  # Connections owed a coalesced SACK
+        self.completed = deque()  # Ended connections not returned by recv() yet
+        # Of all the connections of the socket
+        self.stats = SocketStats()
+        # Optional trace(event, seq_num, length) hook, e.g. a TraceRing or a
+        # TraceWriter
+        self.trace = None
 
     # Support function to send ACK
-    def send_ack(self, ack_seq_num, address):
+    def send_ack(self, ack_seq_num, address, checksum=CRC32, payload=b""):
         ack_header = PacketHeader(
             type=3,
             seq_num=ack_seq_num,
-            length=0,
+            length=len(payload),
+            checksum=0
+        )
+        ack_header.checksum = compute_checksum(bytes(ack_header) + payload, checksum)
+        self.acks.append((bytes(ack_header) + payload, address))
+        if self.trace is not None:
+            self.trace("ack_sent", ack_seq_num, HEADER_SIZE + len(payload))
+
+    def send_sack(self, ack_seq_num, base, seq_nums, address, checksum=CRC32):
+        """Queue a SACK for ack_seq_num: the cumulative base and the blocks
+        of received seq_nums above it."""
+        payload = encode_sack(base, seq_nums)
+        ack_header = PacketHeader(
+            type=3,
+            seq_num=ack_seq_num,
+            length=len(payload),
             checksum=0
         )
-        ack_header.checksum = compute_checksum(ack_header)
-        self.sock.sendto(bytes(ack_header), address)
-
-    def verify_checksum(self, header, payload):
-        """Verify packet checksum"""
-        saved_checksum = header.checksum
-        header.checksum = 0
-        calculated = compute_checksum(bytes(header) + payload)
-        # print(f"Calculated checksum: {calculated} with saved checksum: {saved_checksum}")
-        header.checksum = saved_checksum
-        return calculated == saved_checksum
+        ack_header.checksum = compute_checksum(bytes(ack_header) + payload, checksum)
+        self.acks.append((bytes(ack_header) + payload, address))
+        if self.trace is not None:
+            self.trace("ack_sent", ack_seq_num, HEADER_SIZE + len(payload))
+
+    def flush_acks(self):
+        """Send the queued ACKs in one batch."""
+        self.stats.acks_sent += len(self.acks)
+        self.batch_io.send_batch(self.acks)
+        self.acks.clear()
 
     def bind(self, ip, port):
         self.sock.bind((ip, port))
 
     def recv(self):
-        """Return in-order data and send ACKs."""
-        # Process packets, buffer out-of-order, send ACKs (logic from receiver.py)
-        # ...
-        # print("Receiver is listening")
-        start_seq_num = 0
-        data_buffer = defaultdict(bytes)
-        received_data = bytearray()
-        connection_established = -1000  # Ensure only one sender can connect
+        """Return the in-order data and address of the next completed
+        transfer, from any sender. Other senders keep being received."""
+        while not self.completed:
+            self.completed.extend(self.poll())
+        connection = self.completed.popleft()
+        return connection.sink, connection.address
+
+    def recv_stream(self, stream):
+        """Write in-order data of the next sender to connect to a binary
+        stream and send ACKs.
+
+        Data is written as soon as the window base advances, so memory is
+        bounded by the reorder window. Other senders are still received and
+        queued for recv(). Returns the sender address at END, raises
+        ConnectionError if the sender goes silent for IDLE_TIMEOUT.
+        """
+        accepted = []
+
+        def accept(address):
+            if accepted:
+                return bytearray()
+            accepted.append(address)
+            return stream
 
         while True:
-            # print("Waiting for package")
-            try:
-                package, address = self.sock.recvfrom(self.buffer_size)
-            except socket.timeout:
-                # print("Timeout when waiting package")
-                continue
+            for connection in self.poll(accept):
+                if connection.sink is stream:
+                    return connection.address
+                self.completed.append(connection)
+            if accepted and accepted[0] not in self.connections:
+                raise ConnectionError("Sender %s:%d timed out" % accepted[0])
+
+    def serve(self, accept, on_close=None):
+        """
+        Receive from any number of senders concurrently, forever.
+
+        accept(address) returns the sink of a new sender (a bytearray or an
+        object with write()), on_close(connection) is called at its END.
+        """
+        while True:
+            for connection in self.poll(accept):
+                if on_close is not None:
+                    on_close(connection)
 
+    def poll(self, accept=None):
+        """
+        Receive one batch of packets from any sender, send the ACKs owed and
+        return the connections that ended in it. accept(address) returns
+        the sink of a new connection, a bytearray by default.
+        """
+        # Process packets, buffer out-of-order, send ACKs (logic from receiver.py)
+        now = time.time()
+        # Forget finished connections once their END ACK cannot be needed,
+        # and the connections of senders that went silent
+        for address, connection in list(self.connections.items()):
+            if connection.done:
+                if now - connection.closed_time > LINGER:
+                    del self.connections[address]
+            elif now - connection.last_seen > IDLE_TIMEOUT:
+                log.warning("Connection from %s:%d timed out", *address)
+                self.owed.discard(connection)
+                del self.connections[address]
+
+        # Wake up when the first delayed ACK timer expires
+        timeout = 0.5
+        for connection in self.owed:
+            timeout = connection.ack_policy.timeout(timeout)
+        self.sock.settimeout(timeout)
+        try:
+            batch = self.batch_io.recv_batch()
+        except socket.timeout:
+            # print("Timeout when waiting package")
+            batch = ()
+
+        finished = []
+        stats = self.stats
+        trace = self.trace
+        for package, address in batch:
             # print("Received package")
             # Check valid package
             if (len(package) < 16):
                 # print("Invalid length packet")
+                stats.checksum_failures += 1
                 continue
 
             try:
-                header = PacketHeader(package[:16])
-            except ValueError:  
+                header = PacketHeader.unpack_from(package)
+            except ValueError:
                 # Wrong format
                 # print("Wrong format packet")
+                stats.checksum_failures += 1
                 continue
 
-            # Ensure payload only contains data
-            # print(f"Received package type: {header.type} Reading payload")
+            # Ensure payload only contains data; package is a view into
+            # the receive buffer, so slicing it does not copy
             payload = package[16:16+header.length]
 
-            # Drop package if checksum is invalid
-            if not self.verify_checksum(header, payload):
-                # print(f"Invalid checksum: {header.checksum} with {header.seq_num}")
-                if connection_established == address:
-                    self.send_ack(start_seq_num, address)
-                continue
+            connection = self.connections.get(address)
 
-            # print("Valid package")
+            # Drop package if checksum is invalid, in the algorithm of its
+            # connection (STARTs are always crc32)
+            if not verify_packet(package, header,
+                                 connection.checksum if connection is not None else CRC32):
+                # No ACK: an ACK names one received packet, and start_seq_num
+                # has not been received yet
+                stats.checksum_failures += 1
+                if trace is not None:
+                    trace("checksum_failure", header.seq_num, len(package))
+                continue
 
-            # Start handshake
-            if header.type == 0 and not connection_established == address:
-                # print("Start handshake")
+            # Start handshake: a new sender, or a finished one reconnecting.
+            # A resent START is ACKed again
+            if header.type == 0:
                 if header.seq_num == 0:
-                    self.send_ack(1, address)
-                    connection_established = address
-                    start_seq_num = 1
+                    if connection is None or connection.done:
+                        sink = accept(address) if accept is not None else bytearray()
+                        connection = ReceiverConnection(
+                            address, sink, self.window_size, self.ack_every, self.ack_delay,
+                            accept_checksum(package, header))
+                        self.connections[address] = connection
+                        log.info("Connection from %s:%d, checksum %s", *address,
+                                 connection.checksum.name)
+                    # The START ACK is crc32 and echoes the checksum taken
+                    self.send_ack(1, address, payload=checksum_offer(connection.checksum))
                 continue
 
-            if header.type == 0 and connection_established == address:
-                if header.seq_num == 0:  # Resend ACK
-                    # print("Resend start ACK")
-                    self.send_ack(1, address)
-                    continue
+            if connection is None:
+                continue
+            connection.last_seen = now
 
             # Data transmission
-            if header.type == 2 and connection_established == address:
+            if header.type == 2 and not connection.done:
                 seq_num = header.seq_num
-                # print(f"Data transmission with seq_num: {seq_num} with {start_seq_num}")
+                start_seq_num = connection.start_seq_num
+                data_buffer = connection.data_buffer
+                stats.packets_received += 1
+                stats.bytes_received += header.length
 
                 if seq_num < start_seq_num + self.window_size:
-                    self.send_ack(seq_num, address)
-                    if seq_num >= start_seq_num:
-                        if seq_num not in data_buffer:
-                            data_buffer[seq_num] = payload
-
-                        # In order delivery
-                        while start_seq_num in data_buffer:
-                            # print(f"Received packet {start_seq_num}")
-                            received_data.extend(data_buffer[start_seq_num])
-                            del data_buffer[start_seq_num]
-                            start_seq_num += 1
-                # Drop out of window packets seq_num >= start_seq_num + window_size case
-            # End handshake
-            if header.type == 1 and connection_established == address:
-                # print("End handshake")
-                # print(f"Header seq_num: {header.seq_num} with {start_seq_num}")
-                if header.seq_num == start_seq_num:
-                    self.send_ack(start_seq_num + 1, address)
-                    break
-        return received_data, address        
-        
+                    if trace is not None:
+                        trace("data" if seq_num >= start_seq_num else "duplicate", seq_num,
+                              len(package))
+                    if self.coalesce:
+                        # In order: the window base with no gap behind it
+                        connection.ack_policy.on_data(
+                            seq_num == start_seq_num and not data_buffer.count)
+                        connection.sack_seq_num = seq_num
+                        self.owed.add(connection)
+                    else:
+                        self.send_ack(seq_num, address, connection.checksum)
+                    if seq_num == start_seq_num:
+                        # In-order packet, delivered straight from the receive buffer
+                        connection.deliver(payload)
+                        start_seq_num += 1
+                        # Then the buffered packets behind it
+                        if data_buffer.count:
+                            start_seq_num = data_buffer.drain(start_seq_num, connection.deliver)
+                        connection.start_seq_num = start_seq_num
+                    elif seq_num > start_seq_num:
+                        # Copied into its slot, the receive buffer is reused by the next batch
+                        data_buffer.store(seq_num, payload)
+                        if data_buffer.count > stats.high_water:
+                            stats.high_water = data_buffer.count
+                    else:
+                        stats.duplicates += 1
+                else:
+                    # Drop out of window packets seq_num >= start_seq_num + window_size case
+                    stats.out_of_window += 1
+                    if trace is not None:
+                        trace("out_of_window", seq_num, len(package))
+
+            # End handshake, a resent END of a finished connection is ACKed again
+            elif header.type == 1 and header.seq_num == connection.start_seq_num:
+                self.send_ack(connection.start_seq_num + 1, address, connection.checksum)
+                if not connection.done:
+                    connection.done = True
+                    connection.closed_time = now
+                    finished.append(connection)
+                    log.info("Connection from %s:%d closed", *address)
+
+        # One SACK per connection covers the whole batch, or several when delayed
+        for connection in [connection for connection in self.owed
+                           if connection.ack_policy.due()]:
+            self.send_sack(connection.sack_seq_num, connection.start_seq_num,
+                           connection.data_buffer.seq_nums(connection.start_seq_num),
+                           connection.address, connection.checksum)
+            connection.ack_policy.sent()
+            connection.sack_seq_num = None
+            self.owed.discard(connection)
+        # One batched send for the ACKs of the whole batch
+        self.flush_acks()
+        for connection in self.connections.values():
+            if connection.flush is not None and (not connection.done or connection in finished):
+                connection.flush()
+        return finished
+
+    def close(self):
+        self.sock.close()
+
+
+class _SessionLoop(threading.Thread):
+    """
+    Receive thread of a socket carrying RTPConnections: passes each packet
+    to the connection of its address and runs their timers.
+    """
+
+    def __init__(self, sock, on_start=None):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.connections = {}
+        # Called under the lock with the address and checksum of a new
+        # START (listener), returns its connection
+        self.on_start = on_start
+        self.lock = threading.Lock()  # Guards the state of every connection
+        self.running = True
+        self.buffer_size = 2048
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                now = time.time()
+                # Short sleep cap: timers armed by send() are picked up late
+                # by at most this much
+                timeout = 0.01
+                for address, connection in list(self.connections.items()):
+                    if self.on_start is not None and now - connection.last_seen > IDLE_TIMEOUT:
+                        # Accepted session whose peer went silent: closed
+                        log.warning("Session with %s:%d timed out", *address)
+                        connection.peer_closed = True
+                        connection.changed.notify_all()
+                        del self.connections[address]
+                        continue
+                    timeout = min(timeout, connection._tick(now))
+            self.sock.settimeout(max(timeout, 0.0001))
+            try:
+                package, address = self.sock.recvfrom(self.buffer_size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break  # Socket closed
+            try:
+                header = PacketHeader.unpack_from(package)
+            except ValueError:
+                continue
+            with self.lock:
+                connection = self.connections.get(address)
+                # START packets are checked with crc32, the others with the
+                # checksum of their session
+                if not verify_packet(package, header,
+                                     CRC32 if connection is None else connection.checksum):
+                    continue
+                if connection is not None:
+                    connection.last_seen = time.time()
+                if header.type == 0:
+                    if header.seq_num == 0 and self.on_start is not None:
+                        if connection is None or connection.peer_closed:
+                            connection = self.on_start(address, accept_checksum(package, header))
+                        # Echoes the checksum taken, in crc32 like every START ACK
+                        self.sock.sendto(_ack_packet(1, checksum_offer(connection.checksum)),
+                                         address)
+                elif connection is not None:
+                    connection._on_packet(header, package)
+
+    def stop(self):
+        self.running = False
+
+
+def _ack_packet(ack_seq_num, payload=b"", checksum=CRC32):
+    ack_header = PacketHeader(
+        type=3,
+        seq_num=ack_seq_num,
+        length=len(payload),
+        checksum=0
+    )
+    ack_header.checksum = compute_checksum(bytes(ack_header) + payload, checksum)
+    return bytes(ack_header) + payload
+
+
+class RTPConnection:
+    """
+    Long-lived bidirectional session carrying framed messages.
+
+    After one START handshake both ends send() and recv() any number of
+    messages over the same socket. Every SESSION DATA packet carries the
+    cumulative ACK of the other direction, so a request is acknowledged by
+    its response; separate SACKs are only sent when no data goes back
+    within ack_delay, or at once for out-of-order packets.
+
+        conn = RTPConnection.connect("localhost", 40000)
+        conn.send(b"request")
+        response = conn.recv()
+        conn.close()
+
+    The server side comes from RTPListener.accept().
+    """
+
+    def __init__(self, sock, address, loop, window_size=128, congestion="none",
+                 ack_every=2, ack_delay=0.005, reorder_threshold=3, checksum=CRC32):
+        self.sock = sock
+        self.address = address
+        self.checksum = checksum  # Agreed in the START handshake
+        self.loop = loop
+        self.lock = loop.lock
+        self.changed = threading.Condition(self.lock)
+        self.window_size = window_size
+        self.chunk_size = 1472 - 16 - SESSION_HEADER.size
+        self.rtt = RTTEstimator()
+        # Congestion window, capped by the receiver window (window_size)
+        self.cc = CONGESTION_CONTROLS[congestion](window_size)
+        self.reorder_threshold = reorder_threshold
+
+        # Sending direction
+        self.outgoing = deque()  # (chunk, flags) waiting for window room
+        self.packets = {}  # (chunk, flags) of the packets in flight
+        self.timers = RetransmitTimers()
+        # Send time of packets sent only once, used for RTT samples (Karn's rule)
+        self.send_times = {}
+        self.acked = set()  # Selectively acknowledged above send_base
+        self.fast_scanned = 1  # seq_nums below were already checked for fast retransmit
+        self.send_base = 1
+        self.next_seq_num = 1
+        self.highest_acked = 0
+        self.last_progress = time.time()
+        self.backoff_until = 0.0
+
+        # Receiving direction
+        self.start_seq_num = 1
+        self.data_buffer = {}  # Out-of-order (flags, payload) only
+        self.message = bytearray()  # Message being reassembled
+        self.messages = deque()  # Complete messages not returned by recv() yet
+        self.ack_policy = DelayedAcks(ack_every, ack_delay)
+        self.sack_seq_num = None  # Latest DATA packet owed an ACK
+
+        self.closing = False
+        self.end_acked = False
+        self.peer_closed = False
+        self.last_seen = time.time()  # Of the latest valid packet
+
+    @classmethod
+    def connect(cls, ip, port, window_size=128, congestion="none", ack_every=2,
+                ack_delay=0.005, checksum="crc32"):
+        """Open a session to an RTPListener (START handshake, offering checksum)."""
+        sender = RTPSenderSocket(window_size, checksum=checksum)
+        sender.connect(ip, port)
+        # Replies come from the resolved address
+        address = (socket.gethostbyname(ip), port)
+        loop = _SessionLoop(sender.sock)
+        connection = cls(sender.sock, address, loop, window_size, congestion,
+                         ack_every, ack_delay, checksum=sender.checksum)
+        connection.rtt = sender.rtt
+        loop.connections[address] = connection
+        loop.start()
+        return connection
+
+    def send(self, message):
+        """Queue a message; it is sent as soon as the window has room.
+
+        Does not wait for the ACK, see flush().
+        """
+        message = memoryview(message)
+        with self.lock:
+            if self.closing or self.peer_closed:
+                raise ConnectionError("Connection closed")
+            # An empty message is one empty packet with END_OF_MESSAGE
+            offsets = range(0, max(len(message), 1), self.chunk_size)
+            for offset in offsets:
+                flags = END_OF_MESSAGE if offset == offsets[-1] else 0
+                self.outgoing.append((bytes(message[offset:offset + self.chunk_size]), flags))
+            self._transmit()
+
+    def recv(self, timeout=None):
+        """Return the next message, or None once the peer has closed.
+
+        Raises socket.timeout if no message arrives within timeout.
+        """
+        with self.changed:
+            if not self.changed.wait_for(lambda: self.messages or self.peer_closed, timeout):
+                raise socket.timeout("No message received")
+            if self.messages:
+                return self.messages.popleft()
+            return None
+
+    def flush(self, timeout=None):
+        """Wait until every message sent so far is acknowledged (or the
+        peer has closed the session)."""
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: self.peer_closed
+                or (not self.outgoing and self.send_base == self.next_seq_num), timeout)
+
+    def close(self, timeout=None):
+        """Flush, then terminate the session with an END packet.
+
+        Messages still unacknowledged after timeout seconds are given up,
+        by default three retransmissions at the maximum RTO, so a dead peer
+        does not block close() forever.
+        """
+        if timeout is None:
+            timeout = 3 * self.rtt.max_rto
+        if not self.flush(timeout):
+            log.warning("Session with %s:%d closed with unacknowledged data", *self.address)
+        end_packet = PacketHeader(type=1, seq_num=self.next_seq_num, length=0, checksum=0)
+        end_packet.checksum = compute_checksum(end_packet, self.checksum)
+        with self.changed:
+            self.closing = True
+            # END handshake, given up after 0.5 s like RTPSenderSocket; not
+            # needed if the peer has closed the session already
+            end_time = time.time() + 0.5
+            while not self.end_acked and not self.peer_closed and time.time() < end_time:
+                self.sock.sendto(bytes(end_packet), self.address)
+                self.changed.wait(min(self.rtt.rto, max(end_time - time.time(), 0)))
+            if self.loop.on_start is None:
+                # Client side: the socket and its thread belong to this connection
+                self.loop.stop()
+            if self.loop.connections.get(self.address) is self:
+                del self.loop.connections[self.address]
+        if self.loop.on_start is None:
+            self.loop.join()
+            self.sock.close()
+
+    # The methods below run with the lock held
+
+    def _data_packet(self, seq_num):
+        chunk, flags = self.packets[seq_num]
+        # The cumulative ACK is the current one, also on retransmission
+        payload = SESSION_HEADER.pack(self.start_seq_num, flags) + chunk
+        header = PacketHeader(type=4, seq_num=seq_num, length=len(payload), checksum=0)
+        header.checksum = compute_checksum(bytes(header) + payload, self.checksum)
+        return bytes(header) + payload
+
+    def _send_data(self, seq_num):
+        self.sock.sendto(self._data_packet(seq_num), self.address)
+        self.timers.arm(seq_num, time.time() + self.rtt.rto)
+        if not self.data_buffer:
+            # Piggybacked ACK, nothing out of order to report
+            self.ack_policy.sent()
+            self.sack_seq_num = None
+
+    def _transmit(self):
+        """Send queued chunks that fit in the window."""
+        while self.outgoing and self.next_seq_num < self.send_base + self.cc.window:
+            seq_num = self.next_seq_num
+            self.next_seq_num += 1
+            self.packets[seq_num] = self.outgoing.popleft()
+            self.send_times[seq_num] = time.time()
+            self._send_data(seq_num)
+
+    def _retransmit(self, seq_num):
+        self.send_times.pop(seq_num, None)
+        self._send_data(seq_num)
+
+    def _tick(self, now):
+        """Run the expired timers, return the time until the next one."""
+        for seq_num in self.timers.expired(now):
+            # Loss while ACKs still arrive, timeout when nothing was
+            # acknowledged for a whole RTO
+            if now - self.last_progress >= self.rtt.rto:
+                self.cc.on_timeout(self.next_seq_num)
+            else:
+                self.cc.on_loss(seq_num, self.next_seq_num)
+            # Timers expiring together are one timeout, back off once per RTO
+            if now >= self.backoff_until:
+                self.rtt.on_timeout()
+                self.backoff_until = now + self.rtt.rto
+            self._retransmit(seq_num)
+        if self.sack_seq_num is not None and self.ack_policy.due():
+            self._send_sack()
+        timeout = self.ack_policy.timeout(0.5)
+        deadline = self.timers.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, deadline - now)
+        return timeout
+
+    def _send_sack(self):
+        payload = encode_sack(self.start_seq_num, self.data_buffer)
+        self.sock.sendto(_ack_packet(self.sack_seq_num, payload, self.checksum), self.address)
+        self.ack_policy.sent()
+        self.sack_seq_num = None
+
+    def _on_packet(self, header, package):
+        try:
+            if header.type == 3 and header.length:
+                self._on_ack(header.seq_num, decode_sack(package, header.length))
+            elif header.type == 3:
+                # END ACK
+                if self.closing and header.seq_num == self.next_seq_num + 1:
+                    self.end_acked = True
+                    self.changed.notify_all()
+            elif header.type == 4 and header.length >= SESSION_HEADER.size:
+                ack, flags = SESSION_HEADER.unpack_from(package, HEADER_SIZE)
+                self._on_ack(None, ((0, ack),))
+                self._on_data(header.seq_num, flags,
+                              package[HEADER_SIZE + SESSION_HEADER.size:HEADER_SIZE + header.length])
+            elif header.type == 1 and header.seq_num == self.start_seq_num:
+                self.sock.sendto(_ack_packet(self.start_seq_num + 1, checksum=self.checksum),
+                                 self.address)
+                self.peer_closed = True
+                self.changed.notify_all()
+        except ValueError:
+            pass  # Malformed SACK
+
+    def _on_data(self, seq_num, flags, payload):
+        if seq_num >= self.start_seq_num + self.window_size:
+            return  # Out of window
+        # In order: the window base with no gap behind it
+        self.ack_policy.on_data(seq_num == self.start_seq_num and not self.data_buffer)
+        self.sack_seq_num = seq_num
+        if seq_num == self.start_seq_num:
+            self._deliver(flags, payload)
+            # Then the buffered packets behind it
+            while self.start_seq_num in self.data_buffer:
+                self._deliver(*self.data_buffer.pop(self.start_seq_num))
+        elif seq_num > self.start_seq_num and seq_num not in self.data_buffer:
+            self.data_buffer[seq_num] = (flags, bytes(payload))
+        if self.ack_policy.due():
+            self._send_sack()
+
+    def _deliver(self, flags, payload):
+        self.start_seq_num += 1
+        self.message += payload
+        if flags & END_OF_MESSAGE:
+            self.messages.append(bytes(self.message))
+            self.message = bytearray()
+            self.changed.notify_all()
+
+    def _on_ack(self, received_seq_num, ranges):
+        now = time.time()
+        acked = 0
+        for begin, end in ranges:
+            for seq_num in range(max(begin, self.send_base), min(end, self.next_seq_num)):
+                if seq_num in self.acked:
+                    continue
+                self.acked.add(seq_num)
+                acked += 1
+                self.timers.cancel(seq_num)
+                self.highest_acked = max(self.highest_acked, seq_num)
+                sent_time = self.send_times.pop(seq_num, None)
+                # A SACK samples the packet that triggered it, a piggybacked
+                # ACK the highest packet it covers
+                if sent_time is not None and seq_num == (received_seq_num or end - 1):
+                    self.rtt.sample(now - sent_time)
+        if not acked:
+            return
+        self.cc.on_ack(acked)
+        self.last_progress = now
+        # Move window
+        while self.send_base in self.acked:
+            self.acked.remove(self.send_base)
+            del self.packets[self.send_base]
+            self.send_base += 1
+        # Fast retransmit of the holes with enough later packets acknowledged,
+        # each seq_num checked once, from where the last pass stopped
+        fast_end = self.highest_acked - self.reorder_threshold + 1
+        for seq_num in range(max(self.fast_scanned, self.send_base), fast_end):
+            if seq_num in self.acked:
+                continue
+            self.cc.on_loss(seq_num, self.next_seq_num)
+            self._retransmit(seq_num)
+        self.fast_scanned = max(self.fast_scanned, fast_end)
+        self._transmit()
+        self.changed.notify_all()
+
+
+class RTPListener:
+    """
+    Accepts RTPConnections from any number of peers on one bound port. A
+    session that receives nothing for IDLE_TIMEOUT is closed, as if its
+    peer had ended it.
+    """
+
+    def __init__(self, window_size=128, congestion="none", ack_every=2, ack_delay=0.005):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, window_size * 2048)
+        self.options = (window_size, congestion, ack_every, ack_delay)
+        self.loop = _SessionLoop(self.sock, self._on_start)
+        self.backlog = queue.Queue()
+
+    def bind(self, ip, port):
+        self.sock.bind((ip, port))
+        self.loop.start()
+
+    def _on_start(self, address, checksum):
+        connection = RTPConnection(self.sock, address, self.loop, *self.options,
+                                   checksum=checksum)
+        self.loop.connections[address] = connection
+        self.backlog.put(connection)
+        return connection
+
+    def accept(self):
+        """Wait for a new session, return (connection, address)."""
+        connection = self.backlog.get()
+        return connection, connection.address
 
     def close(self):
+        self.loop.stop()
         self.sock.close()
@@ -1,15 +1,40 @@
 from rtp_socket import RTPSenderSocket
+from stripe import send_striped
+from utils import CHECKSUMS, CONGESTION_CONTROLS, TraceWriter
 import sys
 import argparse
+import logging
 
-def sender(receiver_ip, receiver_port, window_size):
-    rtp_socket = RTPSenderSocket(window_size)
+def sender(receiver_ip, receiver_port, window_size, batch_size=1, file_path=None,
+           congestion="none", cc_trace=False, pacing=False, reorder_threshold=3, streams=1,
+           checksum="crc32", stats=False, trace_path=None):
+    if streams > 1:
+        # One flow per worker process and port, see stripe.py
+        send_striped(receiver_ip, receiver_port, window_size, streams, file_path,
+                     batch_size=batch_size, congestion=congestion, pacing=pacing,
+                     reorder_threshold=reorder_threshold, checksum=checksum)
+        return
+    rtp_socket = RTPSenderSocket(window_size, batch_size, congestion, pacing,
+                                 reorder_threshold, checksum)
+    if cc_trace:
+        rtp_socket.cc.trace = lambda event, state: print(
+            f"cc {event}: {state}", file=sys.stderr)
+    if trace_path is not None:
+        rtp_socket.trace = TraceWriter(trace_path)
     rtp_socket.connect(receiver_ip, receiver_port)
     
-    data = sys.stdin.buffer.read()
-    rtp_socket.send(data)
+    if file_path is not None:
+        # Regular file: send slices of an mmap of it
+        rtp_socket.sendfile(file_path)
+    else:
+        # Stream stdin instead of reading it all into memory
+        rtp_socket.send_stream(sys.stdin.buffer)
     
     rtp_socket.close()
+    if trace_path is not None:
+        rtp_socket.trace.close()
+    if stats:
+        print(f"Stats: {rtp_socket.stats.report()}", file=sys.stderr)
     
     
 def main():
@@ -23,9 +48,64 @@ def main():
     parser.add_argument(
         "window_size", type=int, help="Maximum number of outstanding packets"
     )
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Datagrams per sendmmsg/recvmmsg call (1 disables batching)"
+    )
+    parser.add_argument(
+        "--file", dest="file_path",
+        help="Send this regular file through mmap instead of reading stdin"
+    )
+    parser.add_argument(
+        "--cc", choices=sorted(CONGESTION_CONTROLS), default="none",
+        help="Congestion control, none (the default) keeps a fixed window of window_size"
+    )
+    parser.add_argument(
+        "--cc-trace", action="store_true",
+        help="Print the congestion control state on every loss and timeout"
+    )
+    parser.add_argument(
+        "--pacing", action="store_true",
+        help="Pace new packets at cwnd/SRTT instead of sending window bursts"
+    )
+    parser.add_argument(
+        "--reorder-threshold", type=int, default=3,
+        help="Resend a packet once this many later packets are acknowledged"
+    )
+    parser.add_argument(
+        "--streams", type=int, default=1,
+        help="Stripe the data over this many flows (ports receiver_port and up), "
+             "one process each; the receiver needs the same --streams"
+    )
+    parser.add_argument(
+        "--checksum", choices=sorted(CHECKSUMS), default="crc32",
+        help="Checksum to offer in the START handshake (crc32 if the receiver declines)"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+        help="DEBUG logs every packet, which slows the transfer down"
+    )
+    parser.add_argument(
+        "--stats", action="store_true",
+        help="Print the counters of the socket at the end"
+    )
+    parser.add_argument(
+        "--trace", dest="trace_path",
+        help="Record a binary packet trace to this file (see trace_analyze.py)"
+    )
     args = parser.parse_args()
+    if args.streams > 1:
+        # The flows run in worker processes, each with its own socket
+        for option, value in (("--stats", args.stats), ("--trace", args.trace_path),
+                              ("--cc-trace", args.cc_trace)):
+            if value:
+                parser.error(f"{option} is not supported with --streams")
+    # On stderr, stdout may carry the data
+    logging.basicConfig(level=args.log_level, format="%(message)s")
 
-    sender(args.receiver_ip, args.receiver_port, args.window_size)
+    sender(args.receiver_ip, args.receiver_port, args.window_size, args.batch_size,
+           args.file_path, args.cc, args.cc_trace, args.pacing, args.reorder_threshold,
+           args.streams, args.checksum, args.stats, args.trace_path)
 
 
 if __name__ == "__main__":
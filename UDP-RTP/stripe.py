@@ -0,0 +1,148 @@
+"""
+Striped transfers: one payload split across several RTP flows.
+
+The payload is cut into SEGMENT_SIZE segments dealt round-robin to
+`streams` flows, flow i carrying segments i, i + streams, ... on port
+base_port + i. Each flow is an ordinary RTP transfer run by its own
+worker process, so the protocol work of a transfer scales over cores.
+The receiving workers write every segment straight to its offset in the
+output file with pwrite(), so reassembly needs no extra pass.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from rtp_socket import RTPReceiverSocket, RTPSenderSocket
+
+# Whole DATA packets (1456 bytes of payload) per segment, so segments
+# never split a packet
+SEGMENT_SIZE = 1456 * 256
+
+
+def _flow_offset(offset, flow, streams):
+    """Offset in the payload of byte `offset` of flow `flow`."""
+    segment, within = divmod(offset, SEGMENT_SIZE)
+    return (segment * streams + flow) * SEGMENT_SIZE + within
+
+
+class StripeReader:
+    """Binary stream of the segments of one flow, read from a file with pread."""
+
+    def __init__(self, fd, flow, streams):
+        self.fd = fd
+        self.flow = flow
+        self.streams = streams
+        self.offset = 0  # Bytes of this flow read so far
+
+    def readinto(self, buffer):
+        # Stop at the end of the segment, the next one is further on
+        length = min(len(buffer), SEGMENT_SIZE - self.offset % SEGMENT_SIZE)
+        length = os.preadv(self.fd, [memoryview(buffer)[:length]],
+                           _flow_offset(self.offset, self.flow, self.streams))
+        self.offset += length
+        return length
+
+
+class StripeWriter:
+    """Binary stream of one flow, written to its segments of a file with pwrite."""
+
+    def __init__(self, fd, flow, streams):
+        self.fd = fd
+        self.flow = flow
+        self.streams = streams
+        self.offset = 0  # Bytes of this flow written so far
+
+    def write(self, data):
+        data = memoryview(data)
+        written = len(data)
+        while data:
+            length = min(len(data), SEGMENT_SIZE - self.offset % SEGMENT_SIZE)
+            os.pwrite(self.fd, data[:length],
+                      _flow_offset(self.offset, self.flow, self.streams))
+            self.offset += length
+            data = data[length:]
+        return written
+
+    def flush(self):
+        pass
+
+
+def _send_flow(path, flow, streams, receiver_ip, receiver_port, window_size,
+               options):
+    rtp_socket = RTPSenderSocket(window_size, **options)
+    rtp_socket.connect(receiver_ip, receiver_port + flow)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        rtp_socket.send_stream(StripeReader(fd, flow, streams))
+    finally:
+        os.close(fd)
+    rtp_socket.close()
+
+
+def _recv_flow(path, flow, streams, receiver_ip, receiver_port, window_size,
+               options):
+    rtp_socket = RTPReceiverSocket(window_size, **options)
+    rtp_socket.bind(receiver_ip, receiver_port + flow)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        rtp_socket.recv_stream(StripeWriter(fd, flow, streams))
+    finally:
+        os.close(fd)
+    rtp_socket.close()
+
+
+def send_striped(receiver_ip, receiver_port, window_size, streams, file_path=None,
+                 **options):
+    """
+    Send a regular file (or stdin, spooled to a temporary file first) over
+    `streams` flows to receiver_port .. receiver_port + streams - 1.
+    options are passed to each RTPSenderSocket.
+    """
+    spool = None
+    if file_path is None:
+        # Every worker reads its own segments, which needs a seekable file
+        spool = tempfile.NamedTemporaryFile()
+        shutil.copyfileobj(sys.stdin.buffer, spool)
+        spool.flush()
+        file_path = spool.name
+    try:
+        with ProcessPoolExecutor(max_workers=streams) as executor:
+            flows = [executor.submit(_send_flow, file_path, flow, streams, receiver_ip,
+                                     receiver_port, window_size, options)
+                     for flow in range(streams)]
+            for flow in flows:
+                flow.result()
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def recv_striped(receiver_ip, receiver_port, window_size, streams, output_path=None,
+                 **options):
+    """
+    Receive a striped transfer on receiver_port .. receiver_port + streams - 1
+    into output_path, or stdout (through a temporary file) if None.
+    options are passed to each RTPReceiverSocket.
+    """
+    spool = None
+    if output_path is None:
+        spool = tempfile.NamedTemporaryFile()
+        output_path = spool.name
+    else:
+        open(output_path, "wb").close()
+    try:
+        with ProcessPoolExecutor(max_workers=streams) as executor:
+            flows = [executor.submit(_recv_flow, output_path, flow, streams, receiver_ip,
+                                     receiver_port, window_size, options)
+                     for flow in range(streams)]
+            for flow in flows:
+                flow.result()
+        if spool is not None:
+            spool.seek(0)
+            shutil.copyfileobj(spool, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+    finally:
+        if spool is not None:
+            spool.close()
@@ -0,0 +1,78 @@
+"""
+Packets/sec per core of utils.BatchIO for several batch sizes.
+
+Each round sends a burst of DATA-sized datagrams over loopback and then
+drains it; send and receive CPU time (time.process_time) are measured
+separately. batch_size=1 is the per-packet sendto/recvfrom path.
+
+Usage: python bench_batch_io.py [FOLDER_PATH] [--packets N] [--batch-sizes 1 8 32 64]
+"""
+import argparse
+import os
+import socket
+import sys
+import time
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def bench(utils, batch_size, packets, burst, size):
+    tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, burst * 4096)
+    rx.bind(("127.0.0.1", 0))
+    rx.settimeout(0.5)
+    tx.settimeout(0.5)
+    address = rx.getsockname()
+    tx_io = utils.BatchIO(tx, batch_size)
+    rx_io = utils.BatchIO(rx, batch_size)
+    payload = os.urandom(size)
+    datagrams = [(payload, address)] * burst
+
+    send_cpu = recv_cpu = 0.0
+    sent = received = 0
+    while sent < packets:
+        begin = time.process_time()
+        tx_io.send_batch(datagrams)
+        send_cpu += time.process_time() - begin
+        sent += burst
+
+        begin = time.process_time()
+        got = 0
+        try:
+            while got < burst:
+                got += len(rx_io.recv_batch())
+        except socket.timeout:
+            pass
+        recv_cpu += time.process_time() - begin
+        received += got
+    tx.close()
+    rx.close()
+    return sent / send_cpu, received / recv_cpu, received / sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "folder_path", nargs="?", default=os.path.join(DIR, "..", "UDP-RTP"),
+        help="Folder containing the utils.py to benchmark",
+    )
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--burst", type=int, default=128)
+    parser.add_argument("--size", type=int, default=1472)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.realpath(args.folder_path))
+    import utils
+
+    print(f"sendmmsg/recvmmsg available: {utils._libc is not None}")
+    print(f"{'batch':>6} {'send pkt/s/core':>16} {'recv pkt/s/core':>16} {'delivered':>10}")
+    for batch_size in args.batch_sizes:
+        send_pps, recv_pps, delivered = bench(
+            utils, batch_size, args.packets, args.burst, args.size)
+        print(f"{batch_size:>6} {send_pps:>16,.0f} {recv_pps:>16,.0f} {delivered:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
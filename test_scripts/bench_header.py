@@ -0,0 +1,121 @@
+"""
+Microbenchmark: header encode/decode with the struct codec vs scapy.
+
+Usage: python bench_header.py [FOLDER_PATH] [-n ITERATIONS]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_utils(folder_path):
+    sys.path.insert(0, os.path.realpath(folder_path))
+    import utils
+    return utils
+
+
+def scapy_header():
+    """The original scapy based header, only if scapy is installed."""
+    try:
+        from scapy.all import IntField, Packet
+    except ImportError:
+        return None
+
+    class ScapyPacketHeader(Packet):
+        name = "PacketHeader"
+        fields_desc = [
+            IntField("type", 0),
+            IntField("seq_num", 0),
+            IntField("length", 0),
+            IntField("checksum", 0),
+        ]
+
+    return ScapyPacketHeader
+
+
+def run(label, stmt, number, env):
+    seconds = timeit.timeit(stmt, number=number, globals=env)
+    print(f"{label:<34} {seconds / number * 1e9:10.1f} ns/op")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "folder_path", nargs="?", default=os.path.join(DIR, "..", "UDP-RTP"),
+        help="Folder containing the utils.py to benchmark",
+    )
+    parser.add_argument("-n", "--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    utils = load_utils(args.folder_path)
+    payload = os.urandom(1456)
+    buffer = bytearray(utils.HEADER_SIZE + len(payload))
+    env = {
+        "PacketHeader": utils.PacketHeader,
+        "compute_checksum": utils.compute_checksum,
+        "payload": payload,
+        "buffer": buffer,
+        "raw": bytes(utils.PacketHeader(type=2, seq_num=7, length=1456, checksum=1)),
+    }
+
+    print("struct codec")
+    run("  encode bytes(header)",
+        "bytes(PacketHeader(type=2, seq_num=7, length=1456, checksum=0))",
+        args.number, env)
+    run("  encode pack_into",
+        "PacketHeader(type=2, seq_num=7, length=1456, checksum=0)"
+        ".pack_into(buffer)", args.number, env)
+    run("  decode unpack_from", "PacketHeader.unpack_from(raw)",
+        args.number, env)
+    run("  DATA packet + checksum",
+        "h = PacketHeader(type=2, seq_num=7, length=1456, checksum=0)\n"
+        "h.checksum = compute_checksum(bytes(h) + payload)\n"
+        "bytes(h) + payload", args.number, env)
+    if hasattr(utils, "build_packet"):
+        buffer[utils.HEADER_SIZE:] = payload
+        env["build_packet"] = utils.build_packet
+        run("  DATA packet build_packet",
+            "build_packet(buffer, 2, 7, 1456)", args.number, env)
+
+    if hasattr(utils, "CHECKSUMS"):
+        # A received batch of 64 DATA packets, verified one by one and in
+        # one verify_batch() pass, for each checksum available
+        batch_size = 64
+        print(f"checksums (batch of {batch_size})")
+        for name, checksum in sorted(utils.CHECKSUMS.items()):
+            packet = bytes(utils.build_packet(bytearray(buffer), 2, 7, 1456, checksum))
+            batch = [(packet, None)] * batch_size
+            env.update(checksum=checksum, packet=packet, batch=batch,
+                       verify_packet=utils.verify_packet, verify_batch=utils.verify_batch)
+            run(f"  {name} build_packet",
+                "build_packet(buffer, 2, 7, 1456, checksum)", args.number, env)
+            run(f"  {name} verify_packet x{batch_size}",
+                "for p, _ in batch:\n"
+                "    verify_packet(p, PacketHeader.unpack_from(p), checksum)",
+                max(1, args.number // batch_size), env)
+            run(f"  {name} verify_batch x{batch_size}",
+                "verify_batch(batch, checksum)",
+                max(1, args.number // batch_size), env)
+
+    ScapyPacketHeader = scapy_header()
+    if ScapyPacketHeader is None:
+        print("scapy not installed, skipping scapy path")
+        return
+    env["PacketHeader"] = ScapyPacketHeader
+    number = max(1, args.number // 20)
+    print("scapy")
+    run("  encode bytes(header)",
+        "bytes(PacketHeader(type=2, seq_num=7, length=1456, checksum=0))",
+        number, env)
+    run("  decode PacketHeader(raw)", "PacketHeader(raw)", number, env)
+    run("  DATA packet + checksum",
+        "h = PacketHeader(type=2, seq_num=7, length=1456, checksum=0)\n"
+        "h.checksum = compute_checksum(bytes(h) + payload)\n"
+        "bytes(h) + payload", number, env)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Count duplicate DATA transmissions of a sender over a lossy path.
+
+Runs FOLDER_PATH/receiver.py and FOLDER_PATH/sender.py with a relay in
+between that drops packets with a fixed probability (seeded RNG), and
+counts every DATA datagram the sender puts on the wire.
+
+To compare before/after, run it on two checkouts, e.g.
+    git worktree add /tmp/rtp-before <commit>
+    python bench_retransmit.py /tmp/rtp-before/RTP-opt
+    python bench_retransmit.py ../RTP-opt
+"""
+import argparse
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+PacketHeader = struct.Struct("!IIII")
+
+
+class LossyRelay:
+    """UDP relay between one sender and one receiver that drops packets."""
+
+    def __init__(self, receiver_addr, loss, seed):
+        self.receiver_addr = receiver_addr
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.bind(("localhost", 0))
+        self.back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.front.settimeout(0.1)
+        self.back.settimeout(0.1)
+        self.sender_addr = None
+        self.running = True
+        self.data_sends = Counter()
+        self.wire_bytes = 0
+        self.acks = 0
+
+    @property
+    def port(self):
+        return self.front.getsockname()[1]
+
+    def lose(self):
+        with self.lock:
+            return self.rng.random() < self.loss
+
+    def forward(self, from_socket, to_socket, to_sender):
+        while self.running:
+            try:
+                pkt, address = from_socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if to_sender:
+                self.acks += 1
+                to_addr = self.sender_addr
+            else:
+                self.sender_addr = address
+                to_addr = self.receiver_addr
+                if len(pkt) >= PacketHeader.size:
+                    pkt_type, seq_num, _, _ = PacketHeader.unpack_from(pkt)
+                    if pkt_type == 2:
+                        self.data_sends[seq_num] += 1
+                        self.wire_bytes += len(pkt)
+            if to_addr is not None and not self.lose():
+                to_socket.sendto(pkt, to_addr)
+
+    def start(self):
+        self.threads = [
+            threading.Thread(target=self.forward, args=(self.front, self.back, False)),
+            threading.Thread(target=self.forward, args=(self.back, self.front, True)),
+        ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.front.close()
+        self.back.close()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder_path", help="Folder with sender.py and receiver.py")
+    parser.add_argument("--input", default=os.path.join(DIR, "test_message.txt"))
+    parser.add_argument("--window-size", type=int, default=128)
+    parser.add_argument("--loss", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=145)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--sender-args", default="", help='Extra sender options, e.g. "--batch-size 16"')
+    parser.add_argument("--receiver-args", default="", help='Extra receiver options, e.g. "--sack"')
+    args = parser.parse_args()
+
+    folder_path = os.path.realpath(args.folder_path)
+    receiver_port = free_port()
+    relay = LossyRelay(("localhost", receiver_port), args.loss, args.seed)
+    relay.start()
+
+    with open(os.devnull, "wb") as devnull, open(args.input, "rb") as stdin:
+        receiver = subprocess.Popen(
+            [sys.executable, "receiver.py", "localhost", str(receiver_port),
+             str(args.window_size)] + args.receiver_args.split(),
+            cwd=folder_path, stdout=subprocess.PIPE, stderr=devnull,
+        )
+        time.sleep(0.5)
+        begin = time.time()
+        sender = subprocess.Popen(
+            [sys.executable, "sender.py", "localhost", str(relay.port),
+             str(args.window_size)] + args.sender_args.split(),
+            cwd=folder_path, stdin=stdin, stdout=devnull, stderr=devnull,
+        )
+        output, _ = receiver.communicate(timeout=args.timeout)
+        sender.wait(timeout=args.timeout)
+        elapsed = time.time() - begin
+    relay.stop()
+
+    with open(args.input, "rb") as f:
+        correct = output == f.read()
+    unique = len(relay.data_sends)
+    total = sum(relay.data_sends.values())
+    print(f"folder:            {folder_path}")
+    print(f"loss:              {args.loss:.1%} (seed {args.seed})")
+    print(f"correct output:    {correct}")
+    print(f"elapsed:           {elapsed:.2f}s")
+    print(f"unique DATA:       {unique}")
+    print(f"DATA transmissions:{total:>8}")
+    print(f"duplicates:        {total - unique}")
+    print(f"DATA wire bytes:   {relay.wire_bytes}")
+    print(f"ACKs:              {relay.acks}")
+
+
+if __name__ == "__main__":
+    main()
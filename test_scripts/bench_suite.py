@@ -0,0 +1,319 @@
+"""
+End-to-end benchmark suite of the RTP implementations.
+
+For every combination of implementation, file size, window size and
+impairment, runs FOLDER/receiver.py and FOLDER/sender.py as subprocesses
+on free ports with the proxy (proxy.py) in between, in this process.
+Each run records:
+
+    correct          received output identical to the input
+    elapsed          wall time from the sender start to the receiver exit
+    wire_time        first to last packet through the proxy
+    goodput_mbps     input bits / wire_time
+    data_sends       DATA datagrams the sender put on the wire
+    retransmit_ratio (data_sends - unique DATA) / unique DATA
+    acks             datagrams from the receiver to the sender
+    sender_rss_kb    peak RSS of the sender
+    receiver_rss_kb  peak RSS of the receiver
+
+Impairments are the presets of IMPAIRMENTS or the names of the emulation
+profiles in profiles.json. Results are written as JSON and/or CSV; with
+--baseline, the median of every configuration is compared to an earlier
+JSON file and regressions are flagged (exit status 1).
+
+Usage:
+    python bench_suite.py --sizes 100K 1M --windows 32 128 \\
+        --impairments clean loss5 wan --repeat 3 --json new.json
+    python bench_suite.py --results new.json --baseline old.json
+"""
+import argparse
+import csv
+import filecmp
+import json
+import os
+import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from proxy import Proxy, load_profiles
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT = os.path.dirname(DIR)
+IMPLEMENTATIONS = ["RTP-base", "RTP-opt", "UDP-RTP"]
+PacketHeader = struct.Struct("!IIII")
+
+# Rates of the proxy for the impairment presets
+IMPAIRMENTS = {
+    "clean": {},
+    "loss1": {"loss": 0.01},
+    "loss5": {"loss": 0.05},
+    "reorder": {"reorder": 0.05},
+    "mix": {"loss": 0.02, "delay": 0.01, "reorder": 0.02, "corrupt": 0.01},
+}
+
+# Configuration key and measured fields of a result, in CSV column order
+KEY = ["implementation", "size", "window", "impairment"]
+FIELDS = KEY + ["run", "correct", "timeout", "elapsed", "wire_time", "goodput_mbps",
+                "data_sends", "unique_data", "retransmit_ratio", "acks",
+                "sender_rss_kb", "receiver_rss_kb"]
+# Compared to the baseline: a regression is a change in the bad direction
+# larger than the threshold
+COMPARED = {"wire_time": +1, "goodput_mbps": -1, "retransmit_ratio": +1,
+            "sender_rss_kb": +1, "receiver_rss_kb": +1}
+
+
+def parse_size(text):
+    """Bytes of a size like 4096, 100K or 2M."""
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class WireCounter:
+    """Proxy tap counting what the endpoints put on the wire."""
+
+    def __init__(self):
+        self.data_sends = 0
+        self.unique_data = set()
+        self.acks = 0
+        self.first = None
+        self.last = None
+
+    def __call__(self, pkt, towards_receiver, now):
+        if self.first is None:
+            self.first = now
+        self.last = now
+        if not towards_receiver:
+            self.acks += 1
+        elif len(pkt) >= PacketHeader.size:
+            pkt_type, seq_num, _, _ = PacketHeader.unpack_from(pkt)
+            if pkt_type == 2:
+                self.data_sends += 1
+                self.unique_data.add(seq_num)
+
+
+def peak_rss(pid):
+    """
+    VmHWM of a live process in KB, 0 if unknown. Unlike ru_maxrss of
+    wait4(), it starts afresh at exec instead of including the peak of
+    this process it was forked from.
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def wait_peak_rss(processes, deadline):
+    """
+    Wait for subprocesses until deadline (killing them then), sampling
+    their peak RSS until they exit. Returns the peaks in KB.
+    """
+    peaks = [0] * len(processes)
+    while True:
+        running = False
+        for i, process in enumerate(processes):
+            # Sampled before poll(): the status of a reaped process is gone
+            peaks[i] = max(peaks[i], peak_rss(process.pid))
+            if process.poll() is None:
+                running = True
+                if time.time() > deadline:
+                    process.kill()
+        if not running:
+            return peaks
+        time.sleep(0.005)
+
+
+def run_once(folder_path, input_path, output_path, window, impairment, profiles,
+             seed, timeout, sender_args, receiver_args):
+    """One transfer through the proxy, returns its measurements."""
+    if impairment in IMPAIRMENTS:
+        proxy_options = dict(IMPAIRMENTS[impairment])
+    else:
+        profile = profiles[impairment]
+        proxy_options = dict(profile.rates, profile=profile)
+    receiver_port = free_port()
+    proxy = Proxy(("localhost", free_port()), ("127.0.0.1", receiver_port), seed=seed,
+                  **proxy_options)
+    counter = WireCounter()
+    proxy.tap = counter
+    proxy_thread = threading.Thread(target=proxy.run, daemon=True)
+    proxy_thread.start()
+    proxy_port = proxy.front.getsockname()[1]
+
+    with open(input_path, "rb") as stdin, open(output_path, "wb") as stdout:
+        receiver = subprocess.Popen(
+            [sys.executable, "receiver.py", "localhost", str(receiver_port), str(window)]
+            + receiver_args, cwd=folder_path, stdout=stdout, stderr=subprocess.DEVNULL)
+        time.sleep(0.3)  # Bound before the START arrives
+        begin = time.time()
+        sender = subprocess.Popen(
+            [sys.executable, "sender.py", "localhost", str(proxy_port), str(window)]
+            + sender_args, cwd=folder_path, stdin=stdin, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        deadline = begin + timeout
+        sender_rss, receiver_rss = wait_peak_rss([sender, receiver], deadline)
+        elapsed = time.time() - begin
+    proxy.stop()
+    proxy_thread.join()
+    proxy.close()
+
+    size = os.path.getsize(input_path)
+    wire_time = (counter.last - counter.first) if counter.first is not None else 0.0
+    unique = len(counter.unique_data)
+    return {
+        "correct": filecmp.cmp(input_path, output_path, shallow=False),
+        "timeout": time.time() > deadline,
+        "elapsed": round(elapsed, 4),
+        "wire_time": round(wire_time, 4),
+        "goodput_mbps": round(size * 8 / wire_time / 1e6, 3) if wire_time else 0.0,
+        "data_sends": counter.data_sends,
+        "unique_data": unique,
+        "retransmit_ratio": round((counter.data_sends - unique) / unique, 4) if unique else 0.0,
+        "acks": counter.acks,
+        "sender_rss_kb": sender_rss,
+        "receiver_rss_kb": receiver_rss,
+    }
+
+
+def run_suite(args, profiles):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        output_path = os.path.join(tmp, "output")
+        for size_text in args.sizes:
+            size = parse_size(size_text)
+            input_path = os.path.join(tmp, f"input_{size}")
+            with open(input_path, "wb") as f:
+                f.write(random.Random(args.seed).randbytes(size))
+            for implementation in args.implementations:
+                folder_path = os.path.join(ROOT, implementation)
+                for window in args.windows:
+                    for impairment in args.impairments:
+                        for run in range(args.repeat):
+                            result = {"implementation": implementation, "size": size,
+                                      "window": window, "impairment": impairment,
+                                      "run": run}
+                            result.update(run_once(
+                                folder_path, input_path, output_path, window, impairment,
+                                profiles, args.seed + run, args.timeout,
+                                args.sender_args.split(), args.receiver_args.split()))
+                            results.append(result)
+                            print_result(result)
+    return results
+
+
+def print_result(result):
+    status = "ok" if result["correct"] else ("TIMEOUT" if result["timeout"] else "WRONG")
+    print(f"{result['implementation']:<9} {result['size']:>10} w{result['window']:<5} "
+          f"{result['impairment']:<10} {status:<7} {result['wire_time']:8.3f}s "
+          f"{result['goodput_mbps']:9.2f} Mbit/s  retx {result['retransmit_ratio']:6.2%}  "
+          f"acks {result['acks']:>7}  rss {result['sender_rss_kb']}/"
+          f"{result['receiver_rss_kb']} KB", flush=True)
+
+
+def medians(results):
+    """Median of the COMPARED fields of every configuration."""
+    groups = {}
+    for result in results:
+        groups.setdefault(tuple(result[k] for k in KEY), []).append(result)
+    return {key: {field: statistics.median(r[field] for r in group) for field in COMPARED}
+            for key, group in groups.items()}
+
+
+def compare(results, baseline, threshold):
+    """Print the changes against the baseline, returns the regressions."""
+    regressions = []
+    current = medians(results)
+    for key, old in sorted(medians(baseline).items()):
+        new = current.get(key)
+        if new is None:
+            continue
+        for field, direction in COMPARED.items():
+            if not old[field]:
+                continue
+            change = (new[field] - old[field]) / old[field]
+            if change * direction > threshold:
+                regressions.append((key, field, old[field], new[field], change))
+                print(f"REGRESSION {' '.join(map(str, key))} {field}: "
+                      f"{old[field]} -> {new[field]} ({change:+.1%})")
+            elif -change * direction > threshold:
+                print(f"improved   {' '.join(map(str, key))} {field}: "
+                      f"{old[field]} -> {new[field]} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--implementations", nargs="+", default=IMPLEMENTATIONS,
+                        help="Folders (under the repository root) to benchmark")
+    parser.add_argument("--sizes", nargs="+", default=["100K", "1M"],
+                        help="File sizes, e.g. 4096 100K 1M")
+    parser.add_argument("--windows", nargs="+", type=int, default=[128])
+    parser.add_argument("--impairments", nargs="+", default=["clean", "loss5"],
+                        help=f"Presets ({', '.join(IMPAIRMENTS)}) or profile names")
+    parser.add_argument("--profiles", default=os.path.join(DIR, "profiles.json"))
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per configuration")
+    parser.add_argument("--seed", type=int, default=145)
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds per run")
+    parser.add_argument("--sender-args", default="",
+                        help='Extra sender options for every implementation, e.g. "--batch-size 16"')
+    parser.add_argument("--receiver-args", default="",
+                        help='Extra receiver options for every implementation')
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("--csv", help="Write the results to this CSV file")
+    parser.add_argument("--results", help="Load results from this JSON file instead of running")
+    parser.add_argument("--baseline", help="JSON results to compare with, flags regressions")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative change of a median counted as a regression")
+    args = parser.parse_args()
+
+    if args.results is not None:
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        profiles = load_profiles(args.profiles)
+        for impairment in args.impairments:
+            if impairment not in IMPAIRMENTS and impairment not in profiles:
+                parser.error(f"unknown impairment {impairment!r}")
+        results = run_suite(args, profiles)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+    failed = [r for r in results if not r["correct"]]
+    if failed:
+        print(f"{len(failed)} of {len(results)} runs did not deliver the input")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
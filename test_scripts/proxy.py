@@ -1,31 +1,423 @@
+"""
+Event-driven UDP impairment proxy between RTP senders and a receiver.
+
+One selectors loop forwards both directions. Every packet independently
+is lost, delayed, reordered (held back briefly so later packets overtake
+it), corrupted or forwarded at once, with the given probabilities and a
+seeded RNG, so a run can be reproduced. Held packets wait in a timer heap
+and never block forwarding. Each sender gets its own socket towards the
+receiver, so any number of senders can share the proxy.
+
+A named emulation profile (see profiles.json) adds a link model to each
+direction: Gilbert-Elliott burst loss, duplication, a token bucket
+bandwidth limit with a drop-tail queue and a jittered latency.
+
+--trace records the fate of every packet in a binary trace, the format
+of the endpoints' traces, read by trace_analyze.py.
+
+Usage:
+    python proxy.py localhost 50000 localhost 40000 --loss 0.05 --seed 1
+    python proxy.py localhost 50000 localhost 40000 --profile wan --seed 1
+    python proxy.py localhost 50000 localhost 40000 0123   # old error types
+"""
 import argparse
+import heapq
+import json
+import os
 import random
+import selectors
 import socket
+import struct
+import sys
 import time
+from collections import Counter, deque
 
-from scapy.all import IntField, Packet
+# Same wire layout as utils.PacketHeader: type, seq_num, length, checksum
+PacketHeader = struct.Struct("!IIII")
 
+BUFFER_SIZE = 2048
+# Datagrams read from a ready socket before the other sockets get a turn
+READ_BURST = 64
+# Room for bursts of a full window of datagrams
+SOCKET_BUFFER = 4 * 1024 * 1024
+# Longest wait in the loop, how soon stop() takes effect
+STOP_POLL = 0.1
+DIR = os.path.dirname(os.path.realpath(__file__))
+PROFILES = os.path.join(DIR, "profiles.json")
 
-class PacketHeader(Packet):
-    name = "PacketHeader"
-    fields_desc = [
-        IntField("type", 0),
-        IntField("seq_num", 0),
-        IntField("length", 0),
-        IntField("checksum", 0),
-    ]
+# The trace format and writer of the endpoints, from the utils.py of
+# UDP-RTP: next to the copy of this script there, in ../UDP-RTP from here
+sys.path.append(os.path.join(DIR, "..", "UDP-RTP"))
+from utils import (BACKWARD, BURST_LOST, CORRUPTED, DELAYED, DUPLICATED, FORWARD, LOST, OK,
+                   QUEUE_DROP, REORDERED, TraceWriter)
+
+# Trace verdicts of the fates
+VERDICTS = {"forwarded": OK, "loss": LOST, "queue_drop": QUEUE_DROP, "delay": DELAYED,
+            "reorder": REORDERED, "corrupt": CORRUPTED, "duplicate": DUPLICATED,
+            "burst_loss": BURST_LOST}
 
 
 def get_seq_num(pkt):
     if len(pkt) > 1500:
         print("Error! Packet size exceeds 1500")
-    pkt_header = PacketHeader(pkt[:16])
+    if len(pkt) < PacketHeader.size:
+        return "INVALID", -1
+    pkt_header_type, seq_num, _, _ = PacketHeader.unpack_from(pkt)
     pkt_type = "START/END"
-    if pkt_header.type == 2:
+    if pkt_header_type == 2:
         pkt_type = "DATA"
-    elif pkt_header.type == 3:
+    elif pkt_header_type == 3:
         pkt_type = "ACK"
-    return pkt_type, pkt_header.seq_num
+    return pkt_type, seq_num
+
+
+def legacy_rates(error_types, share=0.2):
+    """
+    Rates equivalent to the error_types string of the old proxy: a share
+    of the packets is impaired, the impairment picked uniformly from the
+    string (1: delay, 2: reorder, 3: drop, other: jam).
+    """
+    rates = {"loss": 0.0, "delay": 0.0, "reorder": 0.0, "corrupt": 0.0}
+    for error_type in error_types:
+        rate = {"1": "delay", "2": "reorder", "3": "loss"}.get(error_type, "corrupt")
+        rates[rate] += share / len(error_types)
+    return rates
+
+
+def _udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+    return sock
+
+
+class Profile:
+    """
+    An emulated network path, applied to each direction separately.
+
+    bandwidth is in Mbit/s (None: unlimited), burst in bytes and queue in
+    packets (None: unlimited), latency and jitter in seconds, with a
+    "normal" or "uniform" jitter distribution. gilbert_elliott holds the
+    p (good to bad), r (bad to good), loss_good and loss_bad
+    probabilities of the burst loss chain. loss, delay, reorder and
+    corrupt are the independent per-packet rates of the proxy.
+    """
+
+    def __init__(self, name="", description="", bandwidth=None, burst=3000, queue=None,
+                 latency=0.0, jitter=0.0, distribution="normal", gilbert_elliott=None,
+                 duplicate=0.0, loss=0.0, delay=0.0, reorder=0.0, corrupt=0.0):
+        if distribution not in ("normal", "uniform"):
+            raise ValueError(f"Unknown latency distribution {distribution!r}")
+        self.name = name
+        self.description = description
+        self.bandwidth = bandwidth
+        self.burst = burst
+        self.queue = queue
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.gilbert_elliott = dict(p=0.0, r=1.0, loss_good=0.0, loss_bad=0.0)
+        self.gilbert_elliott.update(gilbert_elliott or {})
+        self.duplicate = duplicate
+        self.rates = {"loss": loss, "delay": delay, "reorder": reorder, "corrupt": corrupt}
+
+
+def load_profiles(path=PROFILES):
+    """Profiles by name from a JSON file of {name: {parameter: value}}."""
+    with open(path) as f:
+        config = json.load(f)
+    profiles = {}
+    for name, parameters in config.items():
+        try:
+            profiles[name] = Profile(name, **parameters)
+        except TypeError as e:
+            raise ValueError(f"Profile {name!r} in {path}: {e}") from None
+    return profiles
+
+
+class Link:
+    """
+    One direction of an emulated path: Gilbert-Elliott loss, then a token
+    bucket with a drop-tail queue, then a jittered latency.
+
+    The bucket is FIFO, so the time a packet leaves it is known when it
+    arrives: the packet is scheduled once, for that time plus its
+    latency, in the timer heap of the proxy. The link stays FIFO under
+    jitter, a packet never comes out before the one ahead of it;
+    reordering is left to the reorder rate.
+    """
+
+    def __init__(self, profile, rng):
+        self.rng = rng
+        # Bytes per second
+        self.rate = profile.bandwidth * 1e6 / 8 if profile.bandwidth else None
+        self.burst = profile.burst
+        self.tokens = profile.burst
+        self.updated = 0.0  # Time tokens was computed at
+        self.queue = profile.queue
+        self.departures = deque()  # Of the packets waiting in the bucket
+        self.latency = profile.latency
+        self.jitter = profile.jitter
+        self.uniform = profile.distribution == "uniform"
+        self.last_due = 0.0  # Time the last packet comes out
+        ge = profile.gilbert_elliott
+        self.p = ge["p"]
+        self.r = ge["r"]
+        self.loss_good = ge["loss_good"]
+        self.loss_bad = ge["loss_bad"]
+        self.bad = False
+        self.duplicate = profile.duplicate
+
+    def lost(self):
+        """Step the good/bad chain, then lose with the loss rate of the state."""
+        random = self.rng.random
+        if self.bad:
+            if random() < self.r:
+                self.bad = False
+        elif random() < self.p:
+            self.bad = True
+        return random() < (self.loss_bad if self.bad else self.loss_good)
+
+    def arrival(self, now, size):
+        """
+        Time a packet of size bytes arriving now comes out of the link,
+        or None if the queue is full (tail drop).
+        """
+        departure = now
+        if self.rate is not None:
+            departures = self.departures
+            while departures and departures[0] <= now:
+                departures.popleft()
+            if self.queue is not None and len(departures) >= self.queue:
+                return None
+            # The packet starts draining the bucket when the one ahead has left
+            start = max(now, self.updated)
+            tokens = min(self.burst, self.tokens + (start - self.updated) * self.rate)
+            if tokens >= size:
+                departure = start
+                tokens -= size
+            else:
+                departure = start + (size - tokens) / self.rate
+                tokens = 0.0
+            self.tokens = tokens
+            self.updated = departure
+            if departure > now:
+                departures.append(departure)
+        latency = self.latency
+        if self.jitter:
+            if self.uniform:
+                latency += self.rng.uniform(-self.jitter, self.jitter)
+            else:
+                latency = max(self.rng.gauss(latency, self.jitter), 0.0)
+        self.last_due = max(departure + max(latency, 0.0), self.last_due)
+        return self.last_due
+
+
+class Flow:
+    """One sender: its address and its socket towards the receiver."""
+
+    def __init__(self, address, sock, warmup):
+        self.address = address
+        self.sock = sock
+        self.warmup = warmup  # Packets still forwarded unimpaired
+
+
+class Proxy:
+    """
+    Forward datagrams between the senders that reach bind_addr and
+    receiver_addr, impairing them in both directions.
+
+    The first `warmup` packets of every flow are never lost or impaired,
+    so the START handshake gets through. With a profile, all packets go
+    through the link of their direction, shared by all flows, warmup
+    packets included: the first RTT sample already has the latency of
+    the path.
+    """
+
+    def __init__(self, bind_addr, receiver_addr, loss=0.0, delay=0.0, reorder=0.0,
+                 corrupt=0.0, delay_time=0.4, reorder_time=0.01, seed=None, warmup=10,
+                 verbose=False, profile=None):
+        self.receiver_addr = receiver_addr
+        self.rng = random.Random(seed)
+        # Towards the receiver and towards the senders
+        self.forward_link = self.backward_link = None
+        if profile is not None:
+            self.forward_link = Link(profile, self.rng)
+            self.backward_link = Link(profile, self.rng)
+        # Cumulative thresholds: a single random() picks the fate of a packet
+        self.loss = loss
+        self.delay = self.loss + delay
+        self.reorder = self.delay + reorder
+        self.corrupt = self.reorder + corrupt
+        if self.corrupt > 1:
+            raise ValueError("Impairment probabilities add up to more than 1")
+        self.delay_time = delay_time
+        self.reorder_time = reorder_time
+        self.warmup = warmup
+        self.verbose = verbose
+        # Held packets: (due time, order, socket, packet, address)
+        self.timers = []
+        self.order = 0  # Ties broken in arrival order
+        self.stats = Counter()
+        # Optional tap(pkt, towards_receiver, now), called with every packet
+        # received, before it is impaired
+        self.tap = None
+        # Optional TraceWriter, records the fate of every packet
+        self.recorder = None
+        self.running = True
+        self.selector = selectors.DefaultSelector()
+        self.front = _udp_socket()
+        self.front.bind(bind_addr)
+        self.selector.register(self.front, selectors.EVENT_READ, None)
+        self.flows = {}  # Sender address -> Flow
+
+    def _flow(self, address):
+        flow = self.flows.get(address)
+        if flow is None:
+            flow = Flow(address, _udp_socket(), self.warmup)
+            self.flows[address] = flow
+            self.selector.register(flow.sock, selectors.EVENT_READ, flow)
+        return flow
+
+    def _send(self, sock, pkt, address):
+        try:
+            sock.sendto(pkt, address)
+        except BlockingIOError:
+            self.stats["overflow"] += 1  # Socket buffer full: lost
+        except OSError:
+            self.stats["unreachable"] += 1  # Nobody listening (yet)
+        else:
+            self.stats["forwarded"] += 1
+
+    def _hold(self, due, sock, pkt, address):
+        self.order += 1
+        heapq.heappush(self.timers, (due, self.order, sock, pkt, address))
+
+    def _transmit(self, link, sock, pkt, address, now, hold=0.0, impair=True):
+        """
+        Send a packet over the link of its direction, hold seconds late.
+        Without impair it only gets the latency and bandwidth of the link,
+        no burst loss or duplication.
+        """
+        if link is None:
+            if hold:
+                self._hold(now + hold, sock, pkt, address)
+            else:
+                self._send(sock, pkt, address)
+            return
+        if impair and link.lost():
+            self._count("burst_loss", sock, pkt)
+            return
+        copies = 1
+        if impair and link.duplicate and self.rng.random() < link.duplicate:
+            copies = 2
+            self._count("duplicate", sock, pkt)
+        for _ in range(copies):
+            due = link.arrival(now, len(pkt))
+            if due is None:
+                self._count("queue_drop", sock, pkt)
+            else:
+                self._hold(due + hold, sock, pkt, address)
+
+    def _count(self, fate, sock, pkt):
+        self.stats[fate] += 1
+        if self.recorder is not None:
+            self._record(fate, sock, pkt)
+        if self.verbose:
+            pkt_type, seq_num = get_seq_num(pkt)
+            print(f"Got it: {fate}. {pkt_type}: {seq_num}")
+
+    def _record(self, fate, sock, pkt):
+        pkt_type = seq_num = 0
+        if len(pkt) >= PacketHeader.size:
+            pkt_type, seq_num, _, _ = PacketHeader.unpack_from(pkt)
+        self.recorder.record(BACKWARD if sock is self.front else FORWARD, pkt_type,
+                             seq_num, len(pkt), VERDICTS[fate])
+
+    def _impair(self, flow, link, sock, pkt, address, now):
+        """Decide the fate of one packet and forward, hold or drop it."""
+        self.stats["received"] += 1
+        if flow.warmup > 0:
+            flow.warmup -= 1
+            if self.recorder is not None:
+                self._record("forwarded", sock, pkt)
+            self._transmit(link, sock, pkt, address, now, impair=False)
+            return
+        r = self.rng.random()
+        if r >= self.corrupt:
+            if self.recorder is not None:
+                self._record("forwarded", sock, pkt)
+            self._transmit(link, sock, pkt, address, now)
+            return
+        if r < self.loss:
+            self._count("loss", sock, pkt)
+        elif r < self.delay:
+            self._count("delay", sock, pkt)
+            self._transmit(link, sock, pkt, address, now, self.delay_time)
+        elif r < self.reorder:
+            self._count("reorder", sock, pkt)
+            self._transmit(link, sock, pkt, address, now, self.reorder_time)
+        else:
+            # Recorded with the header as it was sent
+            self._count("corrupt", sock, pkt)
+            if pkt:  # An empty datagram has no byte to jam
+                pkt = bytearray(pkt)
+                pkt[self.rng.randrange(len(pkt))] = ord("a")
+            self._transmit(link, sock, pkt, address, now)
+
+    def _read(self, sock, flow):
+        """Forward the datagrams waiting on a ready socket."""
+        now = time.monotonic()
+        tap = self.tap
+        for _ in range(READ_BURST):
+            try:
+                pkt, address = sock.recvfrom(BUFFER_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # ICMP error of an earlier send
+            if tap is not None:
+                tap(pkt, flow is None, now)
+            if flow is None:
+                # From a sender, out through its own socket
+                sender = self._flow(address)
+                self._impair(sender, self.forward_link, sender.sock, pkt,
+                             self.receiver_addr, now)
+            else:
+                # From the receiver, back to the sender of this flow
+                self._impair(flow, self.backward_link, self.front, pkt, flow.address, now)
+
+    def _fire(self, now):
+        """Send the held packets that are due."""
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            _, _, sock, pkt, address = heapq.heappop(timers)
+            self._send(sock, pkt, address)
+
+    def run(self):
+        select = self.selector.select
+        while self.running:
+            timeout = STOP_POLL
+            if self.timers:
+                timeout = min(max(self.timers[0][0] - time.monotonic(), 0), STOP_POLL)
+            for key, _ in select(timeout):
+                self._read(key.fileobj, key.data)
+            if self.timers:
+                self._fire(time.monotonic())
+
+    def stop(self):
+        """Make run() return, from another thread."""
+        self.running = False
+
+    def close(self):
+        for flow in self.flows.values():
+            flow.sock.close()
+        self.front.close()
+        self.selector.close()
+
+    def report(self):
+        return ", ".join(f"{name} {count}" for name, count in sorted(self.stats.items()))
 
 
 def main():
@@ -35,127 +427,75 @@ def main():
     parser.add_argument("receiver_addr", help="Receiver address")
     parser.add_argument("receiver_port", type=int, help="Receiver port")
     parser.add_argument(
-        "error_types",
+        "error_types", nargs="?",
         help=(
-            "String of error types to simulate (e.g. '0123' for all types). "
-            "1: delay, 2: reorder, 3: drop, other: jam"
+            "String of error types to simulate (e.g. '0123' for all types), "
+            "20%% of packets impaired as in the old proxy. "
+            "1: delay, 2: reorder, 3: drop, other: jam. Overrides the rates"
         ),
     )
+    parser.add_argument("--profile",
+                        help="Emulation profile to apply to both directions")
+    parser.add_argument("--profiles", default=PROFILES,
+                        help="JSON file of the emulation profiles")
+    parser.add_argument("--list-profiles", action="store_true",
+                        help="List the emulation profiles and exit")
+    parser.add_argument("--loss", type=float,
+                        help="Probability of dropping a packet")
+    parser.add_argument("--delay", type=float,
+                        help="Probability of delaying a packet by --delay-time")
+    parser.add_argument("--reorder", type=float,
+                        help="Probability of holding a packet back by --reorder-time")
+    parser.add_argument("--corrupt", type=float,
+                        help="Probability of changing a byte of a packet to 'a'")
+    parser.add_argument("--delay-time", type=float, default=0.4,
+                        help="Seconds a delayed packet is held")
+    parser.add_argument("--reorder-time", type=float, default=0.01,
+                        help="Seconds a reordered packet is held, later ones overtake it")
+    parser.add_argument("--seed", type=int, help="RNG seed, for reproducible runs")
+    parser.add_argument("--warmup", type=int, default=10,
+                        help="Packets of each flow forwarded unimpaired first")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Print every impaired packet")
+    parser.add_argument("--trace", dest="trace_path",
+                        help="Record a binary trace of every packet to this file")
     args = parser.parse_args()
 
-    bind_addr = args.bind_addr
-    bind_port = args.bind_port
-    receiver_addr = args.receiver_addr
-    receiver_port = args.receiver_port
-    sender_addr = bind_addr
-    sender_port = [0]  # Act like a pointer to 0 to allow modification
-    options = args.error_types
-    start_stage = 0
-
-    def run(
-        from_addr, from_port, from_socket, to_addr, to_port, to_socket, start_stage
-    ):
-        def delay():
-            """Delay a packet by 0.4 seconds."""
-            pkt, _ = from_socket.recvfrom(2048)
-            pkt_type, seq_num = get_seq_num(pkt)
-            print(f"Got it: Delay. {pkt_type}: {seq_num}")
-            time.sleep(0.4)
-            to_socket.sendto(pkt, (to_addr, to_port))
-
-        def reorder():
-            """Take in 6 packets, reorder them, and send them out."""
-            num = 6
-            packet_list = []
-
-            for _ in range(num):
-                try:
-                    pkt, _ = from_socket.recvfrom(2048)
-                    pkt_type, seq_num = get_seq_num(pkt)
-                    print(f"Got it: Reorder. {pkt_type}: {seq_num}")
-                    packet_list.append(pkt)
-                except socket.error:
-                    break
-
-            random.shuffle(packet_list)
-            for pkt in packet_list:
-                to_socket.sendto(pkt, (to_addr, to_port))
-
-        def drop():
-            """Drop the next available packet."""
-            pkt, _ = from_socket.recvfrom(2048)
-            pkt_type, seq_num = get_seq_num(pkt)
-            print(f"Got it: Drop. {pkt_type}: {seq_num}")
-
-        def jam():
-            """Randomly change a byte from the packet to "a"."""
-            pkt, _ = from_socket.recvfrom(2048)
-            i = random.randint(0, len(pkt) - 1)
-            pkt = pkt[:i] + b"a" + pkt[i + 1 :]
-            pkt_type, seq_num = get_seq_num(pkt)
-            print(f"Got it: Jam. {pkt_type}: {seq_num}")
-            to_socket.sendto(pkt, (to_addr, to_port))
-
-        if start_stage < 10 or random.randint(1, 100) > 20:
-            pkt, address = from_socket.recvfrom(2048, socket.MSG_DONTWAIT)
-            if address[1] != receiver_port and address[1] != bind_port:
-                sender_port.pop(0)
-                sender_port.append(address[1])
-            pkt_type, seq_num = get_seq_num(pkt)
-            print(f"Got it: No messing. {pkt_type}: {seq_num}")
-            print(f"Forwarding packet from {from_addr}:{from_port} to {to_addr}:{to_port}")
-            to_socket.sendto(pkt, (to_addr, to_port))
-        else:
-            mode = int(options[random.randrange(len(options))])
-            if mode == 1:
-                delay()
-            elif mode == 3:
-                drop()
-            elif mode == 2:
-                reorder()
-            else:
-                jam()
-
-    sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    sender_socket.settimeout(0.1)
-    receiver_socket.settimeout(0.1)
+    profile = None
+    if args.profile is not None or args.list_profiles:
+        profiles = load_profiles(args.profiles)
+        if args.list_profiles:
+            for name, profile in profiles.items():
+                print(f"{name:<12} {profile.description}")
+            return
+        if args.profile not in profiles:
+            parser.error(f"unknown profile {args.profile!r}, "
+                         f"choose from {', '.join(profiles)}")
+        profile = profiles[args.profile]
 
-    sender_socket.bind((bind_addr, bind_port))
-
-    while True:
-        # The proxy alternatively forwards messages from sender to receiver and from
-        # receiver to sender; each turn transmits at most 5 packets
-        try:
-            for _ in range(5):
-                run(
-                    sender_addr,
-                    sender_port,
-                    sender_socket,
-                    receiver_addr,
-                    receiver_port,
-                    receiver_socket,
-                    start_stage,
-                )
-                start_stage += 1
-        except socket.error:
-            pass
-
-        try:
-            for _ in range(5):
-                run(
-                    receiver_addr,
-                    receiver_port,
-                    receiver_socket,
-                    sender_addr,
-                    sender_port[0],
-                    sender_socket,
-                    start_stage,
-                )
-                start_stage += 1
-        except socket.error:
-            pass
+    # The rates of the profile, unless given on the command line
+    rates = dict(profile.rates) if profile is not None else {}
+    for rate in ("loss", "delay", "reorder", "corrupt"):
+        if getattr(args, rate) is not None:
+            rates[rate] = getattr(args, rate)
+    if args.error_types is not None:
+        rates = legacy_rates(args.error_types)
+    receiver_addr = (socket.gethostbyname(args.receiver_addr), args.receiver_port)
+    proxy = Proxy((args.bind_addr, args.bind_port), receiver_addr,
+                  delay_time=args.delay_time, reorder_time=args.reorder_time,
+                  seed=args.seed, warmup=args.warmup, verbose=args.verbose,
+                  profile=profile, **rates)
+    if args.trace_path is not None:
+        proxy.recorder = TraceWriter(args.trace_path)
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Proxy: {proxy.report()}", file=sys.stderr)
+        proxy.close()
+        if proxy.recorder is not None:
+            proxy.recorder.close()
 
 
 if __name__ == "__main__":
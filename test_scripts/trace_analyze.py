@@ -0,0 +1,201 @@
+"""
+Offline analyzer of binary packet traces (sender.py/receiver.py --trace,
+proxy.py --trace).
+
+Prints a summary of the trace and rebuilds, over time:
+
+    sequence          seq_num of every DATA packet (sequence/time plot)
+    in_flight         DATA packets sent and not acknowledged yet
+    retransmissions   DATA packets sent again, with their verdict
+    goodput           Mbit/s of new data delivered (receiver) or
+                      acknowledged (sender, proxy), per --bin seconds
+
+--csv DIR writes each series to DIR/<name>.csv, --plot FILE draws them
+(needs matplotlib). An ACK acknowledges the packet it names, or every
+seq_num below its own when cumulative (RTP-base: recorded as such by
+its endpoints, --cumulative-acks for a proxy trace). With SACK the
+in-flight curve is an upper bound.
+
+Usage: python trace_analyze.py TRACE [--csv DIR] [--plot FILE] [--bin SECONDS]
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+from collections import Counter
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def load_utils(folder_path):
+    sys.path.insert(0, os.path.realpath(folder_path))
+    import utils
+    return utils
+
+
+def analyze(records, utils, bin_size, cumulative_acks=False):
+    """The series of a trace, see the module docstring."""
+    # The sender's DATA and the receiver's ACKs, as seen where the trace was taken
+    data_directions = {utils.SENT, utils.RECEIVED, utils.FORWARD}
+    ack_directions = {utils.RECEIVED, utils.BACKWARD}
+    # Extra records of a proxy about a packet it already recorded
+    link_verdicts = {utils.BURST_LOST, utils.QUEUE_DROP, utils.DUPLICATED}
+    dropped = {utils.CHECKSUM_FAILURE, utils.OUT_OF_WINDOW}
+    retransmit_verdicts = {utils.RETRANSMIT, utils.FAST_RETRANSMIT}
+
+    sequence = []
+    in_flight = []
+    retransmissions = []
+    delivered = []  # (time, bytes) of new data
+    data_length = {}
+    sent = set()
+    acked = set()
+    ack_base = 1  # Everything below is acknowledged by a cumulative ACK
+    for t, direction, type, seq_num, length, verdict in records:
+        if verdict in link_verdicts:
+            continue
+        if type == 2 and direction in data_directions:
+            sequence.append((t, seq_num, direction, verdict))
+            if verdict in dropped:
+                continue
+            if seq_num in data_length or verdict in retransmit_verdicts:
+                retransmissions.append((t, seq_num, verdict))
+            else:
+                data_length[seq_num] = length - utils.HEADER_SIZE
+                if direction == utils.RECEIVED:
+                    # A receiver trace: delivered as it arrives
+                    delivered.append((t, data_length[seq_num]))
+            if direction != utils.RECEIVED:
+                sent.add(seq_num)
+                in_flight.append((t, len(sent) - len(acked)))
+        elif type == 3 and direction in ack_directions:
+            if cumulative_acks or verdict == utils.CUMULATIVE:
+                covered = range(ack_base, seq_num)
+                ack_base = max(ack_base, seq_num)
+            else:
+                covered = (seq_num,)
+            new = [seq_num for seq_num in covered if seq_num in sent and seq_num not in acked]
+            if new:
+                acked.update(new)
+                delivered.append((t, sum(data_length.get(seq_num, 0) for seq_num in new)))
+                in_flight.append((t, len(sent) - len(acked)))
+
+    goodput = []
+    if delivered:
+        bins = Counter()
+        for t, length in delivered:
+            bins[int(t / bin_size)] += length
+        for i in range(min(bins), max(bins) + 1):
+            goodput.append((round(i * bin_size, 6), bins[i] * 8 / bin_size / 1e6))
+    return {"sequence": sequence, "in_flight": in_flight,
+            "retransmissions": retransmissions, "goodput": goodput}
+
+
+def summary(start, records, series, utils, bin_size):
+    lines = [f"trace started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))}"]
+    if not records:
+        return lines + ["no records"]
+    duration = records[-1][0] - records[0][0]
+    lines.append(f"records:          {len(records)} over {duration:.3f}s")
+    types = {0: "START", 1: "END", 2: "DATA", 3: "ACK", 4: "SESSION"}
+    counts = Counter((r[1], r[2], r[5]) for r in records)
+    for (direction, type, verdict), count in sorted(counts.items()):
+        lines.append(f"  {utils.DIRECTIONS[direction]:<9} {types.get(type, '?'):<8} "
+                     f"{utils.VERDICTS[verdict]:<17} {count}")
+    unique = len({r[1] for r in series["sequence"]})
+    lines.append(f"unique DATA:      {unique}")
+    lines.append(f"retransmissions:  {len(series['retransmissions'])}")
+    if series["in_flight"]:
+        lines.append(f"peak in flight:   {max(n for _, n in series['in_flight'])}")
+    if series["goodput"]:
+        rates = [rate for _, rate in series["goodput"]]
+        lines.append(f"goodput:          mean {sum(rates) / len(rates):.2f} Mbit/s, "
+                     f"peak {max(rates):.2f} Mbit/s")
+        # Longest run of bins without progress, where a transfer stalled
+        stall = longest = 0
+        for _, rate in series["goodput"]:
+            stall = stall + 1 if rate == 0 else 0
+            longest = max(longest, stall)
+        if longest:
+            lines.append(f"longest stall:    {longest * bin_size:.3f}s")
+    return lines
+
+
+def write_csv(directory, series, utils):
+    os.makedirs(directory, exist_ok=True)
+    columns = {
+        "sequence": ["time", "seq_num", "direction", "verdict"],
+        "in_flight": ["time", "in_flight"],
+        "retransmissions": ["time", "seq_num", "verdict"],
+        "goodput": ["time", "mbps"],
+    }
+    for name, rows in series.items():
+        with open(os.path.join(directory, f"{name}.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns[name])
+            for row in rows:
+                row = list(row)
+                if name == "sequence":
+                    row[2] = utils.DIRECTIONS[row[2]]
+                if name in ("sequence", "retransmissions"):
+                    row[-1] = utils.VERDICTS[row[-1]]
+                writer.writerow(row)
+
+
+def plot(path, series, utils, title):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figure, (seq_axes, flight_axes, goodput_axes) = plt.subplots(
+        3, 1, sharex=True, figsize=(10, 10))
+    figure.suptitle(title)
+    sequence = series["sequence"]
+    seq_axes.scatter([r[0] for r in sequence], [r[1] for r in sequence], s=1,
+                     label="DATA")
+    retransmissions = series["retransmissions"]
+    seq_axes.scatter([r[0] for r in retransmissions], [r[1] for r in retransmissions],
+                     s=6, color="red", label="retransmitted")
+    seq_axes.set_ylabel("seq_num")
+    seq_axes.legend(loc="upper left")
+    flight_axes.step([r[0] for r in series["in_flight"]],
+                     [r[1] for r in series["in_flight"]], where="post")
+    flight_axes.set_ylabel("packets in flight")
+    goodput_axes.step([r[0] for r in series["goodput"]],
+                      [r[1] for r in series["goodput"]], where="post")
+    goodput_axes.set_ylabel("goodput (Mbit/s)")
+    goodput_axes.set_xlabel("time (s)")
+    figure.savefig(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="Trace file to analyze")
+    parser.add_argument("--bin", type=float, default=0.1,
+                        help="Seconds per goodput bin")
+    parser.add_argument("--csv", dest="csv_dir", help="Write the series as CSV files here")
+    parser.add_argument("--plot", help="Draw the series to this image file (matplotlib)")
+    parser.add_argument("--cumulative-acks", action="store_true",
+                        help="The ACKs of a proxy trace are cumulative (RTP-base)")
+    parser.add_argument(
+        "--folder", default=os.path.join(DIR, "..", "UDP-RTP"),
+        help="Folder containing the utils.py that defines the trace format",
+    )
+    args = parser.parse_args()
+
+    utils = load_utils(args.folder)
+    start, records = utils.read_trace(args.trace)
+    series = analyze(records, utils, args.bin, args.cumulative_acks)
+    print("\n".join(summary(start, records, series, utils, args.bin)))
+    if args.csv_dir:
+        write_csv(args.csv_dir, series, utils)
+    if args.plot:
+        try:
+            plot(args.plot, series, utils, os.path.basename(args.trace))
+        except ImportError:
+            parser.error("--plot needs matplotlib (pip install matplotlib)")
+
+
+if __name__ == "__main__":
+    main()